@@ -0,0 +1,253 @@
+"""Request and MongoDB command metrics, exported in Prometheus text format.
+
+`RequestMetricsMiddleware` records per-route latency, payload sizes and the
+MongoDB time spent inside each request; `CommandMetrics` is a pymongo command
+listener recording per-collection/per-command timings and documents returned.
+Both write into a `MetricsRegistry`, rendered by the /api/metrics route.
+"""
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from pymongo import monitoring
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+METRIC_HELP = {
+    "http_request_duration_seconds": ("histogram", "HTTP request latency by route"),
+    "http_request_mongo_seconds": ("histogram", "Time spent in MongoDB commands per HTTP request"),
+    "http_request_size_bytes": ("histogram", "HTTP request body size by route"),
+    "http_response_size_bytes": ("histogram", "HTTP response body size by route"),
+    "mongodb_command_duration_seconds": ("histogram", "MongoDB command latency by collection and command"),
+    "mongodb_documents_returned_total": ("counter", "Documents returned by MongoDB commands"),
+    "mongodb_command_failures_total": ("counter", "Failed MongoDB commands"),
+    "storage_ping_seconds": ("histogram", "Database round-trip time measured by the health checks"),
+}
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, Tuple], Histogram] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+
+    def observe(self, name: str, labels: dict, value: float, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name: str, labels: dict, value: float = 1):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def render(self) -> str:
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        described = set()
+        for (name, labels), histogram in histograms:
+            describe(lines, described, name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{format_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            describe(lines, described, name)
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def describe(lines: List[str], described: set, name: str):
+    if name in described:
+        return
+    described.add(name)
+    kind, help_text = METRIC_HELP.get(name, ("untyped", name))
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def format_labels(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+# Per-request trace shared with the command listener. Motor runs pymongo calls
+# in a thread pool with a copy of the caller's context, so commands issued
+# while handling a request see that request's trace object.
+class RequestTrace:
+    def __init__(self, capture_queries: bool):
+        self.mongo_seconds = 0.0
+        self.queries: Optional[List[dict]] = [] if capture_queries else None
+
+
+current_trace: ContextVar[Optional[RequestTrace]] = ContextVar("current_trace", default=None)
+
+
+def query_shape(value):
+    """Replace literal values with '?' so queries can be logged without data."""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if value and all(isinstance(item, dict) for item in value):
+            return [query_shape(item) for item in value]
+        return "?"
+    return "?"
+
+
+def command_shape(command_name: str, command) -> dict:
+    if command_name == "find":
+        return {"filter": query_shape(command.get("filter", {})), "sort": query_shape(command.get("sort", {}))}
+    if command_name == "aggregate":
+        return {"pipeline": [next(iter(stage), "?") for stage in command.get("pipeline", [])]}
+    if command_name in ("update", "delete"):
+        statements = command.get("updates" if command_name == "update" else "deletes", [])
+        return {"filter": query_shape(statements[0].get("q", {})) if statements else {}, "count": len(statements)}
+    if command_name == "findAndModify":
+        return {"filter": query_shape(command.get("query", {}))}
+    if command_name == "insert":
+        return {"documents": len(command.get("documents", []))}
+    return {}
+
+
+class CommandMetrics(monitoring.CommandListener):
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def started(self, event):
+        command = event.command
+        collection = command.get(event.command_name)
+        if event.command_name == "getMore":
+            collection = command.get("collection")
+        if not isinstance(collection, str):
+            collection = "-"
+        trace = current_trace.get()
+        shape = None
+        if trace is not None and trace.queries is not None:
+            shape = command_shape(event.command_name, command)
+        with self._lock:
+            self._inflight[(event.connection_id, event.request_id)] = (collection, trace, shape)
+
+    def succeeded(self, event):
+        collection, trace = self._finish(event)
+        labels = {"collection": collection, "command": event.command_name}
+        self.registry.observe("mongodb_command_duration_seconds", labels, event.duration_micros / 1e6)
+        returned = documents_returned(event.command_name, event.reply)
+        if returned:
+            self.registry.inc("mongodb_documents_returned_total", labels, returned)
+
+    def failed(self, event):
+        collection, _ = self._finish(event)
+        labels = {"collection": collection, "command": event.command_name}
+        self.registry.observe("mongodb_command_duration_seconds", labels, event.duration_micros / 1e6)
+        self.registry.inc("mongodb_command_failures_total", labels)
+
+    def _finish(self, event):
+        with self._lock:
+            collection, trace, shape = self._inflight.pop((event.connection_id, event.request_id), ("-", None, None))
+        if trace is not None:
+            trace.mongo_seconds += event.duration_micros / 1e6
+            if shape is not None:
+                trace.queries.append({
+                    "collection": collection,
+                    "command": event.command_name,
+                    "ms": round(event.duration_micros / 1000, 3),
+                    **shape,
+                })
+        return collection, trace
+
+
+def documents_returned(command_name: str, reply) -> int:
+    cursor = reply.get("cursor")
+    if cursor:
+        return len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+    if command_name == "findAndModify":
+        return 1 if reply.get("value") else 0
+    return 0
+
+
+class RequestMetricsMiddleware:
+    """ASGI middleware recording latency and payload sizes per route template."""
+
+    def __init__(self, app, registry: MetricsRegistry, slow_request_ms: Optional[float] = None):
+        self.app = app
+        self.registry = registry
+        self.slow_request_ms = slow_request_ms
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = RequestTrace(capture_queries=self.slow_request_ms is not None)
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        status_code = 500
+        response_bytes = 0
+
+        async def send_wrapper(message):
+            nonlocal status_code, response_bytes
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            current_trace.reset(token)
+            duration = time.perf_counter() - started
+            self.record(scope, status_code, duration, response_bytes, trace)
+
+    def record(self, scope, status_code: int, duration: float, response_bytes: int, trace: RequestTrace):
+        route = scope.get("route")
+        labels = {
+            "method": scope["method"],
+            "route": getattr(route, "path", "unmatched"),
+            "status": str(status_code),
+        }
+        self.registry.observe("http_request_duration_seconds", labels, duration)
+        self.registry.observe("http_request_mongo_seconds", labels, trace.mongo_seconds)
+        self.registry.observe("http_response_size_bytes", labels, response_bytes, SIZE_BUCKETS)
+        request_bytes = dict(scope.get("headers", [])).get(b"content-length")
+        if request_bytes and request_bytes.isdigit():
+            self.registry.observe("http_request_size_bytes", labels, int(request_bytes), SIZE_BUCKETS)
+
+        if self.slow_request_ms is not None and duration * 1000 >= self.slow_request_ms:
+            logger.warning("Slow request %s %s %s %.1fms (mongo %.1fms): %s",
+                           scope["method"], scope["path"], status_code, duration * 1000,
+                           trace.mongo_seconds * 1000, json.dumps(trace.queries))
@@ -1,30 +1,59 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, Depends, Header, HTTPException, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
-from motor.motor_asyncio import AsyncIOMotorClient
 import os
+import io
+import csv
+import json
+import time
+import asyncio
+import calendar
+import hashlib
 import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from pathlib import Path
-from pydantic import BaseModel, Field, ConfigDict
-from typing import List, Optional
-from datetime import datetime, timezone
+from pydantic import BaseModel, Field, ConfigDict, ValidationError
+from typing import Dict, List, Literal, NamedTuple, Optional, get_args
+from datetime import date, datetime, timedelta, timezone
+try:
+    import orjson
+except ImportError:  # optional, the stdlib encoder is used without it
+    orjson = None
+from metrics import CommandMetrics, MetricsRegistry, RequestMetricsMiddleware
+from storage import (
+    BRANCH_PATTERN, DEFAULT_BRANCH, PAYMENT_METHODS, SEARCH_KINDS, TRANSACTION_TYPES, DuplicateError,
+    InvalidCursor, PeriodClosed, StockItemAlreadySold, StockItemNotFound, StorageError, backdated, create_storage,
+    normalize_text, utc_today,
+)
 
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
 
-# MongoDB connection
-mongo_url = os.environ['MONGO_URL']
-client = AsyncIOMotorClient(mongo_url)
-db = client[os.environ['DB_NAME']]
+# Metrics shared by the request middleware and the Mongo command listener
+metrics_registry = MetricsRegistry()
+
+# Storage backend (STORAGE_BACKEND=mongo|sqlite|memory, see storage/__init__.py)
+storage = create_storage(event_listeners=[CommandMetrics(metrics_registry)])
+
+# Startup and shutdown (start_app/stop_app, at the end of this module)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_app()
+    try:
+        yield
+    finally:
+        await stop_app()
 
 # Create the main app without a prefix
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Create a router with the /api prefix
 api_router = APIRouter(prefix="/api")
 
-
 # Models
 class ItemType(BaseModel):
     model_config = ConfigDict(extra="ignore")
@@ -37,7 +66,7 @@ class ItemTypeResponse(BaseModel):
 class StockItem(BaseModel):
     model_config = ConfigDict(extra="ignore")
     item_number: str
-    date_of_purchase: str
+    date_of_purchase: date
     type: str
     description: str
     supplier_name: str
@@ -46,7 +75,7 @@ class StockItem(BaseModel):
     status: str = "current"  # current or sold
 
 class StockItemCreate(BaseModel):
-    date_of_purchase: str
+    date_of_purchase: date
     type: str
     description: str
     supplier_name: str
@@ -55,7 +84,8 @@ class StockItemCreate(BaseModel):
 
 class Transaction(BaseModel):
     model_config = ConfigDict(extra="ignore")
-    date: str
+    id: Optional[int] = None  # change version at insert; unset on rows read from old exports
+    date: date
     transaction_type: str  # sell, purchase, spending
     name: str  # customer or supplier name
     amount: float
@@ -63,7 +93,7 @@ class Transaction(BaseModel):
     stock_code: Optional[str] = None
 
 class TransactionCreate(BaseModel):
-    date: str
+    date: date
     transaction_type: str
     name: str
     amount: float
@@ -79,169 +109,1341 @@ class CustomerSupplierCreate(BaseModel):
     name: str
     type: str
 
+class SearchResult(BaseModel):
+    kind: str  # stock, customer or supplier
+    name: str  # item description or contact name
+    item_number: Optional[str] = None
+    supplier_name: Optional[str] = None
+    score: float
+
 class Balance(BaseModel):
     cash: float
     bank1: float
     bank2: float
     total: float
 
+class Branch(BaseModel):
+    name: str = Field(..., pattern=BRANCH_PATTERN)
 
-# Helper function to get next stock number
-async def get_next_stock_number():
-    counter = await db.counters.find_one({"name": "stock_counter"})
-    if not counter:
-        await db.counters.insert_one({"name": "stock_counter", "value": 1000})
-        return "1000"
-    
-    new_value = counter["value"] + 1
-    await db.counters.update_one(
-        {"name": "stock_counter"},
-        {"$set": {"value": new_value}}
+class BranchBalance(Balance):
+    name: str
+
+class DashboardData(BaseModel):
+    transactions: Optional[List[Transaction]] = None
+    balance: Optional[Balance] = None
+    stock: Optional[List[StockItem]] = None
+    customers: Optional[List[CustomerSupplier]] = None
+    suppliers: Optional[List[CustomerSupplier]] = None
+
+class SyncDeletions(BaseModel):
+    transactions: List[int]
+    stock: List[str]
+
+class SyncResponse(BaseModel):
+    version: int  # pass as `since` on the next sync
+    more: bool
+    transactions: List[Transaction]
+    stock: List[StockItem]
+    deleted: SyncDeletions
+
+class PnlReportRow(BaseModel):
+    period: str
+    sell: float
+    purchase: float
+    spending: float
+    income: float
+    net: float
+    count: int
+
+class BranchPnlReportRow(PnlReportRow):
+    branch: str
+
+class PaymentMethodReportRow(BaseModel):
+    payment_method: str
+    sell: float
+    purchase: float
+    spending: float
+    net: float
+    count: int
+
+class SpendingReportRow(BaseModel):
+    period: str
+    cash: float
+    bank1: float
+    bank2: float
+    total: float
+
+class MarginReportRow(BaseModel):
+    key: str  # item type, supplier or period
+    count: int
+    revenue: float  # sale amounts
+    cost: float  # purchase prices of the sold items
+    margin: float
+    margin_pct: Optional[float] = None  # margin / revenue * 100, None without revenue
+
+class StockAgingRow(BaseModel):
+    bucket: str  # age in days, e.g. "31-90" or "366+"
+    count: int
+    value: float  # purchase prices
+
+class HealthStatus(BaseModel):
+    status: str
+    storage: str
+    db_latency_ms: float
+
+class LedgerEntry(BaseModel):
+    balance: float
+    count: int
+
+class PeriodClose(BaseModel):
+    period: str = Field(..., pattern=r"^\d{4}(-(0[1-9]|1[0-2]))?$")  # "2024" or "2024-03"
+    archive: bool = False  # move the period's transactions out of the hot collection
+
+class PeriodSnapshot(BaseModel):
+    period: str
+    period_end: str
+    closed_at: str
+    ledger: Dict[str, LedgerEntry]  # per payment method, as of period_end
+    total: float
+
+class PeriodCloseResult(PeriodSnapshot):
+    archived: int  # transactions moved to the archive
+
+class BulkRowError(BaseModel):
+    row: int  # 1-based position in the uploaded array/CSV
+    error: str
+
+class BulkImportResult(BaseModel):
+    inserted: int
+    errors: List[BulkRowError]
+
+class StockBulkImportResult(BulkImportResult):
+    item_numbers: List[str]
+
+
+# Branches
+# Every route works on one branch, chosen with the `branch` query parameter
+# (EventSource cannot send headers) and DEFAULT_BRANCH when it is omitted.
+# Branch names are cached per worker; an unknown name re-reads the registry,
+# so branches created through another worker are picked up.
+known_branches = set()
+
+async def get_branch(branch: str = Query(DEFAULT_BRANCH, pattern=BRANCH_PATTERN)) -> str:
+    if branch not in known_branches:
+        known_branches.update(await storage.list_branches())
+        if branch not in known_branches:
+            raise HTTPException(status_code=404, detail="Branch not found")
+    return branch
+
+
+# Balance ledger
+# Each backend keeps a running total per branch and payment method next to
+# the transactions, so reading the balance never scans the transaction history.
+async def rebuild_balance_ledger(branch: str):
+    return await storage.rebuild_balances(branch)
+
+async def verify_balance_ledger(branch: str):
+    expected = await storage.compute_balances_from_history(branch)
+    ledger = await storage.get_ledger(branch)
+    mismatches = {}
+    for method in PAYMENT_METHODS:
+        stored = ledger[method]
+        if abs(stored["balance"] - expected[method]["balance"]) > 1e-6 or stored["count"] != expected[method]["count"]:
+            mismatches[method] = {
+                "ledger": {"balance": stored["balance"], "count": stored["count"]},
+                "history": expected[method],
+            }
+    return mismatches
+
+
+# Daily rollups
+# Backends keep per-day amount/count totals for every transaction type and
+# payment method current on every write; reports are built from those.
+PERIOD_LENGTHS = {"day": 10, "month": 7, "year": 4}
+
+async def rebuild_daily_rollups(branch: str):
+    return await storage.rebuild_rollups(branch)
+
+
+# Stock number allocation
+# Numbers come from a single atomic increment of the branch's stock counter,
+# so concurrent inserts can never be handed the same item_number. With
+# STOCK_NUMBER_BLOCK_SIZE > 1 each worker leases a block of numbers per branch
+# in one round-trip and hands them out from memory; numbers left in a block
+# when the worker stops are skipped, so item numbers stay unique but may have
+# gaps.
+class StockNumberAllocator:
+    def __init__(self, block_size: int = 1):
+        self.block_size = max(1, block_size)
+        # branch -> (next number, end of the leased block)
+        self._blocks = {}
+        self._locks = {}
+
+    async def next(self, branch: str):
+        if self.block_size == 1:
+            return str(await storage.reserve_stock_numbers(branch, 1))
+        async with self._locks.setdefault(branch, asyncio.Lock()):
+            value, end = self._blocks.get(branch, (0, 0))
+            if value >= end:
+                value = await storage.reserve_stock_numbers(branch, self.block_size)
+                end = value + self.block_size
+            self._blocks[branch] = (value + 1, end)
+        return str(value)
+
+stock_number_allocator = StockNumberAllocator(int(os.environ.get('STOCK_NUMBER_BLOCK_SIZE', '1')))
+
+async def get_next_stock_number(branch: str):
+    return await stock_number_allocator.next(branch)
+
+
+# Recording transactions
+# A sell claims its stock item together with the insert, so two tills can
+# never sell the same item (see the backends for how each keeps this atomic).
+# An Idempotency-Key is stored on the transaction under a unique index, so a
+# retried request returns the transaction that was already recorded.
+async def claim_stock_item(branch: str, item_number: str):
+    try:
+        await storage.claim_stock_item(branch, item_number)
+    except StockItemAlreadySold:
+        raise HTTPException(status_code=409, detail="Stock item already sold")
+    except StockItemNotFound:
+        raise HTTPException(status_code=404, detail="Stock item not found")
+
+# Group commit
+# With WRITE_BATCH_MAX_ITEMS > 1, single transaction POSTs are queued and one
+# background task writes them together: a batch is flushed when it reaches
+# WRITE_BATCH_MAX_ITEMS or WRITE_BATCH_MAX_DELAY_MS after its first item
+# arrived. Each request waits for its own result, so it is only acknowledged
+# once its batch is written (with WRITE_BATCH_W/WRITE_BATCH_JOURNAL on Mongo).
+# A batch is written as one storage batch per branch, concurrently.
+class TransactionBatcher:
+    def __init__(self, max_items: int = 1, max_delay_ms: float = 5.0):
+        self.max_items = max(1, max_items)
+        self.max_delay = max_delay_ms / 1000
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        """Whether writes go through the queue: batching is configured and
+        the writer task is running. Otherwise callers record directly."""
+        return self._task is not None
+
+    def start(self):
+        if self.max_items > 1 and self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run(self._queue))
+
+    async def stop(self):
+        """Flush whatever is queued, then stop the writer task. The queue is
+        detached first, so writes arriving meanwhile are recorded directly
+        instead of waiting behind the stop marker."""
+        if self._task is not None:
+            task, queue = self._task, self._queue
+            self._task = self._queue = None
+            await queue.put(None)
+            await task
+
+    async def record(self, branch: str, trans_dict: dict, stock_code: Optional[str]):
+        if self._queue is None:
+            # Not running (never started or stopped): no writer to wait for
+            return await storage.record_transaction(branch, trans_dict, stock_code)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((branch, trans_dict, stock_code, future))
+        await future
+
+    async def _run(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            entry = await queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_items:
+                try:
+                    entry = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        entry = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            await self._flush(batch)
+
+    async def _flush(self, batch):
+        by_branch = {}
+        for branch, doc, stock_code, future in batch:
+            by_branch.setdefault(branch, []).append((doc, stock_code, future))
+        await asyncio.gather(*(self._flush_branch(branch, entries) for branch, entries in by_branch.items()))
+
+    async def _flush_branch(self, branch: str, batch):
+        try:
+            errors = await storage.record_transaction_batch(branch, [(doc, stock_code) for doc, stock_code, _ in batch])
+        except Exception as e:
+            logger.exception(f"Transaction batch of {len(batch)} for branch {branch} failed")
+            errors = [e] * len(batch)
+        for (_, _, future), error in zip(batch, errors):
+            if future.done():
+                continue
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+transaction_batcher = TransactionBatcher(
+    max_items=int(os.environ.get('WRITE_BATCH_MAX_ITEMS', '1')),
+    max_delay_ms=float(os.environ.get('WRITE_BATCH_MAX_DELAY_MS', '5'))
+)
+
+async def record_transaction(branch: str, trans_dict: dict, stock_code: Optional[str]):
+    try:
+        if transaction_batcher.enabled:
+            await transaction_batcher.record(branch, trans_dict, stock_code)
+        else:
+            await storage.record_transaction(branch, trans_dict, stock_code)
+    except StockItemAlreadySold:
+        raise HTTPException(status_code=409, detail="Stock item already sold")
+    except StockItemNotFound:
+        raise HTTPException(status_code=404, detail="Stock item not found")
+    except PeriodClosed:
+        raise HTTPException(status_code=409, detail="Transaction date is in a closed period")
+
+
+# List helpers
+# List endpoints use keyset pagination: `after` is the cursor of the last row
+# of the previous page and the next cursor is returned in the X-Next-Cursor
+# header, so the body stays a plain list. `stream=true` writes NDJSON straight
+# from the backend's cursor instead of materializing the result. `from`/`to`
+# date filters are inclusive and passed to storage as "YYYY-MM-DD".
+MAX_PAGE_SIZE = 5000
+
+def iso_date(value: Optional[date]) -> Optional[str]:
+    return value.isoformat() if value else None
+
+async def ndjson_lines(docs):
+    async for doc in docs:
+        yield json.dumps(doc) + "\n"
+
+async def list_page(list_method, stream_method, model, response: Response,
+                    limit: Optional[int] = None, after: Optional[str] = None, stream: bool = False, **filters):
+    try:
+        if stream:
+            docs = stream_method(**filters, limit=limit, after=after)
+            return StreamingResponse(ndjson_lines(docs), media_type="application/x-ndjson")
+        page = await list_method(**filters, limit=limit, after=after)
+    except InvalidCursor:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if fast_list_responses:
+        response = Response(list_encoder(model).encode(page.docs), media_type="application/json")
+    if page.next_cursor:
+        response.headers["X-Next-Cursor"] = page.next_cursor
+    return response if fast_list_responses else page.docs
+
+
+# Fast list serialization
+# Returning documents through `response_model=List[...]` validates every row
+# into a model, serializes it back and runs it through jsonable_encoder before
+# json.dumps. Rows read from storage are already shaped by the backend's field
+# projection, so with FAST_LIST_RESPONSES=1 list responses are encoded
+# directly: fields are put in model order, optional defaults filled in and
+# ints in float fields widened, then the list is dumped with orjson. orjson
+# only formats floats differently from json.dumps outside 1e-4 <= |x| < 1e16
+# (exponent notation), so responses containing such values fall back to the
+# stdlib encoder and the output stays byte-identical to the model path.
+fast_list_responses = os.environ.get('FAST_LIST_RESPONSES', '').lower() in ('1', 'true', 'yes')
+
+class ListEncoder:
+    def __init__(self, model):
+        self.template = tuple(
+            (name, None if field.is_required() else field.default) for name, field in model.model_fields.items()
+        )
+        self.float_fields = tuple(
+            name for name, field in model.model_fields.items() if field.annotation in (float, Optional[float])
+        )
+
+    def rows(self, docs, exclude_unset: bool = False):
+        rows, orjson_safe = [], orjson is not None
+        for doc in docs:
+            if exclude_unset:
+                row = {name: doc[name] for name, _ in self.template if name in doc}
+            else:
+                row = {name: doc[name] if name in doc else default for name, default in self.template}
+            for name in self.float_fields:
+                value = row.get(name)
+                if value is None:
+                    continue
+                if type(value) is not float:
+                    row[name] = value = float(value)
+                if orjson_safe and not (1e-4 <= abs(value) < 1e16 or value == 0.0):
+                    orjson_safe = False
+            rows.append(row)
+        return rows, orjson_safe
+
+    def encode(self, docs, exclude_unset: bool = False) -> bytes:
+        rows, orjson_safe = self.rows(docs, exclude_unset)
+        return orjson.dumps(rows) if orjson_safe else encode_json(rows)
+
+@lru_cache(maxsize=None)
+def list_encoder(model) -> ListEncoder:
+    return ListEncoder(model)
+
+
+# Reference data cache
+# Item types and contacts change rarely but are fetched on every page load, so
+# their list responses are cached per worker and branch (namespaces like
+# "item_types:main") as encoded JSON with a strong content ETag. Writes bump
+# the namespace version, which invalidates every entry for it; the TTL bounds
+# staleness across workers. A matching If-None-Match is answered with a 304
+# without touching the database.
+class CachedBody(NamedTuple):
+    body: bytes
+    etag: str
+    version: int
+    expires_at: float
+
+class ReferenceCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._versions = {}
+
+    def version(self, namespace: str) -> int:
+        return self._versions.get(namespace, 0)
+
+    def get(self, namespace: str, key) -> Optional[CachedBody]:
+        entry = self._entries.get((namespace, key))
+        if entry is None:
+            return None
+        if entry.expires_at < time.monotonic() or entry.version != self.version(namespace):
+            del self._entries[(namespace, key)]
+            return None
+        self._entries.move_to_end((namespace, key))
+        return entry
+
+    def put(self, namespace: str, key, body: bytes, version: int) -> CachedBody:
+        etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+        entry = CachedBody(body, etag, version, time.monotonic() + self.ttl)
+        # Skip storing if a write invalidated the namespace while we were loading
+        if version == self.version(namespace):
+            self._entries[(namespace, key)] = entry
+            self._entries.move_to_end((namespace, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, namespace: str):
+        self._versions[namespace] = self.version(namespace) + 1
+        for cache_key in [k for k in self._entries if k[0] == namespace]:
+            del self._entries[cache_key]
+
+    def observe(self, namespace: str, version: int):
+        """Version the namespace with an external counter instead; entries
+        cached under another value are dropped when read."""
+        self._versions[namespace] = version
+
+reference_cache = ReferenceCache(
+    ttl=float(os.environ.get('REFERENCE_CACHE_TTL', '60')),
+    max_entries=int(os.environ.get('REFERENCE_CACHE_SIZE', '64'))
+)
+
+def encode_json(content) -> bytes:
+    # Same encoding as starlette's JSONResponse
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+async def cached_list(namespace: str, key, load, model, cache: ReferenceCache = reference_cache) -> CachedBody:
+    entry = cache.get(namespace, key)
+    if entry is None:
+        version = cache.version(namespace)
+        docs = await load()
+        entry = cache.put(namespace, key, encode_json([model(**doc).model_dump() for doc in docs]), version)
+    return entry
+
+async def cached_list_response(request: Request, namespace: str, key, load, model,
+                               cache: ReferenceCache = reference_cache):
+    entry = await cached_list(namespace, key, load, model, cache)
+    headers = {"ETag": entry.etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        return Response(status_code=304, headers=headers)
+    return Response(entry.body, media_type="application/json", headers=headers)
+
+
+# Bulk import helpers
+# Bulk endpoints accept a JSON array, a text/csv body or a multipart upload
+# with the CSV in a `file` field. Rows are validated in one pass; invalid rows
+# are reported back and the valid ones are written in a single batch.
+async def read_bulk_rows(request: Request) -> List[dict]:
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith("multipart/form-data"):
+        form = await request.form()
+        upload = form.get("file")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(status_code=400, detail="Missing CSV file upload")
+        return parse_csv_rows(decode_csv(await upload.read(), upload.content_type or ""))
+    if content_type.startswith("text/csv"):
+        return parse_csv_rows(decode_csv(await request.body(), content_type))
+
+    try:
+        rows = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or CSV")
+    if not isinstance(rows, list):
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or CSV")
+    return rows
+
+def decode_csv(data: bytes, content_type: str) -> str:
+    # UTF-8 (with or without a BOM) unless the upload names its charset
+    charset = next((param.split("=", 1)[1].strip().strip('"') for param in content_type.split(";")[1:]
+                    if param.strip().lower().startswith("charset=")), "utf-8")
+    try:
+        return data.decode("utf-8-sig" if charset.lower() in ("utf-8", "utf8") else charset)
+    except LookupError:
+        raise HTTPException(status_code=400, detail=f"Unknown CSV charset: {charset}")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400,
+                            detail=f"CSV is not valid {charset}; save it as UTF-8 or send its charset")
+
+def parse_csv_rows(text: str) -> List[dict]:
+    # Empty cells are treated as missing so model defaults apply
+    return [
+        {key.strip(): value.strip() for key, value in row.items() if key and value and value.strip()}
+        for row in csv.DictReader(io.StringIO(text))
+    ]
+
+def format_validation_error(error: ValidationError) -> str:
+    return "; ".join(
+        f"{'.'.join(str(part) for part in e['loc']) or 'row'}: {e['msg']}" for e in error.errors()
     )
-    return str(new_value)
+
+def validate_rows(rows: List[dict], model):
+    valid, errors = [], []
+    for position, row in enumerate(rows, start=1):
+        try:
+            valid.append((position, model.model_validate(row)))
+        except ValidationError as e:
+            errors.append(BulkRowError(row=position, error=format_validation_error(e)))
+    return valid, errors
+
+
+# Branch Routes
+# GET /api/branches lists every branch with its balance, read from all the
+# ledgers in one query.
+@api_router.post("/branches", response_model=Branch)
+async def create_branch(branch: Branch):
+    try:
+        await storage.create_branch(branch.name)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail="Branch already exists")
+    known_branches.add(branch.name)
+    return branch
+
+@api_router.get("/branches", response_model=List[BranchBalance])
+async def get_branches():
+    names = await storage.list_branches()
+    ledgers = await storage.branch_ledgers()
+    rows = []
+    for name in names:
+        totals = {method: ledgers[name][method]["balance"] if name in ledgers else 0.0 for method in PAYMENT_METHODS}
+        rows.append(BranchBalance(name=name, **totals, total=sum(totals.values())))
+    return rows
 
 
 # Item Types Routes
 @api_router.post("/item-types", response_model=ItemTypeResponse)
-async def create_item_type(item_type: ItemType):
-    existing = await db.item_types.find_one({"name": item_type.name})
-    if existing:
-        raise HTTPException(status_code=400, detail="Item type already exists")
-    
+async def create_item_type(item_type: ItemType, branch: str = Depends(get_branch)):
     doc = item_type.model_dump()
-    await db.item_types.insert_one(doc)
+    try:
+        await storage.insert_item_type(branch, doc)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail="Item type already exists")
+    reference_cache.invalidate(f"item_types:{branch}")
     return ItemTypeResponse(**doc)
 
 @api_router.get("/item-types", response_model=List[ItemTypeResponse])
-async def get_item_types():
-    types = await db.item_types.find({}, {"_id": 0}).to_list(1000)
-    return types
+async def get_item_types(request: Request, branch: str = Depends(get_branch)):
+    return await cached_list_response(request, f"item_types:{branch}", None,
+                                      lambda: storage.list_item_types(branch), ItemTypeResponse)
 
 @api_router.delete("/item-types/{name}")
-async def delete_item_type(name: str):
-    result = await db.item_types.delete_one({"name": name})
-    if result.deleted_count == 0:
+async def delete_item_type(name: str, branch: str = Depends(get_branch)):
+    if not await storage.delete_item_type(branch, name):
         raise HTTPException(status_code=404, detail="Item type not found")
+    reference_cache.invalidate(f"item_types:{branch}")
     return {"message": "Item type deleted successfully"}
 
 
 # Stock Routes
 @api_router.post("/stock", response_model=StockItem)
-async def create_stock_item(item: StockItemCreate):
-    item_number = await get_next_stock_number()
+async def create_stock_item(item: StockItemCreate, branch: str = Depends(get_branch)):
+    item_number = await get_next_stock_number(branch)
     
-    stock_dict = item.model_dump()
+    stock_dict = item.model_dump(mode="json")
     stock_dict["item_number"] = item_number
     stock_dict["status"] = "current"
     
-    await db.stock_items.insert_one(stock_dict)
-    return StockItem(**stock_dict)
+    await storage.insert_stock_items(branch, [stock_dict])
+    created = StockItem(**stock_dict)
+    publish_change(branch, "stock", "insert", created.model_dump(mode="json"))
+    return created
+
+@api_router.post("/stock/bulk", response_model=StockBulkImportResult)
+async def create_stock_items_bulk(request: Request, branch: str = Depends(get_branch)):
+    valid, errors = validate_rows(await read_bulk_rows(request), StockItemCreate)
+    if not valid:
+        return StockBulkImportResult(inserted=0, errors=errors, item_numbers=[])
+    
+    first_number = await storage.reserve_stock_numbers(branch, len(valid))
+    docs = []
+    for offset, (_, item) in enumerate(valid):
+        stock_dict = item.model_dump(mode="json")
+        stock_dict["item_number"] = str(first_number + offset)
+        stock_dict["status"] = "current"
+        docs.append(stock_dict)
+    
+    await storage.insert_stock_items(branch, docs)
+    publish_change(branch, "stock", "reload")
+    return StockBulkImportResult(
+        inserted=len(docs),
+        errors=errors,
+        item_numbers=[doc["item_number"] for doc in docs]
+    )
 
 @api_router.get("/stock", response_model=List[StockItem])
-async def get_stock_items(status: str = "current"):
-    items = await db.stock_items.find({"status": status}, {"_id": 0}).to_list(1000)
-    return items
+async def get_stock_items(response: Response, status: str = "current",
+                          limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                          after: Optional[str] = None, stream: bool = False,
+                          date_from: Optional[date] = Query(None, alias="from"),
+                          date_to: Optional[date] = Query(None, alias="to"),
+                          branch: str = Depends(get_branch)):
+    return await list_page(storage.list_stock, storage.stream_stock, StockItem, response, limit, after, stream,
+                           branch=branch, status=status, date_from=iso_date(date_from), date_to=iso_date(date_to))
 
 @api_router.put("/stock/{item_number}/sell")
-async def mark_item_as_sold(item_number: str):
-    result = await db.stock_items.update_one(
-        {"item_number": item_number},
-        {"$set": {"status": "sold"}}
-    )
-    if result.modified_count == 0:
-        raise HTTPException(status_code=404, detail="Stock item not found")
+async def mark_item_as_sold(item_number: str, branch: str = Depends(get_branch)):
+    await claim_stock_item(branch, item_number)
+    publish_change(branch, "stock", "update", {"item_number": item_number, "status": "sold"})
     return {"message": "Item marked as sold"}
 
 @api_router.delete("/stock/{item_number}")
-async def delete_stock_item(item_number: str):
-    result = await db.stock_items.delete_one({"item_number": item_number})
-    if result.deleted_count == 0:
+async def delete_stock_item(item_number: str, branch: str = Depends(get_branch)):
+    if not await storage.delete_stock_item(branch, item_number):
         raise HTTPException(status_code=404, detail="Stock item not found")
+    publish_change(branch, "stock", "delete", {"item_number": item_number})
     return {"message": "Stock item deleted successfully"}
 
 
 # Transaction Routes
 @api_router.post("/transactions", response_model=Transaction)
-async def create_transaction(transaction: TransactionCreate):
-    trans_dict = transaction.model_dump()
+async def create_transaction(transaction: TransactionCreate,
+                             idempotency_key: Optional[str] = Header(None, max_length=128),
+                             branch: str = Depends(get_branch)):
+    trans_dict = transaction.model_dump(mode="json")
+    if idempotency_key:
+        existing = await storage.find_transaction_by_key(branch, idempotency_key)
+        if existing:
+            return existing
+        trans_dict["idempotency_key"] = idempotency_key
     
-    # If it's a sell transaction, mark the stock item as sold
-    if transaction.transaction_type == "sell" and transaction.stock_code:
-        await mark_item_as_sold(transaction.stock_code)
+    # If it's a sell transaction, the stock item is marked as sold with it
+    stock_code = transaction.stock_code if transaction.transaction_type == "sell" else None
+    try:
+        await record_transaction(branch, trans_dict, stock_code)
+    except (DuplicateError, HTTPException) as e:
+        # A concurrent retry with the same key may have recorded it first
+        if idempotency_key:
+            existing = await storage.find_transaction_by_key(branch, idempotency_key)
+            if existing:
+                return existing
+        if isinstance(e, DuplicateError):
+            # Keys are unique across branches
+            raise HTTPException(status_code=409, detail="Idempotency-Key already used in another branch")
+        raise
     
-    await db.transactions.insert_one(trans_dict)
-    return Transaction(**trans_dict)
+    created = Transaction(**trans_dict)
+    publish_change(branch, "transactions", "insert", created.model_dump(mode="json"))
+    if stock_code:
+        publish_change(branch, "stock", "update", {"item_number": stock_code, "status": "sold"})
+    await publish_balance_change(branch)
+    return created
+
+def bulk_row_error(error: StorageError) -> str:
+    if isinstance(error, StockItemAlreadySold):
+        return "Stock item already sold"
+    if isinstance(error, StockItemNotFound):
+        return "Stock item not found"
+    return "Transaction could not be recorded"
+
+@api_router.post("/transactions/bulk", response_model=BulkImportResult)
+async def create_transactions_bulk(request: Request, branch: str = Depends(get_branch)):
+    valid, errors = validate_rows(await read_bulk_rows(request), TransactionCreate)
+    
+    # Backdated rows must be after the last closed period
+    earlier = backdated(t.date.isoformat() for _, t in valid)
+    closed = await storage.closed_through(branch) if earlier else None
+    if closed:
+        for position, transaction in valid:
+            if transaction.date.isoformat() <= closed:
+                errors.append(BulkRowError(row=position, error="Transaction date is in a closed period"))
+        valid = [(position, t) for position, t in valid if t.date.isoformat() > closed]
+    
+    # Sells claim their stock item inside the storage write, as single sells
+    # do; rows whose item is missing or already sold are reported, not inserted
+    items = [(t.model_dump(mode="json"), t.stock_code if t.transaction_type == "sell" and t.stock_code else None)
+             for _, t in valid]
+    try:
+        results = await storage.record_transactions(branch, items)
+    except PeriodClosed:
+        # Closed since the check above
+        raise HTTPException(status_code=409, detail="Transaction date is in a closed period")
+    inserted = []
+    for (position, _), (_, stock_code), error in zip(valid, items, results):
+        if error is None:
+            inserted.append(stock_code)
+        else:
+            errors.append(BulkRowError(row=position, error=bulk_row_error(error)))
+    if inserted:
+        publish_change(branch, "transactions", "reload")
+        if any(inserted):
+            publish_change(branch, "stock", "reload")
+        await publish_balance_change(branch)
+    
+    errors.sort(key=lambda e: e.row)
+    return BulkImportResult(inserted=len(inserted), errors=errors)
 
 @api_router.get("/transactions", response_model=List[Transaction])
-async def get_transactions():
-    transactions = await db.transactions.find({}, {"_id": 0}).to_list(1000)
-    return transactions
+async def get_transactions(response: Response,
+                           limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                           after: Optional[str] = None, stream: bool = False,
+                           date_from: Optional[date] = Query(None, alias="from"),
+                           date_to: Optional[date] = Query(None, alias="to"),
+                           newest_first: bool = False, branch: str = Depends(get_branch)):
+    return await list_page(storage.list_transactions, storage.stream_transactions, Transaction, response,
+                           limit, after, stream, branch=branch, date_from=iso_date(date_from),
+                           date_to=iso_date(date_to), newest_first=newest_first)
 
-@api_router.delete("/transactions/{date}/{name}")
-async def delete_transaction(date: str, name: str):
-    result = await db.transactions.delete_one({"date": date, "name": name})
-    if result.deleted_count == 0:
+async def transaction_deleted(branch: str, delete):
+    try:
+        deleted = await delete
+    except PeriodClosed:
+        raise HTTPException(status_code=409, detail="Transaction date is in a closed period")
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Transaction not found")
+    publish_change(branch, "transactions", "delete", {"id": deleted["id"]})
+    await publish_balance_change(branch)
     return {"message": "Transaction deleted successfully"}
 
+@api_router.delete("/transactions/{transaction_id}")
+async def delete_transaction_by_id(transaction_id: int, branch: str = Depends(get_branch)):
+    return await transaction_deleted(branch, storage.delete_transaction_by_id(branch, transaction_id))
+
+# Deletes the first transaction with this date and name; kept for older clients
+@api_router.delete("/transactions/{date}/{name}")
+async def delete_transaction(date: str, name: str, branch: str = Depends(get_branch)):
+    return await transaction_deleted(branch, storage.delete_transaction(branch, date, name))
+
+
+# Delta sync: everything written after change version `since`. Clients keep
+# the returned version and call again while `more` is true.
+@api_router.get("/sync", response_model=SyncResponse)
+async def sync(since: int = Query(0, ge=0), limit: int = Query(MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+               branch: str = Depends(get_branch)):
+    return await storage.changes_since(branch, since, limit)
+
 
 # Customer/Supplier Routes
+def contacts_loader(branch: str, type: Optional[str]):
+    async def load():
+        return (await storage.list_contacts(branch, type=type)).docs
+    return load
+
 @api_router.post("/customers-suppliers", response_model=CustomerSupplier)
-async def create_customer_supplier(entity: CustomerSupplierCreate):
-    existing = await db.customers_suppliers.find_one({"name": entity.name, "type": entity.type})
-    if existing:
-        raise HTTPException(status_code=400, detail=f"{entity.type.capitalize()} already exists")
-    
+async def create_customer_supplier(entity: CustomerSupplierCreate, branch: str = Depends(get_branch)):
     doc = entity.model_dump()
-    await db.customers_suppliers.insert_one(doc)
+    try:
+        await storage.insert_contact(branch, doc)
+    except DuplicateError:
+        raise HTTPException(status_code=400, detail=f"{entity.type.capitalize()} already exists")
+    reference_cache.invalidate(f"customers_suppliers:{branch}")
+    publish_change(branch, "contacts", "insert", {"name": doc["name"], "type": doc["type"]})
     return CustomerSupplier(**doc)
 
 @api_router.get("/customers-suppliers", response_model=List[CustomerSupplier])
-async def get_customers_suppliers(type: Optional[str] = None):
-    query = {"type": type} if type else {}
-    entities = await db.customers_suppliers.find(query, {"_id": 0}).to_list(1000)
-    return entities
+async def get_customers_suppliers(request: Request, response: Response, type: Optional[str] = None,
+                                  limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+                                  after: Optional[str] = None, stream: bool = False,
+                                  branch: str = Depends(get_branch)):
+    if limit or after or stream:
+        return await list_page(storage.list_contacts, storage.stream_contacts, CustomerSupplier, response,
+                               limit, after, stream, branch=branch, type=type)
+    
+    return await cached_list_response(request, f"customers_suppliers:{branch}", type, contacts_loader(branch, type),
+                                      CustomerSupplier)
 
 @api_router.delete("/customers-suppliers/{name}/{type}")
-async def delete_customer_supplier(name: str, type: str):
-    result = await db.customers_suppliers.delete_one({"name": name, "type": type})
-    if result.deleted_count == 0:
+async def delete_customer_supplier(name: str, type: str, branch: str = Depends(get_branch)):
+    if not await storage.delete_contact(branch, name, type):
         raise HTTPException(status_code=404, detail="Customer/Supplier not found")
+    reference_cache.invalidate(f"customers_suppliers:{branch}")
+    publish_change(branch, "contacts", "delete", {"name": name, "type": type})
     return {"message": "Customer/Supplier deleted successfully"}
 
 
-# Balance Route
-@api_router.get("/balance", response_model=Balance)
-async def get_balance():
-    transactions = await db.transactions.find({}, {"_id": 0}).to_list(10000)
+# Search Route
+# Typeahead over stock descriptions/suppliers and contact names, served from
+# the backend's prefix and text indexes (see storage.base.search_score for
+# the ranking).
+MAX_SEARCH_RESULTS = 50
+
+@api_router.get("/search", response_model=List[SearchResult])
+async def search(q: str = Query(..., min_length=1, max_length=100),
+                 kind: Optional[Literal["stock", "customer", "supplier"]] = None,
+                 limit: int = Query(10, ge=1, le=MAX_SEARCH_RESULTS),
+                 branch: str = Depends(get_branch)):
+    query = normalize_text(q)
+    if not query:
+        return []
+    return await storage.search(branch, query, (kind,) if kind else SEARCH_KINDS, limit)
+
+
+# Balance Routes
+def ledger_balance(ledger: Dict[str, dict]) -> Balance:
+    totals = {method: ledger[method]["balance"] for method in PAYMENT_METHODS}
     
-    cash = 0.0
-    bank1 = 0.0
-    bank2 = 0.0
+    total = sum(totals.values())
+    return Balance(**totals, total=total)
+
+async def branch_balance(branch: str) -> Balance:
+    return ledger_balance(await storage.get_ledger(branch))
+
+# `as_of` (inclusive) is answered from the latest period snapshot up to that
+# day plus the transactions dated after it, see Period Routes
+@api_router.get("/balance", response_model=Balance)
+async def get_balance(as_of: Optional[date] = None, branch: str = Depends(get_branch)):
+    if as_of is not None:
+        return ledger_balance(await storage.balance_as_of(branch, as_of.isoformat()))
+    return await branch_balance(branch)
+
+@api_router.post("/balance/rebuild")
+async def rebuild_balance(branch: str = Depends(get_branch)):
+    totals = await rebuild_balance_ledger(branch)
+    await publish_balance_change(branch)
+    return {"message": "Balance ledger rebuilt", "ledger": totals}
+
+@api_router.get("/balance/verify")
+async def verify_balance(branch: str = Depends(get_branch)):
+    mismatches = await verify_balance_ledger(branch)
+    return {"consistent": not mismatches, "mismatches": mismatches}
+
+
+# Dashboard Route
+# One round-trip for everything the dashboard page shows; the sections are
+# read concurrently from the storage backend. Transactions are the newest
+# `transactions_limit`, newest first: older ones are paged in from
+# /transactions?newest_first=true with the X-Next-Cursor header.
+DASHBOARD_SECTIONS = ("transactions", "balance", "stock", "customers", "suppliers")
+DASHBOARD_TRANSACTIONS = int(os.environ.get('DASHBOARD_TRANSACTIONS', '200'))
+DASHBOARD_LIST_MODELS = {"transactions": Transaction, "stock": StockItem,
+                         "customers": CustomerSupplier, "suppliers": CustomerSupplier}
+
+def encode_dashboard(results: dict) -> bytes:
+    # Sections in DashboardData field order and fields missing from stored
+    # rows left out, like the response_model_exclude_unset output
+    parts = []
+    for section in DASHBOARD_SECTIONS:
+        if section not in results:
+            continue
+        if section in DASHBOARD_LIST_MODELS:
+            body = list_encoder(DASHBOARD_LIST_MODELS[section]).encode(results[section], exclude_unset=True)
+        else:
+            body = encode_json(results[section].model_dump())
+        parts.append(b'"' + section.encode() + b'":' + body)
+    return b"{" + b",".join(parts) + b"}"
+
+async def load_contacts(branch: str, type: str):
+    entry = await cached_list(f"customers_suppliers:{branch}", type, contacts_loader(branch, type), CustomerSupplier)
+    return json.loads(entry.body)
+
+@api_router.get("/dashboard", response_model=DashboardData, response_model_exclude_unset=True)
+async def get_dashboard(response: Response, sections: Optional[str] = None,
+                        transactions_limit: int = Query(DASHBOARD_TRANSACTIONS, ge=1, le=MAX_PAGE_SIZE),
+                        branch: str = Depends(get_branch)):
+    selected = DASHBOARD_SECTIONS
+    if sections:
+        selected = tuple(section.strip() for section in sections.split(",") if section.strip())
+        unknown = [section for section in selected if section not in DASHBOARD_SECTIONS]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Unknown dashboard sections: {', '.join(unknown)}")
     
-    for trans in transactions:
-        amount = trans["amount"]
-        payment_method = trans["payment_method"]
-        trans_type = trans["transaction_type"]
-        
-        # Sell and purchase add to balance, spending subtracts
-        if trans_type in ["sell", "purchase"]:
-            if payment_method == "cash":
-                cash += amount
-            elif payment_method == "bank1":
-                bank1 += amount
-            elif payment_method == "bank2":
-                bank2 += amount
-        elif trans_type == "spending":
-            if payment_method == "cash":
-                cash -= amount
-            elif payment_method == "bank1":
-                bank1 -= amount
-            elif payment_method == "bank2":
-                bank2 -= amount
+    next_cursor = None
+
+    async def load_transactions():
+        nonlocal next_cursor
+        page = await storage.list_transactions(branch, limit=transactions_limit, newest_first=True)
+        next_cursor = page.next_cursor
+        return page.docs
+
+    async def load_stock():
+        return (await storage.list_stock(branch, "current")).docs
+
+    loaders = {
+        "transactions": load_transactions,
+        "balance": lambda: branch_balance(branch),
+        "stock": load_stock,
+        "customers": lambda: load_contacts(branch, "customer"),
+        "suppliers": lambda: load_contacts(branch, "supplier"),
+    }
+    results = dict(zip(selected, await asyncio.gather(*(loaders[section]() for section in selected))))
+    if fast_list_responses:
+        response = Response(encode_dashboard(results), media_type="application/json")
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return response if fast_list_responses else results
+
+
+# Report Routes
+# Built from the daily rollups, grouped by the first PERIOD_LENGTHS[period]
+# characters of the date. /reports/branches is the P&L of every branch from
+# one aggregation over all the rollups. `from`/`to` are validated dates,
+# compared as ISO strings against the rollup days.
+def rollup_amount(totals: dict, trans_type: str, methods=PAYMENT_METHODS) -> float:
+    return sum(totals[trans_type][method]["amount"] for method in methods)
+
+def rollup_count(totals: dict, methods=PAYMENT_METHODS) -> int:
+    return sum(totals[t][method]["count"] for t in TRANSACTION_TYPES for method in methods)
+
+def pnl_fields(row: dict) -> dict:
+    amounts = {t: rollup_amount(row["totals"], t) for t in TRANSACTION_TYPES}
+    # Same convention as the balance: sell and purchase in, spending out
+    income = amounts["sell"] + amounts["purchase"]
+    return dict(period=row["period"], **amounts, income=income, net=income - amounts["spending"],
+                count=rollup_count(row["totals"]))
+
+@api_router.get("/reports/pnl", response_model=List[PnlReportRow])
+async def get_pnl_report(period: Literal["day", "month", "year"] = "month",
+                         date_from: Optional[date] = Query(None, alias="from"),
+                         date_to: Optional[date] = Query(None, alias="to"),
+                         branch: str = Depends(get_branch)):
+    rows = await storage.rollup_totals(branch, PERIOD_LENGTHS[period], iso_date(date_from), iso_date(date_to))
+    return [PnlReportRow(**pnl_fields(row)) for row in rows]
+
+@api_router.get("/reports/branches", response_model=List[BranchPnlReportRow])
+async def get_branch_report(period: Literal["day", "month", "year"] = "month",
+                            date_from: Optional[date] = Query(None, alias="from"),
+                            date_to: Optional[date] = Query(None, alias="to")):
+    rows = await storage.branch_rollup_totals(PERIOD_LENGTHS[period], iso_date(date_from), iso_date(date_to))
+    return [BranchPnlReportRow(branch=row["branch"], **pnl_fields(row)) for row in rows]
+
+@api_router.get("/reports/payment-methods", response_model=List[PaymentMethodReportRow])
+async def get_payment_method_report(date_from: Optional[date] = Query(None, alias="from"),
+                                    date_to: Optional[date] = Query(None, alias="to"),
+                                    branch: str = Depends(get_branch)):
+    grouped = await storage.rollup_totals(branch, None, iso_date(date_from), iso_date(date_to))
+    totals = grouped[0]["totals"] if grouped else None
     
-    total = cash + bank1 + bank2
-    return Balance(cash=cash, bank1=bank1, bank2=bank2, total=total)
+    rows = []
+    for method in PAYMENT_METHODS:
+        amounts = {t: rollup_amount(totals, t, [method]) if totals else 0.0 for t in TRANSACTION_TYPES}
+        rows.append(PaymentMethodReportRow(
+            payment_method=method, **amounts,
+            net=amounts["sell"] + amounts["purchase"] - amounts["spending"],
+            count=rollup_count(totals, [method]) if totals else 0
+        ))
+    return rows
+
+@api_router.get("/reports/spending", response_model=List[SpendingReportRow])
+async def get_spending_report(period: Literal["day", "month", "year"] = "month",
+                              date_from: Optional[date] = Query(None, alias="from"),
+                              date_to: Optional[date] = Query(None, alias="to"),
+                              branch: str = Depends(get_branch)):
+    rows = []
+    grouped = await storage.rollup_totals(branch, PERIOD_LENGTHS[period], iso_date(date_from), iso_date(date_to))
+    for row in grouped:
+        amounts = {method: row["totals"]["spending"][method]["amount"] for method in PAYMENT_METHODS}
+        rows.append(SpendingReportRow(period=row["period"], **amounts, total=sum(amounts.values())))
+    return rows
+
+@api_router.post("/reports/rebuild")
+async def rebuild_reports(branch: str = Depends(get_branch)):
+    days = await rebuild_daily_rollups(branch)
+    return {"message": "Daily rollups rebuilt", "days": days}
+
+
+# Period Routes
+# Closing a month or year that has ended freezes the ledger as of its last
+# day into an immutable snapshot, so historical balances never replay the
+# whole history. Transactions dated in a closed period can no longer be
+# recorded or deleted (409). With `archive`, they move out of the hot
+# transactions collection: lists, exports, sync and margins then only cover
+# open periods, while the balance, rollup reports and snapshots still
+# include them.
+def period_end(period: str) -> str:
+    year, _, month = period.partition("-")
+    if not month:
+        return f"{year}-12-31"
+    return date(int(year), int(month), calendar.monthrange(int(year), int(month))[1]).isoformat()
+
+def snapshot_fields(snapshot: dict) -> dict:
+    return dict(snapshot, total=sum(snapshot["ledger"][method]["balance"] for method in PAYMENT_METHODS))
+
+@api_router.post("/periods/close", response_model=PeriodCloseResult)
+async def close_period(close: PeriodClose, branch: str = Depends(get_branch)):
+    end = period_end(close.period)
+    if end >= utc_today():
+        raise HTTPException(status_code=400, detail="Period has not ended")
+    try:
+        snapshot = await storage.close_period(branch, close.period, end, close.archive)
+    except PeriodClosed:
+        raise HTTPException(status_code=409, detail="Period already closed")
+    if snapshot["archived"]:
+        publish_change(branch, "transactions", "reload")
+    return PeriodCloseResult(**snapshot_fields(snapshot))
+
+@api_router.get("/periods", response_model=List[PeriodSnapshot])
+async def get_periods(branch: str = Depends(get_branch)):
+    return [PeriodSnapshot(**snapshot_fields(snapshot)) for snapshot in await storage.list_snapshots(branch)]
+
+
+# Analytics Routes
+# Margins join each sell to the stock item it sold, and stock aging buckets
+# the current stock by purchase date, both aggregated over the branch's whole
+# history. Responses are cached like the reference data, but versioned by the
+# branch's change counter, which every stock and transaction write bumps: a
+# repeated view costs one counter read, and writes from any worker invalidate
+# it. The TTL bounds how long a write still in flight in another worker can
+# be missed.
+analytics_cache = ReferenceCache(
+    ttl=float(os.environ.get('ANALYTICS_CACHE_TTL', '300')),
+    max_entries=int(os.environ.get('ANALYTICS_CACHE_SIZE', '64'))
+)
+
+MARGIN_GROUP_FIELDS = {"type": "type", "supplier": "supplier_name"}
+# Upper bounds of the stock aging buckets in days; older items go in the last
+AGING_BUCKET_DAYS = (30, 90, 180, 365)
+
+async def cached_analytics_response(request: Request, name: str, branch: str, key, load, model):
+    namespace = f"{name}:{branch}"
+    analytics_cache.observe(namespace, await storage.change_version(branch))
+    return await cached_list_response(request, namespace, key, load, model, analytics_cache)
+
+def margin_fields(row: dict) -> dict:
+    margin = row["revenue"] - row["cost"]
+    return dict(row, margin=margin, margin_pct=margin / row["revenue"] * 100 if row["revenue"] else None)
+
+def aging_bucket_labels() -> List[str]:
+    lower = [0] + [days + 1 for days in AGING_BUCKET_DAYS]
+    return [f"{low}-{high}" for low, high in zip(lower, AGING_BUCKET_DAYS)] + [f"{AGING_BUCKET_DAYS[-1] + 1}+"]
+
+@api_router.get("/analytics/margins", response_model=List[MarginReportRow])
+async def get_margins(request: Request, group_by: Literal["type", "supplier", "day", "month", "year"] = "type",
+                      date_from: Optional[date] = Query(None, alias="from"),
+                      date_to: Optional[date] = Query(None, alias="to"),
+                      branch: str = Depends(get_branch)):
+    if group_by in MARGIN_GROUP_FIELDS:
+        field, period_length = MARGIN_GROUP_FIELDS[group_by], None
+    else:
+        field, period_length = "period", PERIOD_LENGTHS[group_by]
+
+    async def load():
+        rows = await storage.margin_totals(branch, field, period_length, iso_date(date_from), iso_date(date_to))
+        return [margin_fields(row) for row in rows]
+
+    return await cached_analytics_response(request, "margins", branch, (group_by, date_from, date_to), load,
+                                           MarginReportRow)
+
+@api_router.get("/analytics/stock-aging", response_model=List[StockAgingRow])
+async def get_stock_aging(request: Request, branch: str = Depends(get_branch)):
+    # Ages are counted up to today, so the day is part of the cache key
+    today = date.fromisoformat(utc_today())
+    cutoffs = [(today - timedelta(days=days)).isoformat() for days in AGING_BUCKET_DAYS]
+    labels = aging_bucket_labels()
+
+    async def load():
+        rows = {row["bucket"]: row for row in await storage.stock_aging(branch, cutoffs)}
+        return [{"bucket": label, "count": rows[index]["count"] if index in rows else 0,
+                 "value": rows[index]["value"] if index in rows else 0.0}
+                for index, label in enumerate(labels)]
+
+    return await cached_analytics_response(request, "stock_aging", branch, today, load, StockAgingRow)
+
+
+# Export Routes
+# Full exports for accounting. Rows come from the backend's cursor in batches
+# and are written out EXPORT_CHUNK_ROWS at a time: one CSV chunk or one
+# Parquet row group per batch, so memory stays constant however long the
+# history is. Parquet needs pyarrow.
+EXPORT_CHUNK_ROWS = 5000
+
+class ChunkSink:
+    """Write-only file for pyarrow that hands back what was written so far."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+def load_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet export requires pyarrow")
+    return pyarrow
+
+def parquet_schema(pa, model):
+    types = {float: pa.float64(), int: pa.int64(), date: pa.date32()}
+    # Optional[X] is Union[X, None]; its first argument is X
+    return pa.schema([
+        pa.field(name, types.get((get_args(field.annotation) or (field.annotation,))[0], pa.string()),
+                 nullable=not field.is_required())
+        for name, field in model.model_fields.items()
+    ])
+
+async def csv_chunks(docs, model):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=list(model.model_fields), extrasaction="ignore")
+    writer.writeheader()
+    rows = 0
+    async for doc in docs:
+        writer.writerow(doc)
+        rows += 1
+        if rows % EXPORT_CHUNK_ROWS == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+async def parquet_chunks(docs, model, pa):
+    schema = parquet_schema(pa, model)
+    date_fields = [name for name, field in model.model_fields.items() if field.annotation is date]
+    sink = ChunkSink()
+    writer = pa.parquet.ParquetWriter(pa.PythonFile(sink, mode="w"), schema)
+    batch = []
+    async for doc in docs:
+        for name in date_fields:
+            doc[name] = date.fromisoformat(doc[name])
+        batch.append(doc)
+        if len(batch) == EXPORT_CHUNK_ROWS:
+            writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+            batch = []
+            yield sink.drain()
+    if batch:
+        writer.write_batch(pa.RecordBatch.from_pylist(batch, schema=schema))
+    writer.close()
+    yield sink.drain()
+
+def export_response(docs, model, name: str, format: str):
+    if format == "parquet":
+        chunks = parquet_chunks(docs, model, load_pyarrow())
+        media_type = "application/vnd.apache.parquet"
+    else:
+        chunks = csv_chunks(docs, model)
+        media_type = "text/csv; charset=utf-8"
+    headers = {"Content-Disposition": f'attachment; filename="{name}.{format}"'}
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+@api_router.get("/export/transactions")
+async def export_transactions(format: Literal["csv", "parquet"] = "csv",
+                              date_from: Optional[date] = Query(None, alias="from"),
+                              date_to: Optional[date] = Query(None, alias="to"),
+                              transaction_type: Optional[Literal["sell", "purchase", "spending"]] = None,
+                              branch: str = Depends(get_branch)):
+    docs = storage.export_transactions(branch, iso_date(date_from), iso_date(date_to), transaction_type)
+    return export_response(docs, Transaction, "transactions", format)
+
+@api_router.get("/export/stock")
+async def export_stock(format: Literal["csv", "parquet"] = "csv",
+                       status: Optional[Literal["current", "sold"]] = None,
+                       date_from: Optional[date] = Query(None, alias="from"),
+                       date_to: Optional[date] = Query(None, alias="to"),
+                       branch: str = Depends(get_branch)):
+    docs = storage.export_stock(branch, status, iso_date(date_from), iso_date(date_to))
+    return export_response(docs, StockItem, "stock", format)
+
+
+# Change Events Route
+# GET /api/events?branch= is a server-sent event stream of that branch, one
+# event per change:
+#   event: stock|transactions|contacts|balance
+#   data: {"op": "insert"|"update"|"delete"|"reload", "doc": {...}}
+# Inserts carry the full row, updates the key plus changed fields, deletes the
+# key (stock: item_number, transactions: id, contacts: name+type) and
+# balance updates the whole Balance. "reload", or a delete with "doc": null,
+# means refetch that collection. Clients should also refetch when they
+# reconnect, as changes made while disconnected are not replayed.
+# With change stream support (Mongo replica set) every worker forwards the
+# database's changes to its subscribers, so writes from any worker or tool
+# are seen; otherwise routes publish their own writes to this worker only.
+EVENT_COLLECTIONS = ("stock", "transactions", "contacts", "balance")
+EVENT_QUEUE_SIZE = 1000
+EVENT_HEARTBEAT_SECONDS = 15
+EVENT_RETRY_MS = 2000
+
+class EventSubscription:
+    def __init__(self, branch: str):
+        self.branch = branch
+        self.queue: asyncio.Queue = asyncio.Queue(EVENT_QUEUE_SIZE)
+        self.overflowed = False
+
+class EventBus:
+    def __init__(self):
+        self._subscriptions = set()
+        # Set while a change stream feeds the bus; local writes are then
+        # published by the stream instead of the routes
+        self.external = False
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscriptions)
+
+    def subscribe(self, branch: str) -> EventSubscription:
+        subscription = EventSubscription(branch)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: EventSubscription):
+        self._subscriptions.discard(subscription)
+
+    def publish(self, branch: Optional[str], collection: str, op: str, doc: Optional[dict] = None):
+        """Send to the subscribers of `branch`, or to every subscriber when None."""
+        if not self._subscriptions:
+            return
+        message = f"event: {collection}\ndata: ".encode() + encode_json({"op": op, "doc": doc}) + b"\n\n"
+        for subscription in list(self._subscriptions):
+            if branch is not None and subscription.branch != branch:
+                continue
+            try:
+                subscription.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind: end its stream, the client reconnects and refetches
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+event_bus = EventBus()
+
+def publish_change(branch: str, collection: str, op: str, doc: Optional[dict] = None):
+    if not event_bus.external:
+        event_bus.publish(branch, collection, op, doc)
+
+async def publish_balance(branch: str):
+    if event_bus.has_subscribers:
+        event_bus.publish(branch, "balance", "update", (await branch_balance(branch)).model_dump())
+
+async def publish_balance_change(branch: str):
+    if not event_bus.external:
+        await publish_balance(branch)
+
+async def forward_change_stream():
+    delay = 1
+    while True:
+        try:
+            event_bus.external = True
+            async for event in storage.watch():
+                delay = 1
+                if event["collection"] == "balance" and event["branch"] is not None:
+                    await publish_balance(event["branch"])
+                elif event["branch"] is None:
+                    # Deleted without a pre-image: every branch refetches
+                    event_bus.publish(None, event["collection"], "reload")
+                else:
+                    event_bus.publish(event["branch"], event["collection"], event["op"], event["doc"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Change stream interrupted, publishing local changes until it resumes: {e}")
+        # Changes may have been missed while the stream was down
+        event_bus.external = False
+        for collection in EVENT_COLLECTIONS:
+            event_bus.publish(None, collection, "reload")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 30)
+
+async def event_stream(subscription: EventSubscription):
+    try:
+        yield f"retry: {EVENT_RETRY_MS}\n\n".encode()
+        while not (subscription.overflowed and subscription.queue.empty()):
+            try:
+                yield await asyncio.wait_for(subscription.queue.get(), EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield b": heartbeat\n\n"
+    finally:
+        event_bus.unsubscribe(subscription)
+
+@api_router.get("/events")
+async def get_events(branch: str = Depends(get_branch)):
+    return StreamingResponse(event_stream(event_bus.subscribe(branch)), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# Metrics Route
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+
+# Health Routes
+# /health/live only says the process is serving. /health/ready is for the
+# load balancer: it fails until startup has connected and warmed up, once
+# shutdown begins, and whenever a ping to the database fails or takes longer
+# than HEALTH_PING_TIMEOUT_MS.
+health_ping_timeout = float(os.environ.get('HEALTH_PING_TIMEOUT_MS', '2000')) / 1000
+
+async def ping_storage() -> float:
+    """Database round-trip time in milliseconds."""
+    start = time.perf_counter()
+    await asyncio.wait_for(storage.ping(), health_ping_timeout)
+    elapsed = time.perf_counter() - start
+    metrics_registry.observe("storage_ping_seconds", {"storage": storage.name}, elapsed)
+    return elapsed * 1000
+
+@api_router.get("/health/live")
+async def health_live():
+    return {"status": "ok"}
+
+@api_router.get("/health/ready", response_model=HealthStatus)
+async def health_ready():
+    if not getattr(app.state, "ready", False):
+        raise HTTPException(status_code=503, detail="Not ready")
+    try:
+        latency = await ping_storage()
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Database ping timed out")
+    except Exception as e:
+        raise HTTPException(status_code=503, detail=f"Database unreachable: {e}")
+    return HealthStatus(status="ready", storage=storage.name, db_latency_ms=round(latency, 3))
 
 
 # Include the router in the main app
@@ -253,6 +1455,16 @@ app.add_middleware(
     allow_origins=os.environ.get('CORS_ORIGINS', '*').split(','),
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
+)
+
+# Outermost, so the latency includes every other middleware. Set
+# SLOW_REQUEST_MS to log slow requests with the query shapes they ran.
+slow_request_ms = os.environ.get('SLOW_REQUEST_MS')
+app.add_middleware(
+    RequestMetricsMiddleware,
+    registry=metrics_registry,
+    slow_request_ms=float(slow_request_ms) if slow_request_ms else None,
 )
 
 # Configure logging
@@ -262,6 +1474,66 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-@app.on_event("shutdown")
-async def shutdown_db_client():
-    client.close()
\ No newline at end of file
+# Pooled connections opened at startup; MONGO_MIN_POOL_SIZE by default
+warmup_connections = int(os.environ.get('WARMUP_CONNECTIONS', os.environ.get('MONGO_MIN_POOL_SIZE') or '1'))
+
+async def warm_caches():
+    """Load what the first page views read: the branch registry, each
+    branch's reference data and the ledgers."""
+    known_branches.update(await storage.list_branches())
+    for branch in known_branches:
+        await cached_list(f"item_types:{branch}", None, lambda: storage.list_item_types(branch), ItemTypeResponse)
+        for type in ("customer", "supplier"):
+            await load_contacts(branch, type)
+    await storage.branch_ledgers()
+
+async def start_app():
+    # Creates indexes/schema, seeds the stock counter and, on the first start
+    # after upgrading, the balance ledger and daily rollups
+    await storage.connect()
+    logger.info(f"Using {storage.name} storage backend")
+    await storage.warmup(warmup_connections)
+    await warm_caches()
+    logger.info(f"Warmup done: {warmup_connections} connections, database ping {await ping_storage():.1f} ms")
+    transaction_batcher.start()
+    if storage.supports_change_streams:
+        app.state.change_stream = asyncio.create_task(forward_change_stream())
+    app.state.ready = True
+
+async def stop_app():
+    # Fail the readiness probe first so the load balancer drains this worker
+    app.state.ready = False
+    change_stream = getattr(app.state, "change_stream", None)
+    if change_stream is not None:
+        change_stream.cancel()
+        app.state.change_stream = None
+    await transaction_batcher.stop()
+    await storage.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Sales tracker maintenance commands")
+    parser.add_argument("command", choices=["rebuild-balance", "verify-balance", "rebuild-rollups"])
+    parser.add_argument("--branch", help="Branch to run the command on (default: every branch)")
+    args = parser.parse_args()
+
+    async def run(command):
+        """Run `command` per branch and return {branch: result}."""
+        await storage.connect()
+        try:
+            branches = [args.branch] if args.branch else await storage.list_branches()
+            return {branch: await command(branch) for branch in branches}
+        finally:
+            await storage.close()
+
+    if args.command == "rebuild-balance":
+        print(json.dumps(asyncio.run(run(rebuild_balance_ledger)), indent=2))
+    elif args.command == "rebuild-rollups":
+        days = asyncio.run(run(rebuild_daily_rollups))
+        print(json.dumps({branch: {"days": count} for branch, count in days.items()}, indent=2))
+    else:
+        mismatches = {branch: found for branch, found in asyncio.run(run(verify_balance_ledger)).items() if found}
+        print(json.dumps({"consistent": not mismatches, "mismatches": mismatches}, indent=2))
+        raise SystemExit(1 if mismatches else 0)
@@ -0,0 +1,73 @@
+"""Pluggable storage backends, selected with the STORAGE_BACKEND env var:
+
+- ``mongo`` (default): MongoDB through Motor, using MONGO_URL and DB_NAME,
+  with the pool settings in MONGO_CLIENT_OPTIONS
+- ``sqlite``: embedded SQLite file at SQLITE_PATH (WAL mode)
+- ``memory``: SQLite in-memory database, nothing persisted
+"""
+import os
+from pathlib import Path
+
+from .base import (
+    BRANCH_PATTERN, CHANGE_COUNTER, CONTACT_FIELDS, DEFAULT_BRANCH, FIRST_STOCK_NUMBER, ITEM_TYPE_FIELDS,
+    PAYMENT_METHODS, SEARCH_KINDS, STOCK_COUNTER, STOCK_FIELDS, TRANSACTION_FIELDS, TRANSACTION_TYPES,
+    DuplicateError, InvalidCursor, Page, PeriodClosed, Storage, StorageError, StockItemAlreadySold, StockItemNotFound,
+    backdated, normalize_text, utc_today,
+)
+
+STORAGE_BACKENDS = ("mongo", "sqlite", "memory")
+
+# Env var -> MongoClient pool/timeout option; unset ones keep the driver default
+MONGO_CLIENT_OPTIONS = {
+    "MONGO_MAX_POOL_SIZE": "maxPoolSize",
+    "MONGO_MIN_POOL_SIZE": "minPoolSize",
+    "MONGO_MAX_IDLE_TIME_MS": "maxIdleTimeMS",
+    "MONGO_WAIT_QUEUE_TIMEOUT_MS": "waitQueueTimeoutMS",
+    "MONGO_CONNECT_TIMEOUT_MS": "connectTimeoutMS",
+    "MONGO_SOCKET_TIMEOUT_MS": "socketTimeoutMS",
+    "MONGO_SERVER_SELECTION_TIMEOUT_MS": "serverSelectionTimeoutMS",
+}
+
+
+def mongo_client_options() -> dict:
+    return {option: int(os.environ[name]) for name, option in MONGO_CLIENT_OPTIONS.items() if os.environ.get(name)}
+
+
+def batch_write_concern():
+    """Write concern for group-committed batches from WRITE_BATCH_W ("majority"
+    or a node count) and WRITE_BATCH_JOURNAL; None keeps the client default."""
+    from pymongo import WriteConcern
+
+    w = os.environ.get('WRITE_BATCH_W')
+    journal = os.environ.get('WRITE_BATCH_JOURNAL')
+    if w is None and journal is None:
+        return None
+    w = int(w) if w and w.isdigit() else w
+    if w == 0:
+        raise ValueError("WRITE_BATCH_W=0 would acknowledge transactions before they are written")
+    return WriteConcern(
+        w=w,
+        j=journal.lower() in ('1', 'true', 'yes') if journal is not None else None
+    )
+
+
+def create_storage(backend: str = None, event_listeners=None) -> Storage:
+    backend = backend or os.environ.get('STORAGE_BACKEND', 'mongo')
+    if backend == "mongo":
+        from motor.motor_asyncio import AsyncIOMotorClient
+        from .mongo import MongoStorage
+
+        # Connects lazily, on the first command (see Storage.warmup)
+        client = AsyncIOMotorClient(os.environ['MONGO_URL'], event_listeners=event_listeners or [],
+                                    **mongo_client_options())
+        return MongoStorage(client, os.environ['DB_NAME'], batch_write_concern=batch_write_concern())
+    if backend == "sqlite":
+        from .sqlite import SqliteStorage
+
+        default_path = Path(__file__).parent.parent / 'sales_tracker.db'
+        return SqliteStorage(os.environ.get('SQLITE_PATH', str(default_path)))
+    if backend == "memory":
+        from .sqlite import SqliteStorage
+
+        return SqliteStorage(":memory:")
+    raise ValueError(f"Unknown STORAGE_BACKEND {backend!r}, expected one of {', '.join(STORAGE_BACKENDS)}")
@@ -0,0 +1,443 @@
+"""Storage interface shared by every backend.
+
+Route handlers only talk to a `Storage`; each backend owns its schema/indexes,
+the stock counter, the balance ledger and the daily rollups, and keeps them
+consistent with the transactions it records. Dates cross this interface as
+ISO "YYYY-MM-DD" strings; backends store them in their native date type.
+
+Every record belongs to a branch (shop), passed as the first argument of the
+per-branch methods. Each branch has its own counters, ledger and rollups, and
+indexes lead with the branch, so branches never share a hot document or
+index range. Branches are registered with create_branch().
+
+Closing a period freezes the ledger as of its last day into an immutable
+snapshot. Transactions dated on or before the last closed day can no longer
+be recorded or deleted (PeriodClosed), and may be moved to an archive that
+only the ledger, rollups and historical balances still read.
+"""
+import re
+import unicodedata
+from datetime import datetime, timezone
+from typing import AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+PAYMENT_METHODS = ("cash", "bank1", "bank2")
+TRANSACTION_TYPES = ("sell", "purchase", "spending")
+
+# Branch of records written before branches existed
+DEFAULT_BRANCH = "main"
+BRANCH_PATTERN = r"^[a-z0-9][a-z0-9_-]{0,31}$"
+
+FIRST_STOCK_NUMBER = 1000
+STOCK_COUNTER = "stock_counter"
+# Per-branch change version, bumped by every stock/transaction write in the
+# branch. Transactions are never updated, so the version they are inserted
+# with is also their id.
+CHANGE_COUNTER = "change_version"
+
+# Fields returned for each record type, in API order
+ITEM_TYPE_FIELDS = ("name",)
+STOCK_FIELDS = ("item_number", "date_of_purchase", "type", "description", "supplier_name", "phone", "price", "status")
+TRANSACTION_FIELDS = ("id", "date", "transaction_type", "name", "amount", "payment_method", "stock_code")
+CONTACT_FIELDS = ("name", "type")
+
+# Typeahead search
+SEARCH_KINDS = ("stock", "customer", "supplier")
+SEARCH_CANDIDATES = 200
+
+
+class StorageError(Exception):
+    pass
+
+class DuplicateError(StorageError):
+    """A unique key (name, item number, idempotency key...) already exists."""
+
+class StockItemNotFound(StorageError):
+    pass
+
+class StockItemAlreadySold(StorageError):
+    pass
+
+class InvalidCursor(StorageError):
+    pass
+
+class PeriodClosed(StorageError):
+    """The date is on or before the last closed period's end."""
+
+
+class Page(NamedTuple):
+    docs: List[dict]
+    next_cursor: Optional[str]
+
+
+def balance_delta(transaction_type: str, amount: float) -> float:
+    # Sell and purchase add to balance, spending subtracts
+    if transaction_type in ["sell", "purchase"]:
+        return amount
+    if transaction_type == "spending":
+        return -amount
+    return 0.0
+
+def ledger_deltas(transactions: Iterable[dict], sign: int = 1) -> Dict[str, Tuple[float, int]]:
+    """Net (balance, count) change per payment method for a set of transactions."""
+    deltas = {}
+    for trans in transactions:
+        payment_method = trans.get("payment_method")
+        if payment_method not in PAYMENT_METHODS:
+            continue
+        balance, count = deltas.get(payment_method, (0.0, 0))
+        deltas[payment_method] = (
+            balance + sign * balance_delta(trans.get("transaction_type"), trans.get("amount", 0.0)),
+            count + sign
+        )
+    return deltas
+
+def rollup_deltas(transactions: Iterable[dict], sign: int = 1) -> Dict[Tuple[str, str, str], Tuple[float, int]]:
+    """Net (amount, count) change per (date, transaction type, payment method)."""
+    deltas = {}
+    for trans in transactions:
+        trans_type = trans.get("transaction_type")
+        payment_method = trans.get("payment_method")
+        if trans_type not in TRANSACTION_TYPES or payment_method not in PAYMENT_METHODS:
+            continue
+        key = (trans["date"], trans_type, payment_method)
+        amount, count = deltas.get(key, (0.0, 0))
+        deltas[key] = (amount + sign * trans.get("amount", 0.0), count + sign)
+    return deltas
+
+def merge_changes(version: int, transactions: List[dict], stock: List[dict], tombstones: List[dict],
+                  limit: int) -> dict:
+    """The `limit` oldest changes out of each source's `limit` + 1 oldest
+    (transactions by id, stock items and tombstones by version). `version` is
+    where the next sync continues from: the last change returned when there
+    are more, otherwise the sync high-water mark."""
+    changes = sorted(
+        [(doc["id"], "transactions", doc) for doc in transactions] +
+        [(doc.pop("version"), "stock", doc) for doc in stock] +
+        [(doc["version"], "deleted", doc) for doc in tombstones],
+        key=lambda change: change[0]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+    result = {
+        "version": changes[-1][0] if more else version,
+        "more": more,
+        "transactions": [],
+        "stock": [],
+        "deleted": {"transactions": [], "stock": []},
+    }
+    for _, kind, doc in changes:
+        if kind == "deleted":
+            result["deleted"][doc["collection"]].append(doc["key"])
+        else:
+            result[kind].append(doc)
+    return result
+
+def empty_ledger() -> Dict[str, dict]:
+    return {method: {"balance": 0.0, "count": 0} for method in PAYMENT_METHODS}
+
+def add_ledgers(*ledgers: Dict[str, dict]) -> Dict[str, dict]:
+    total = empty_ledger()
+    for ledger in ledgers:
+        for method, values in ledger.items():
+            total[method] = {"balance": total[method]["balance"] + values["balance"],
+                             "count": total[method]["count"] + values["count"]}
+    return total
+
+def utc_today() -> str:
+    return datetime.now(timezone.utc).date().isoformat()
+
+def backdated(dates: Iterable[str]) -> List[str]:
+    """The dates before today. Only periods that have ended can be closed, so
+    writes dated today or later never need the closed period looked up."""
+    today = utc_today()
+    return [value for value in dates if value < today]
+
+def empty_rollup_totals() -> Dict[str, Dict[str, Dict[str, float]]]:
+    return {t: {m: {"amount": 0.0, "count": 0} for m in PAYMENT_METHODS} for t in TRANSACTION_TYPES}
+
+
+# Search helpers
+# Text is normalized to case-folded words without accents, so "Zoë" and
+# "zoe" match. Both backends return candidates from a prefix/text index and
+# rank them the same way with search_score().
+def normalize_text(value: str) -> str:
+    decomposed = unicodedata.normalize("NFKD", value)
+    stripped = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(re.findall(r"\w+", stripped.casefold()))
+
+def text_tokens(*values: str) -> List[str]:
+    return sorted({token for value in values for token in normalize_text(value).split()})
+
+def search_score(query: str, primary: str, others: Iterable[str] = (), relevance: float = 0.0) -> float:
+    """Match tier plus text relevance squashed into [0, 1). Tiers: 3 the
+    primary field equals the query, 2 it starts with it, 1 every query word
+    starts a word of any field, 0 anything else the text index matched (e.g.
+    stemmed plurals). `relevance` only orders text-index-only matches."""
+    primary = normalize_text(primary)
+    words = primary.split() + [word for value in others for word in normalize_text(value).split()]
+    if primary == query:
+        return 3.0
+    if primary.startswith(query):
+        return 2.0
+    if all(any(word.startswith(token) for word in words) for token in query.split()):
+        return 1.0
+    return relevance / (1 + relevance)
+
+def stock_search_result(doc: dict, query: str, relevance: float = 0.0) -> dict:
+    return {
+        "kind": "stock",
+        "name": doc["description"],
+        "item_number": doc["item_number"],
+        "supplier_name": doc["supplier_name"],
+        "score": search_score(query, doc["description"], (doc["supplier_name"],), relevance),
+    }
+
+def contact_search_result(doc: dict, query: str, relevance: float = 0.0) -> dict:
+    return {"kind": doc["type"], "name": doc["name"], "score": search_score(query, doc["name"], relevance=relevance)}
+
+def top_search_results(results: List[dict], limit: int) -> List[dict]:
+    return sorted(results, key=lambda r: (-r["score"], len(r["name"]), r["name"]))[:limit]
+
+
+class Storage:
+    """Backend interface. List methods return a `Page` whose `next_cursor` is
+    set when `limit` rows were returned; `stream_*` methods validate their
+    arguments eagerly and return an async iterator of documents."""
+
+    name = "base"
+    # True when watch() can report writes made by every process
+    supports_change_streams = False
+
+    async def connect(self):
+        """Prepare schema/indexes, seed counters and derived data."""
+        raise NotImplementedError
+
+    async def close(self):
+        raise NotImplementedError
+
+    async def ping(self):
+        """One round trip to the database; raises when it is unreachable."""
+        raise NotImplementedError
+
+    async def warmup(self, connections: int):
+        """Open up to `connections` pooled connections before serving traffic."""
+        raise NotImplementedError
+
+    async def clear(self):
+        """Delete every record and branch except an empty DEFAULT_BRANCH (used
+        by the benchmark harness)."""
+        raise NotImplementedError
+
+    # Branches
+    async def create_branch(self, name: str):
+        """Register a branch and seed its counters; raises DuplicateError."""
+        raise NotImplementedError
+
+    async def list_branches(self) -> List[str]:
+        """Registered branch names, sorted."""
+        raise NotImplementedError
+
+    # Item types
+    async def insert_item_type(self, branch: str, doc: dict):
+        raise NotImplementedError
+
+    async def list_item_types(self, branch: str) -> List[dict]:
+        raise NotImplementedError
+
+    async def delete_item_type(self, branch: str, name: str) -> bool:
+        raise NotImplementedError
+
+    # Customers and suppliers
+    async def insert_contact(self, branch: str, doc: dict):
+        raise NotImplementedError
+
+    async def list_contacts(self, branch: str, type: Optional[str] = None, limit: Optional[int] = None,
+                            after: Optional[str] = None) -> Page:
+        raise NotImplementedError
+
+    def stream_contacts(self, branch: str, type: Optional[str] = None, limit: Optional[int] = None,
+                        after: Optional[str] = None) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def delete_contact(self, branch: str, name: str, type: str) -> bool:
+        raise NotImplementedError
+
+    # Stock
+    async def reserve_stock_numbers(self, branch: str, count: int = 1) -> int:
+        """Atomically reserve `count` consecutive stock numbers and return the first one."""
+        raise NotImplementedError
+
+    async def insert_stock_items(self, branch: str, docs: List[dict]):
+        raise NotImplementedError
+
+    async def list_stock(self, branch: str, status: str, limit: Optional[int] = None, after: Optional[str] = None,
+                         date_from: Optional[str] = None, date_to: Optional[str] = None) -> Page:
+        """Items with `status`, purchased between `date_from` and `date_to` inclusive."""
+        raise NotImplementedError
+
+    def stream_stock(self, branch: str, status: str, limit: Optional[int] = None, after: Optional[str] = None,
+                     date_from: Optional[str] = None, date_to: Optional[str] = None) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def claim_stock_item(self, branch: str, item_number: str):
+        """Mark a current item as sold; raises StockItemNotFound/StockItemAlreadySold."""
+        raise NotImplementedError
+
+    async def delete_stock_item(self, branch: str, item_number: str) -> bool:
+        raise NotImplementedError
+
+    async def search(self, branch: str, query: str, kinds: Iterable[str], limit: int) -> List[dict]:
+        """Top `limit` stock items/contacts matching the normalized `query`,
+        best first (see search_score)."""
+        raise NotImplementedError
+
+    # Transactions
+    async def find_transaction_by_key(self, branch: str, idempotency_key: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    async def record_transaction(self, branch: str, doc: dict, stock_code: Optional[str] = None):
+        """Insert a transaction, claiming `stock_code` and updating the ledger
+        and rollups with it. Sets doc["id"]; the other record_* methods too.
+        Every record_*/delete_* method raises (or, for batches, returns)
+        PeriodClosed for transactions dated in a closed period."""
+        raise NotImplementedError
+
+    async def record_transactions(self, branch: str,
+                                  items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        """Bulk variant: claim each (doc, stock_code) pair's item and insert
+        the docs whose claim succeeded, in one batch. Returns the claim error
+        for each item, None once it is written; raises PeriodClosed for the
+        whole batch."""
+        raise NotImplementedError
+
+    async def record_transaction_batch(self, branch: str,
+                                       items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        """Group commit: record each (doc, stock_code) pair as record_transaction
+        would, but in one write. Items succeed or fail independently; returns
+        the error for each item, None once it is written."""
+        raise NotImplementedError
+
+    async def list_transactions(self, branch: str, limit: Optional[int] = None, after: Optional[str] = None,
+                                date_from: Optional[str] = None, date_to: Optional[str] = None,
+                                newest_first: bool = False) -> Page:
+        """Keyset page in insertion order, or the reverse with `newest_first`
+        (its cursors only continue a newest_first listing)."""
+        raise NotImplementedError
+
+    def stream_transactions(self, branch: str, limit: Optional[int] = None, after: Optional[str] = None,
+                            date_from: Optional[str] = None, date_to: Optional[str] = None,
+                            newest_first: bool = False) -> AsyncIterator[dict]:
+        raise NotImplementedError
+
+    async def delete_transaction(self, branch: str, date: str, name: str) -> Optional[dict]:
+        """Delete one matching transaction, reverse its ledger/rollup effect and return it."""
+        raise NotImplementedError
+
+    async def delete_transaction_by_id(self, branch: str, id: int) -> Optional[dict]:
+        raise NotImplementedError
+
+    # Delta sync
+    async def changes_since(self, branch: str, since: int, limit: int) -> dict:
+        """Transactions and stock items written, and their deletions, after
+        change version `since`, oldest first (see merge_changes). Rows are
+        returned as they are now, so a row changed twice is returned once."""
+        raise NotImplementedError
+
+    # Analytics
+    async def change_version(self, branch: str) -> int:
+        """Change version of the branch's last completed stock/transaction
+        write; cached analytics are valid while it stays the same."""
+        raise NotImplementedError
+
+    async def margin_totals(self, branch: str, group_by: str, period_length: Optional[int] = None,
+                            date_from: Optional[str] = None, date_to: Optional[str] = None) -> List[dict]:
+        """Sell transactions joined to the stock item they sold (stock_code =
+        item_number), grouped by the item's `group_by` field or, for "period",
+        the first `period_length` characters of the sale date. Sells without a
+        matching item are left out. Sorted by key:
+        [{"key", "count", "revenue": sum of amounts, "cost": sum of prices}]"""
+        raise NotImplementedError
+
+    async def stock_aging(self, branch: str, cutoffs: List[str]) -> List[dict]:
+        """Current stock by purchase date: bucket i holds the items bought on
+        or after cutoffs[i] (newest first) and not in an earlier bucket, bucket
+        len(cutoffs) the rest. Non-empty buckets only, sorted:
+        [{"bucket", "count", "value": sum of prices}]"""
+        raise NotImplementedError
+
+    # Period closing
+    async def closed_through(self, branch: str) -> Optional[str]:
+        """End of the last closed period, None before the first close."""
+        raise NotImplementedError
+
+    async def close_period(self, branch: str, period: str, period_end: str, archive: bool = False) -> dict:
+        """Snapshot the ledger of every transaction dated on or before
+        `period_end` and, with `archive`, move those transactions out of the
+        hot collection. Raises PeriodClosed unless `period_end` is after the
+        last closed one. Returns the snapshot: {"period", "period_end",
+        "closed_at", "ledger": {method: {"balance", "count"}}, "archived"}."""
+        raise NotImplementedError
+
+    async def list_snapshots(self, branch: str) -> List[dict]:
+        """Every completed snapshot of the branch, oldest first."""
+        raise NotImplementedError
+
+    async def balance_as_of(self, branch: str, as_of: str) -> Dict[str, dict]:
+        """Ledger of the transactions dated on or before `as_of`: the latest
+        snapshot up to it plus the transactions dated after the snapshot."""
+        raise NotImplementedError
+
+    # Exports
+    def export_transactions(self, branch: str, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                            transaction_type: Optional[str] = None) -> AsyncIterator[dict]:
+        """Every matching transaction ordered by date and name, read in batches."""
+        raise NotImplementedError
+
+    def export_stock(self, branch: str, status: Optional[str] = None, date_from: Optional[str] = None,
+                     date_to: Optional[str] = None) -> AsyncIterator[dict]:
+        """Every matching stock item in insertion order, read in batches."""
+        raise NotImplementedError
+
+    # Change events
+    def watch(self) -> AsyncIterator[dict]:
+        """Changes to stock, transactions, contacts and balances of every
+        branch as they are committed: {"collection": "stock"|"transactions"|
+        "contacts"|"balance", "branch": name or None when unknown, "op":
+        "insert"|"update"|"delete", "doc": API fields or None}. Balance events
+        carry no document."""
+        raise NotImplementedError
+
+    # Balance ledger
+    async def get_ledger(self, branch: str) -> Dict[str, dict]:
+        """Running {"balance", "count"} per payment method."""
+        raise NotImplementedError
+
+    async def branch_ledgers(self) -> Dict[str, Dict[str, dict]]:
+        """get_ledger() of every branch with ledger entries, in one query."""
+        raise NotImplementedError
+
+    async def compute_balances_from_history(self, branch: str) -> Dict[str, dict]:
+        """Ledger recomputed from every transaction, archived ones included."""
+        raise NotImplementedError
+
+    async def rebuild_balances(self, branch: str) -> Dict[str, dict]:
+        raise NotImplementedError
+
+    # Daily rollups
+    async def rebuild_rollups(self, branch: str) -> int:
+        """Recompute the daily rollups from history, archived transactions
+        included; returns the number of days."""
+        raise NotImplementedError
+
+    async def rollup_totals(self, branch: str, period_length: Optional[int], date_from: Optional[str] = None,
+                            date_to: Optional[str] = None) -> List[dict]:
+        """Rollups grouped by the first `period_length` characters of the date
+        (everything in one group when None), sorted by period:
+        [{"period": "2024-01", "totals": {type: {method: {"amount", "count"}}}}]"""
+        raise NotImplementedError
+
+    async def branch_rollup_totals(self, period_length: Optional[int], date_from: Optional[str] = None,
+                                   date_to: Optional[str] = None) -> List[dict]:
+        """rollup_totals() of every branch in one aggregation, sorted by branch
+        then period, with a "branch" key on each row."""
+        raise NotImplementedError
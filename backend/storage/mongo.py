@@ -0,0 +1,1271 @@
+"""MongoDB storage backend (Motor)."""
+import asyncio
+import logging
+import re
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from bson.regex import Regex
+from pymongo import ASCENDING, TEXT, IndexModel, ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+from .base import (
+    CHANGE_COUNTER, CONTACT_FIELDS, DEFAULT_BRANCH, FIRST_STOCK_NUMBER, ITEM_TYPE_FIELDS, PAYMENT_METHODS, SEARCH_CANDIDATES, STOCK_COUNTER,
+    STOCK_FIELDS, TRANSACTION_FIELDS, TRANSACTION_TYPES, DuplicateError, InvalidCursor, Page, Storage,
+    PeriodClosed, StorageError, StockItemAlreadySold, StockItemNotFound, add_ledgers, backdated, contact_search_result,
+    empty_ledger, empty_rollup_totals, ledger_deltas, merge_changes, rollup_deltas, stock_search_result, text_tokens,
+    top_search_results,
+)
+
+logger = logging.getLogger(__name__)
+
+STREAM_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+BACKFILL_BATCH_SIZE = 1000
+ARCHIVE_BATCH_SIZE = 1000
+DATE_FORMAT = "%Y-%m-%d"
+# A reservation older than this is taken to belong to a worker that died
+# mid-write and no longer holds back the sync watermark
+PENDING_VERSION_TIMEOUT = 60
+
+# Indexes
+# Declared per collection and reconciled on startup: missing indexes are
+# created, indexes whose keys/options changed are rebuilt and undeclared ones
+# are dropped. Uniqueness of names and item numbers is enforced here, so the
+# create endpoints insert directly and map DuplicateKeyError to a 400.
+# `search_tokens` holds the normalized words of the searchable fields; the
+# multikey index on it serves anchored prefix regexes for typeahead, and the
+# text index adds stemmed whole-word matches. Every query is scoped to one
+# branch, so indexes lead with `branch` and a branch's reads and writes only
+# touch its own index ranges.
+INDEXES = {
+    "branches": [
+        IndexModel([("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+    "item_types": [
+        IndexModel([("branch", ASCENDING), ("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+    "stock_items": [
+        # Item number first: the margin report's $lookup joins on item_number
+        # alone and filters the branch after
+        IndexModel([("item_number", ASCENDING), ("branch", ASCENDING)], name="item_number_unique", unique=True),
+        IndexModel([("branch", ASCENDING), ("status", ASCENDING), ("_id", ASCENDING)], name="status_id"),
+        IndexModel([("branch", ASCENDING), ("status", ASCENDING), ("date_of_purchase", ASCENDING)],
+                   name="status_date"),
+        IndexModel([("branch", ASCENDING), ("version", ASCENDING)], name="version"),
+        IndexModel([("branch", ASCENDING), ("search_tokens", ASCENDING)], name="search_tokens"),
+        IndexModel([("branch", ASCENDING), ("description", TEXT), ("supplier_name", TEXT)], name="search_text",
+                   weights={"description": 3, "supplier_name": 1}),
+    ],
+    "transactions": [
+        IndexModel([("branch", ASCENDING), ("id", ASCENDING)], name="id_unique", unique=True),
+        IndexModel([("branch", ASCENDING), ("_id", ASCENDING)], name="branch_id"),
+        IndexModel([("branch", ASCENDING), ("date", ASCENDING), ("name", ASCENDING)], name="date_name"),
+        IndexModel([("branch", ASCENDING), ("date", ASCENDING), ("transaction_type", ASCENDING)], name="date_type"),
+        # Not scoped to the branch: with a branch prefix the sparse index would
+        # also hold every transaction without a key, so keys are unique across
+        # branches (clients send random keys)
+        IndexModel([("idempotency_key", ASCENDING)], name="idempotency_key_unique", unique=True, sparse=True),
+    ],
+    "customers_suppliers": [
+        IndexModel([("branch", ASCENDING), ("name", ASCENDING), ("type", ASCENDING)], name="name_type_unique",
+                   unique=True),
+        IndexModel([("branch", ASCENDING), ("type", ASCENDING), ("_id", ASCENDING)], name="type_id"),
+        IndexModel([("branch", ASCENDING), ("search_tokens", ASCENDING)], name="search_tokens"),
+        IndexModel([("branch", ASCENDING), ("name", TEXT)], name="search_text"),
+    ],
+    "counters": [
+        IndexModel([("branch", ASCENDING), ("name", ASCENDING)], name="name_unique", unique=True),
+    ],
+    "balances": [
+        IndexModel([("branch", ASCENDING), ("payment_method", ASCENDING)], name="payment_method_unique",
+                   unique=True),
+    ],
+    "daily_rollups": [
+        IndexModel([("branch", ASCENDING), ("date", ASCENDING)], name="date_unique", unique=True),
+    ],
+    "tombstones": [
+        IndexModel([("branch", ASCENDING), ("version", ASCENDING)], name="version"),
+    ],
+    "period_snapshots": [
+        IndexModel([("branch", ASCENDING), ("period_end", ASCENDING)], name="period_end_unique", unique=True),
+    ],
+    "transactions_archive": [
+        IndexModel([("branch", ASCENDING), ("date", ASCENDING)], name="date"),
+    ],
+    "pending_versions": [
+        IndexModel([("branch", ASCENDING), ("first", ASCENDING)], name="branch_first"),
+        IndexModel([("at", ASCENDING)], name="at_ttl", expireAfterSeconds=PENDING_VERSION_TIMEOUT),
+    ],
+}
+
+COLLECTIONS = ("branches", "item_types", "stock_items", "transactions", "customers_suppliers",
+               "counters", "balances", "daily_rollups", "tombstones", "period_snapshots", "transactions_archive",
+               "pending_versions")
+# Collections whose documents carry a `branch`; the ledger and rollups are
+# derived from transactions and rebuilt instead of migrated
+BRANCH_COLLECTIONS = ("item_types", "stock_items", "transactions", "customers_suppliers", "counters", "tombstones")
+DERIVED_COLLECTIONS = ("balances", "daily_rollups")
+
+
+# Date fields are stored as BSON dates (UTC midnight) and converted from/to
+# "YYYY-MM-DD" strings at this boundary
+DATE_FIELDS = {
+    "stock_items": "date_of_purchase",
+    "transactions": "date",
+}
+
+# Searchable fields per collection, kept in `search_tokens`
+SEARCH_FIELDS = {
+    "stock_items": ("description", "supplier_name"),
+    "customers_suppliers": ("name",),
+}
+
+
+def index_matches(model: IndexModel, existing: dict):
+    spec = model.document
+    if TEXT in spec["key"].values():
+        # Text indexes are reported as _fts/_ftsx keys after any prefix keys;
+        # compare the prefix and the weights
+        declared = spec.get("weights", {})
+        weights = {field: declared.get(field, 1) for field, kind in spec["key"].items() if kind == TEXT}
+        prefix = [(field, kind) for field, kind in spec["key"].items() if kind != TEXT]
+        existing_prefix = [tuple(k) for k in existing["key"] if k[0] not in ("_fts", "_ftsx")]
+        return existing_prefix == prefix and existing.get("weights") == weights
+    return (list(spec["key"].items()) == [tuple(k) for k in existing["key"]]
+            and spec.get("unique", False) == existing.get("unique", False)
+            and spec.get("sparse", False) == existing.get("sparse", False)
+            and spec.get("expireAfterSeconds") == existing.get("expireAfterSeconds"))
+
+def with_search_tokens(collection_name: str, doc: dict) -> dict:
+    return {**doc, "search_tokens": text_tokens(*(doc[field] for field in SEARCH_FIELDS[collection_name]))}
+
+def projection(fields, include_id: bool = False):
+    result = {field: 1 for field in fields}
+    result["_id"] = 1 if include_id else 0
+    return result
+
+def to_bson_date(value: Optional[str]) -> Optional[datetime]:
+    return datetime.strptime(value, DATE_FORMAT) if value else None
+
+def from_bson_date(value):
+    return value.strftime(DATE_FORMAT) if isinstance(value, datetime) else value
+
+def to_stored(collection_name: str, branch: str, doc: dict) -> dict:
+    field = DATE_FIELDS[collection_name]
+    return {**doc, field: to_bson_date(doc[field]), "branch": branch}
+
+def from_stored(collection_name: str, doc: dict) -> dict:
+    field = DATE_FIELDS.get(collection_name)
+    if field and field in doc:
+        doc[field] = from_bson_date(doc[field])
+    return doc
+
+def date_range_query(field: str, date_from, date_to) -> dict:
+    date_range = {}
+    if date_from:
+        date_range["$gte"] = date_from
+    if date_to:
+        date_range["$lte"] = date_to
+    return {field: date_range} if date_range else {}
+
+# Change streams
+# Collection -> (event collection, API fields, key fields). Deletes only carry
+# the document key when pre-images are enabled (MongoDB 6+).
+CHANGE_EVENTS = {
+    "stock_items": ("stock", STOCK_FIELDS, ("item_number",)),
+    "transactions": ("transactions", TRANSACTION_FIELDS, ("id",)),
+    "customers_suppliers": ("contacts", CONTACT_FIELDS, CONTACT_FIELDS),
+    "balances": ("balance", (), ()),
+}
+
+def change_event(change: dict) -> Optional[dict]:
+    collection_name = change["ns"]["coll"]
+    collection, fields, key = CHANGE_EVENTS[collection_name]
+    if change["operationType"] == "delete":
+        before = change.get("fullDocumentBeforeChange")
+        doc = from_stored(collection_name, {field: before[field] for field in key if field in before}) if before else None
+        return {"collection": collection, "branch": before.get("branch") if before else None, "op": "delete",
+                "doc": doc if collection != "balance" else None}
+    after = change.get("fullDocument")
+    if after is None:
+        # Deleted again before the update was looked up; the delete follows
+        return None
+    if collection == "balance":
+        return {"collection": collection, "branch": after.get("branch"), "op": "update", "doc": None}
+    doc = from_stored(collection_name, {field: after[field] for field in fields if field in after})
+    return {"collection": collection, "branch": after.get("branch"),
+            "op": "insert" if change["operationType"] == "insert" else "update", "doc": doc}
+
+def assign_versions(items: List[Tuple[dict, Optional[str]]], first: int) -> List[Optional[int]]:
+    """Hands out the versions reserved from `first`: for a sell, one for
+    claiming its stock item, then the transaction's id. Returns the claim
+    versions."""
+    claim_versions = []
+    version = first
+    for doc, stock_code in items:
+        claim_versions.append(version if stock_code else None)
+        if stock_code:
+            version += 1
+        doc["id"] = version
+        version += 1
+    return claim_versions
+
+def versions_needed(items: List[Tuple[dict, Optional[str]]]) -> int:
+    return sum(2 if stock_code else 1 for _, stock_code in items)
+
+def snapshot_fields(doc: dict) -> dict:
+    return {
+        "period": doc["period"],
+        "period_end": from_bson_date(doc["period_end"]),
+        "closed_at": doc["closed_at"].replace(tzinfo=timezone.utc).isoformat(),
+        "ledger": doc["ledger"],
+    }
+
+def rollup_field(trans_type: str, method: str, field: str) -> str:
+    return f"{trans_type}_{method}_{field}"
+
+
+class MongoStorage(Storage):
+    """Collections: branches, item_types, stock_items, transactions,
+    customers_suppliers, counters (one per branch and name), `balances` (one
+    running-total document per branch and payment method) and `daily_rollups`
+    (one document per branch and date, e.g. {"branch": "main", "date":
+    "2024-01-20", "sell": {"cash": {"amount": 75000.0, "count": 1}}, ...}).
+    `batch_write_concern` applies to group-committed transaction batches;
+    None uses the client's default. Deletions of stock items and transactions
+    leave a document in `tombstones` for delta sync.
+
+    Change versions are reserved with one $inc before the write that uses
+    them, so writes can finish out of version order. Until a write is done its
+    versions are listed in `pending_versions`, shared by every worker on the
+    database, and changes_since() reports nothing past them."""
+
+    name = "mongo"
+
+    def __init__(self, client, db_name: str, batch_write_concern: Optional[WriteConcern] = None):
+        self.client = client
+        self.db = client[db_name]
+        self.batch_write_concern = batch_write_concern
+        self.supports_transactions = False
+        self.supports_text_search = True
+        self.supports_pre_images = False
+        self._last_versions = {}
+
+    async def connect(self):
+        # Migrations run before the indexes are reconciled, as the unique
+        # indexes are keyed on the fields they fill in
+        await self.migrate_branches()
+        await self.migrate_dates()
+        await self.backfill_search_tokens()
+        branches = await self.list_branches()
+        for branch in branches:
+            await self._seed_counters(branch)
+        await self.backfill_versions(branches)
+        await self.ensure_indexes()
+        await self.detect_transaction_support()
+        if self.supports_change_streams:
+            await self.enable_pre_images()
+        # First start after upgrading: seed derived data from existing history
+        for branch in branches:
+            if await self.db.balances.count_documents({"branch": branch}, limit=1) == 0:
+                await self.rebuild_balances(branch)
+                logger.info(f"Balance ledger of branch {branch} seeded from transaction history")
+            if await self.db.daily_rollups.count_documents({"branch": branch}, limit=1) == 0 and \
+                    await self.db.transactions.count_documents({"branch": branch}, limit=1) > 0:
+                days = await self.rebuild_rollups(branch)
+                logger.info(f"Daily rollups of branch {branch} seeded from transaction history ({days} days)")
+
+    async def close(self):
+        self.client.close()
+
+    async def ping(self):
+        await self.client.admin.command("ping")
+
+    async def warmup(self, connections: int):
+        # Concurrent commands each check out a connection, so the pool opens
+        # `connections` of them now instead of during the first requests
+        await asyncio.gather(*(self.ping() for _ in range(max(1, connections))))
+
+    async def clear(self):
+        for name in COLLECTIONS:
+            await self.db[name].delete_many({})
+        await self.db.branches.insert_one({"name": DEFAULT_BRANCH})
+        await self._seed_counters(DEFAULT_BRANCH)
+        self._last_versions.clear()
+
+    async def ensure_indexes(self):
+        for collection_name, models in INDEXES.items():
+            collection = self.db[collection_name]
+            declared = {model.document["name"]: model for model in models}
+            existing = await collection.index_information()
+
+            for name, info in existing.items():
+                if name == "_id_":
+                    continue
+                if name not in declared or not index_matches(declared[name], info):
+                    await collection.drop_index(name)
+                    logger.info(f"Dropped index {collection_name}.{name}")
+
+            for name, model in declared.items():
+                if name in existing and index_matches(model, existing[name]):
+                    continue
+                try:
+                    await collection.create_indexes([model])
+                    logger.info(f"Created index {collection_name}.{name}")
+                except OperationFailure as e:
+                    # e.g. existing duplicates prevent a unique index; keep serving
+                    logger.error(f"Could not create index {collection_name}.{name}: {e}")
+
+    async def migrate_branches(self):
+        # One-off: records written before branches belong to DEFAULT_BRANCH.
+        # The old ledger and rollups are dropped and rebuilt per branch.
+        for collection_name in BRANCH_COLLECTIONS:
+            result = await self.db[collection_name].update_many(
+                {"branch": {"$exists": False}}, {"$set": {"branch": DEFAULT_BRANCH}}
+            )
+            if result.modified_count:
+                logger.info(f"Moved {result.modified_count} {collection_name} documents to branch {DEFAULT_BRANCH}")
+        for collection_name in DERIVED_COLLECTIONS:
+            await self.db[collection_name].delete_many({"branch": {"$exists": False}})
+        await self.db.branches.update_one({"name": DEFAULT_BRANCH}, {"$setOnInsert": {"name": DEFAULT_BRANCH}},
+                                          upsert=True)
+
+    async def migrate_dates(self):
+        # One-off: date strings written before dates were stored natively
+        for collection_name, field in DATE_FIELDS.items():
+            collection = self.db[collection_name]
+            updates, migrated, invalid = [], 0, 0
+            async for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+                try:
+                    value = to_bson_date(doc[field])
+                except ValueError:
+                    invalid += 1
+                    continue
+                updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: value}}))
+                if len(updates) == BACKFILL_BATCH_SIZE:
+                    await collection.bulk_write(updates, ordered=False)
+                    migrated += len(updates)
+                    updates = []
+            if updates:
+                await collection.bulk_write(updates, ordered=False)
+                migrated += len(updates)
+            if migrated:
+                logger.info(f"Migrated {migrated} {collection_name}.{field} values to BSON dates")
+            if invalid:
+                logger.warning(f"{invalid} {collection_name}.{field} values are not YYYY-MM-DD dates, left as strings")
+
+    async def backfill_search_tokens(self):
+        # Documents written before search was added
+        for collection_name in SEARCH_FIELDS:
+            collection = self.db[collection_name]
+            missing = collection.find({"search_tokens": {"$exists": False}}, projection(SEARCH_FIELDS[collection_name],
+                                                                                      include_id=True))
+            updates = []
+            async for doc in missing:
+                tokens = with_search_tokens(collection_name, doc)["search_tokens"]
+                updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"search_tokens": tokens}}))
+                if len(updates) == BACKFILL_BATCH_SIZE:
+                    await collection.bulk_write(updates, ordered=False)
+                    updates = []
+            if updates:
+                await collection.bulk_write(updates, ordered=False)
+
+    async def backfill_versions(self, branches: List[str]):
+        # Documents written before delta sync: transactions get ids and stock
+        # items versions, in insertion order
+        for branch in branches:
+            for collection_name, field in (("transactions", "id"), ("stock_items", "version")):
+                collection = self.db[collection_name]
+                query = {"branch": branch, field: {"$exists": False}}
+                missing = await collection.count_documents(query)
+                if not missing:
+                    continue
+                version = await self._reserve_versions(branch, missing)
+                updates = []
+                async for doc in collection.find(query, {"_id": 1}).sort("_id", 1).limit(missing):
+                    updates.append(UpdateOne({"_id": doc["_id"]}, {"$set": {field: version}}))
+                    version += 1
+                    if len(updates) == BACKFILL_BATCH_SIZE:
+                        await collection.bulk_write(updates, ordered=False)
+                        updates = []
+                if updates:
+                    await collection.bulk_write(updates, ordered=False)
+                logger.info(f"Assigned {collection_name}.{field} to {missing} documents of branch {branch}")
+
+    # Branches
+    async def _seed_counters(self, branch: str):
+        # Seed so that the first $inc hands out FIRST_STOCK_NUMBER
+        for name, value in ((STOCK_COUNTER, FIRST_STOCK_NUMBER - 1), (CHANGE_COUNTER, 0)):
+            await self.db.counters.update_one(
+                {"branch": branch, "name": name}, {"$setOnInsert": {"value": value}}, upsert=True
+            )
+
+    async def create_branch(self, name: str):
+        await self._insert(self.db.branches, {"name": name})
+        await self._seed_counters(name)
+
+    async def list_branches(self) -> List[str]:
+        return [doc["name"] async for doc in self.db.branches.find({}, {"_id": 0, "name": 1}).sort("name", 1)]
+
+    # Change versions
+    async def _reserve_versions(self, branch: str, count: int = 1) -> int:
+        counter = await self.db.counters.find_one_and_update(
+            {"branch": branch, "name": CHANGE_COUNTER},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._last_versions[branch] = max(self._last_versions.get(branch, 0), counter["value"])
+        return counter["value"] - count + 1
+
+    @asynccontextmanager
+    async def _changes(self, branch: str, count: int = 1):
+        """Reserve `count` versions of the branch for a write and keep them
+        pending until it is done. The reservation is listed before the $inc,
+        with the lowest version it can hand out (one past the highest this
+        process has seen), and narrowed to the versions it got after."""
+        pending = await self.db.pending_versions.insert_one({
+            "branch": branch, "first": self._last_versions.get(branch, 0) + 1, "at": datetime.now(timezone.utc)
+        })
+        try:
+            first = await self._reserve_versions(branch, count)
+            await self.db.pending_versions.update_one({"_id": pending.inserted_id}, {"$set": {"first": first}})
+            yield first
+        finally:
+            await self.db.pending_versions.delete_one({"_id": pending.inserted_id})
+
+    async def sync_version(self, branch: str) -> int:
+        """Highest version of the branch below which every write is done. The
+        counter is read before the reservations: a write whose $inc the
+        counter already counts was listed before it."""
+        counter = await self.db.counters.find_one({"branch": branch, "name": CHANGE_COUNTER})
+        version = counter["value"] if counter else 0
+        self._last_versions[branch] = max(self._last_versions.get(branch, 0), version)
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=PENDING_VERSION_TIMEOUT)
+        pending = await self.db.pending_versions.find_one({"branch": branch, "at": {"$gt": cutoff}},
+                                                          sort=[("first", ASCENDING)])
+        if pending:
+            version = min(version, pending["first"] - 1)
+        return version
+
+    async def _tombstone(self, branch: str, collection: str, key, version: int, session=None):
+        await self.db.tombstones.insert_one({"branch": branch, "collection": collection, "key": key,
+                                             "version": version}, session=session)
+
+    async def detect_transaction_support(self):
+        try:
+            hello = await self.client.admin.command("hello")
+            self.supports_transactions = "setName" in hello or hello.get("msg") == "isdbgrid"
+        except Exception as e:
+            logger.warning(f"Could not detect MongoDB topology, using compensating writes: {e}")
+            self.supports_transactions = False
+
+    @property
+    def supports_change_streams(self) -> bool:
+        # Change streams need a replica set or sharded cluster, like transactions
+        return self.supports_transactions
+
+    async def enable_pre_images(self):
+        try:
+            for collection_name, (collection, _, _) in CHANGE_EVENTS.items():
+                if collection != "balance":
+                    await self.db.command("collMod", collection_name, changeStreamPreAndPostImages={"enabled": True})
+            self.supports_pre_images = True
+        except OperationFailure as e:
+            logger.warning(f"Change stream pre-images unavailable, delete events will not carry keys: {e}")
+            self.supports_pre_images = False
+
+    # Keyset pagination over _id
+    def _after(self, query: dict, after: Optional[str], newest_first: bool = False) -> dict:
+        if not after:
+            return query
+        try:
+            return {**query, "_id": {"$lt" if newest_first else "$gt": ObjectId(after)}}
+        except InvalidId:
+            raise InvalidCursor(after)
+
+    async def _page(self, collection, query: dict, fields, limit: Optional[int], after: Optional[str],
+                    hint: Optional[str] = None, newest_first: bool = False) -> Page:
+        cursor = collection.find(self._after(query, after, newest_first), projection(fields, include_id=True))
+        cursor = cursor.sort("_id", -1 if newest_first else 1)
+        if hint:
+            cursor = cursor.hint(hint)
+        if limit:
+            cursor = cursor.limit(limit)
+        docs = await cursor.to_list(limit)
+
+        next_cursor = str(docs[-1]["_id"]) if limit and len(docs) == limit else None
+        for doc in docs:
+            del doc["_id"]
+            from_stored(collection.name, doc)
+        return Page(docs, next_cursor)
+
+    def _stream(self, collection, query: dict, fields, limit: Optional[int], after: Optional[str],
+                hint: Optional[str] = None, newest_first: bool = False):
+        cursor = collection.find(self._after(query, after, newest_first), projection(fields))
+        cursor = cursor.sort("_id", -1 if newest_first else 1)
+        cursor = cursor.batch_size(STREAM_BATCH_SIZE)
+        if hint:
+            cursor = cursor.hint(hint)
+        if limit:
+            cursor = cursor.limit(limit)
+        return self._read(collection.name, cursor)
+
+    async def _read(self, collection_name: str, cursor):
+        async for doc in cursor:
+            yield from_stored(collection_name, doc)
+
+    async def _insert(self, collection, doc: dict):
+        try:
+            await collection.insert_one(dict(doc))
+        except DuplicateKeyError:
+            raise DuplicateError()
+
+    # Item types
+    async def insert_item_type(self, branch: str, doc: dict):
+        await self._insert(self.db.item_types, {**doc, "branch": branch})
+
+    async def list_item_types(self, branch: str) -> List[dict]:
+        return await self.db.item_types.find({"branch": branch}, projection(ITEM_TYPE_FIELDS)).to_list(None)
+
+    async def delete_item_type(self, branch: str, name: str) -> bool:
+        result = await self.db.item_types.delete_one({"branch": branch, "name": name})
+        return result.deleted_count > 0
+
+    # Customers and suppliers
+    async def insert_contact(self, branch: str, doc: dict):
+        await self._insert(self.db.customers_suppliers, {**with_search_tokens("customers_suppliers", doc),
+                                                         "branch": branch})
+
+    def _contact_query(self, branch, type):
+        return {"branch": branch, "type": type} if type else {"branch": branch}
+
+    async def list_contacts(self, branch, type=None, limit=None, after=None) -> Page:
+        return await self._page(self.db.customers_suppliers, self._contact_query(branch, type), CONTACT_FIELDS,
+                                limit, after)
+
+    def stream_contacts(self, branch, type=None, limit=None, after=None):
+        return self._stream(self.db.customers_suppliers, self._contact_query(branch, type), CONTACT_FIELDS,
+                            limit, after)
+
+    async def delete_contact(self, branch: str, name: str, type: str) -> bool:
+        result = await self.db.customers_suppliers.delete_one({"branch": branch, "name": name, "type": type})
+        return result.deleted_count > 0
+
+    # Stock
+    async def reserve_stock_numbers(self, branch: str, count: int = 1) -> int:
+        counter = await self.db.counters.find_one_and_update(
+            {"branch": branch, "name": STOCK_COUNTER},
+            {"$inc": {"value": count}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return counter["value"] - count + 1
+
+    async def insert_stock_items(self, branch: str, docs: List[dict]):
+        async with self._changes(branch, len(docs)) as first:
+            await self.db.stock_items.insert_many([
+                {**to_stored("stock_items", branch, with_search_tokens("stock_items", doc)), "version": first + offset}
+                for offset, doc in enumerate(docs)
+            ], ordered=False)
+
+    # Pages are read in _id order, so the index ending in _id is hinted even
+    # with a date range: it yields documents already sorted and the date is
+    # filtered on the way, where a date index would need a blocking sort
+    def _stock_query(self, branch, status, date_from, date_to):
+        query = date_range_query("date_of_purchase", to_bson_date(date_from), to_bson_date(date_to))
+        query.update(branch=branch, status=status)
+        return query, "status_id"
+
+    async def list_stock(self, branch, status, limit=None, after=None, date_from=None, date_to=None) -> Page:
+        query, hint = self._stock_query(branch, status, date_from, date_to)
+        return await self._page(self.db.stock_items, query, STOCK_FIELDS, limit, after, hint)
+
+    def stream_stock(self, branch, status, limit=None, after=None, date_from=None, date_to=None):
+        query, hint = self._stock_query(branch, status, date_from, date_to)
+        return self._stream(self.db.stock_items, query, STOCK_FIELDS, limit, after, hint)
+
+    async def claim_stock_item(self, branch: str, item_number: str, session=None, version: Optional[int] = None):
+        if version is None:
+            async with self._changes(branch) as version:
+                return await self.claim_stock_item(branch, item_number, session, version)
+        result = await self.db.stock_items.update_one(
+            {"branch": branch, "item_number": item_number, "status": "current"},
+            {"$set": {"status": "sold", "version": version}},
+            session=session
+        )
+        if result.matched_count == 0:
+            if await self.db.stock_items.count_documents({"branch": branch, "item_number": item_number}, limit=1,
+                                                         session=session):
+                raise StockItemAlreadySold(item_number)
+            raise StockItemNotFound(item_number)
+
+    async def release_stock_item(self, branch: str, item_number: str):
+        async with self._changes(branch) as version:
+            await self.db.stock_items.update_one(
+                {"branch": branch, "item_number": item_number, "status": "sold"},
+                {"$set": {"status": "current", "version": version}}
+            )
+
+    async def delete_stock_item(self, branch: str, item_number: str) -> bool:
+        async with self._changes(branch) as version:
+            result = await self.db.stock_items.delete_one({"branch": branch, "item_number": item_number})
+            if result.deleted_count == 0:
+                return False
+            await self._tombstone(branch, "stock", item_number, version)
+        return True
+
+    # Search
+    async def search(self, branch: str, query: str, kinds, limit: int) -> List[dict]:
+        results = []
+        if "stock" in kinds:
+            results += await self._search(self.db.stock_items, {"branch": branch},
+                                          ("item_number", "description", "supplier_name"),
+                                          stock_search_result, query, limit)
+        contact_types = [kind for kind in kinds if kind in ("customer", "supplier")]
+        if contact_types:
+            results += await self._search(self.db.customers_suppliers,
+                                          {"branch": branch, "type": {"$in": contact_types}},
+                                          CONTACT_FIELDS, contact_search_result, query, limit)
+        return top_search_results(results, limit)
+
+    async def _search(self, collection, query_filter: dict, fields, to_result, query: str, limit: int):
+        candidates = {}
+        # Every query word must prefix one of the document's words
+        prefixes = [{"search_tokens": Regex("^" + re.escape(token))} for token in query.split()]
+        cursor = collection.find({**query_filter, "$and": prefixes}, projection(fields, include_id=True))
+        async for doc in cursor.limit(SEARCH_CANDIDATES):
+            candidates[doc["_id"]] = to_result(doc, query)
+
+        if len(candidates) < limit and self.supports_text_search:
+            # Whole stemmed words the prefix index misses, e.g. plurals
+            pipeline = [
+                {"$match": {**query_filter, "$text": {"$search": query}}},
+                {"$sort": {"relevance": {"$meta": "textScore"}}},
+                {"$limit": SEARCH_CANDIDATES},
+                {"$project": {**projection(fields, include_id=True), "relevance": {"$meta": "textScore"}}},
+            ]
+            try:
+                async for doc in collection.aggregate(pipeline):
+                    if doc["_id"] not in candidates:
+                        candidates[doc["_id"]] = to_result(doc, query, doc["relevance"])
+            except (OperationFailure, NotImplementedError) as e:
+                # No text index or a server/stand-in without $text: prefix matches only
+                logger.warning(f"Text search unavailable, using prefix matches only: {e}")
+                self.supports_text_search = False
+        return list(candidates.values())
+
+    # Transactions
+    # A sell claims its stock item with a conditional update that only matches
+    # while the item is still `current`, so two tills can never sell the same
+    # item. On replica sets/sharded clusters the claim, the insert and the
+    # ledger/rollup updates commit as one multi-document transaction; on a
+    # standalone server a failed insert releases the claimed item again.
+    async def find_transaction_by_key(self, branch: str, idempotency_key: str) -> Optional[dict]:
+        doc = await self.db.transactions.find_one({"branch": branch, "idempotency_key": idempotency_key},
+                                                  projection(TRANSACTION_FIELDS))
+        return from_stored("transactions", doc) if doc else None
+
+    async def record_transaction(self, branch: str, doc: dict, stock_code: Optional[str] = None):
+        if await self._closed_dates(branch, [doc["date"]]):
+            raise PeriodClosed(doc["date"])
+        items = [(doc, stock_code)]
+        async with self._changes(branch, versions_needed(items)) as first:
+            claim_version, = assign_versions(items, first)
+            await self._record_transaction(branch, doc, stock_code, claim_version)
+
+    async def _record_transaction(self, branch: str, doc: dict, stock_code: Optional[str],
+                                  claim_version: Optional[int]):
+        stored = to_stored("transactions", branch, doc)
+        if self.supports_transactions:
+            async def write(session):
+                if stock_code:
+                    await self.claim_stock_item(branch, stock_code, session, claim_version)
+                await self.db.transactions.insert_one(stored, session=session)
+                await self.apply_to_ledger(branch, [doc], session=session)
+                await self.apply_to_rollups(branch, [doc], session=session)
+
+            try:
+                async with await self.client.start_session() as session:
+                    await session.with_transaction(write)
+            except DuplicateKeyError:
+                raise DuplicateError()
+            return
+
+        if stock_code:
+            await self.claim_stock_item(branch, stock_code, version=claim_version)
+        try:
+            await self.db.transactions.insert_one(stored)
+        except Exception as e:
+            if stock_code:
+                await self.release_stock_item(branch, stock_code)
+            if isinstance(e, DuplicateKeyError):
+                raise DuplicateError()
+            raise
+        await self.apply_to_ledger(branch, [doc])
+        await self.apply_to_rollups(branch, [doc])
+
+    # Bulk import: like a group-committed batch, but claims are one
+    # bulk_write instead of one update per item (see _claim_stock_items)
+    async def record_transactions(self, branch: str,
+                                  items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        if not items:
+            return []
+        closed = await self._closed_dates(branch, [doc["date"] for doc, _ in items])
+        if closed:
+            raise PeriodClosed(min(closed))
+        async with self._changes(branch, versions_needed(items)) as first:
+            claim_versions = assign_versions(items, first)
+            if self.supports_transactions:
+                async with await self.client.start_session() as session:
+                    return await session.with_transaction(
+                        lambda s: self._record_batch_in_transaction(branch, items, claim_versions, s)
+                    )
+            errors = await self._claim_stock_items(branch, items, claim_versions)
+            return await self._insert_claimed(branch, items, errors)
+
+    async def _claim_stock_items(self, branch, items, claim_versions) -> List[Optional[StorageError]]:
+        """Claims the sells' items with one unordered bulk_write. Its result
+        only counts the matches, so each item's claim is then read back: an
+        item carrying this batch's claim version was claimed for that item."""
+        claims = [(stock_code, version) for (_, stock_code), version in zip(items, claim_versions) if stock_code]
+        if not claims:
+            return [None] * len(items)
+        await self.db.stock_items.bulk_write([
+            UpdateOne({"branch": branch, "item_number": stock_code, "status": "current"},
+                      {"$set": {"status": "sold", "version": version}})
+            for stock_code, version in claims
+        ], ordered=False)
+        cursor = self.db.stock_items.find(
+            {"branch": branch, "item_number": {"$in": [stock_code for stock_code, _ in claims]}},
+            {"_id": 0, "item_number": 1, "version": 1}
+        )
+        versions = {item["item_number"]: item.get("version") async for item in cursor}
+
+        errors = []
+        for (_, stock_code), version in zip(items, claim_versions):
+            if not stock_code or versions.get(stock_code) == version:
+                errors.append(None)
+            elif stock_code in versions:
+                errors.append(StockItemAlreadySold(stock_code))
+            else:
+                errors.append(StockItemNotFound(stock_code))
+        return errors
+
+    # Group commit
+    # With multi-document transactions the whole batch is one transaction:
+    # stock items and idempotency keys are checked with one query each, so
+    # rejected items never reach the insert_many. Without them, claims run
+    # concurrently and insert_many(ordered=False) reports failures per item;
+    # claims of items that failed to insert are released again.
+    async def record_transaction_batch(self, branch: str,
+                                       items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        closed = await self._closed_dates(branch, [doc["date"] for doc, _ in items])
+        if not closed:
+            return await self._record_open_batch(branch, items)
+        open_items = [item for item in items if item[0]["date"] not in closed]
+        results = iter(await self._record_open_batch(branch, open_items) if open_items else [])
+        return [PeriodClosed(doc["date"]) if doc["date"] in closed else next(results) for doc, _ in items]
+
+    async def _record_open_batch(self, branch: str,
+                                 items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        try:
+            async with self._changes(branch, versions_needed(items)) as first:
+                claim_versions = assign_versions(items, first)
+                if not self.supports_transactions:
+                    return await self._record_batch(branch, items, claim_versions)
+                async with await self.client.start_session() as session:
+                    return await session.with_transaction(
+                        lambda s: self._record_batch_in_transaction(branch, items, claim_versions, s),
+                        write_concern=self.batch_write_concern
+                    )
+        except DuplicateKeyError:
+            # A concurrent request took one of the idempotency keys after the
+            # check: record one by one so only that item fails
+            return [await self._record_one(branch, doc, stock_code) for doc, stock_code in items]
+
+    async def _record_one(self, branch: str, doc: dict, stock_code: Optional[str]) -> Optional[StorageError]:
+        try:
+            await self.record_transaction(branch, doc, stock_code)
+        except StorageError as e:
+            return e
+        return None
+
+    async def _record_batch_in_transaction(self, branch, items, claim_versions,
+                                           session) -> List[Optional[StorageError]]:
+        stock_codes = [stock_code for _, stock_code in items if stock_code]
+        keys = [doc["idempotency_key"] for doc, _ in items if doc.get("idempotency_key")]
+        status = {}
+        if stock_codes:
+            cursor = self.db.stock_items.find({"branch": branch, "item_number": {"$in": stock_codes}},
+                                              {"_id": 0, "item_number": 1, "status": 1}, session=session)
+            status = {item["item_number"]: item["status"] async for item in cursor}
+        used_keys = set()
+        if keys:
+            # Keys are unique across branches (see the idempotency_key index)
+            cursor = self.db.transactions.find({"idempotency_key": {"$in": keys}},
+                                               {"_id": 0, "idempotency_key": 1}, session=session)
+            used_keys = {trans["idempotency_key"] async for trans in cursor}
+
+        errors, accepted, sold = [], [], []
+        for (doc, stock_code), claim_version in zip(items, claim_versions):
+            key = doc.get("idempotency_key")
+            if key and key in used_keys:
+                errors.append(DuplicateError())
+                continue
+            if stock_code and stock_code not in status:
+                errors.append(StockItemNotFound(stock_code))
+                continue
+            if stock_code and status[stock_code] != "current":
+                errors.append(StockItemAlreadySold(stock_code))
+                continue
+            if key:
+                used_keys.add(key)
+            if stock_code:
+                status[stock_code] = "sold"
+                sold.append(UpdateOne({"branch": branch, "item_number": stock_code},
+                                      {"$set": {"status": "sold", "version": claim_version}}))
+            errors.append(None)
+            accepted.append(doc)
+
+        if sold:
+            await self.db.stock_items.bulk_write(sold, ordered=False, session=session)
+        if accepted:
+            await self.db.transactions.insert_many([to_stored("transactions", branch, doc) for doc in accepted],
+                                                   session=session)
+            await self.apply_to_ledger(branch, accepted, session=session)
+            await self.apply_to_rollups(branch, accepted, session=session)
+        return errors
+
+    async def _record_batch(self, branch, items, claim_versions) -> List[Optional[StorageError]]:
+        claims = await asyncio.gather(
+            *(self.claim_stock_item(branch, stock_code, version=claim_version)
+              for (_, stock_code), claim_version in zip(items, claim_versions) if stock_code),
+            return_exceptions=True
+        )
+        claims = iter(claims)
+        errors = [next(claims) if stock_code else None for _, stock_code in items]
+        for error in errors:
+            if error is not None and not isinstance(error, StorageError):
+                raise error
+        return await self._insert_claimed(branch, items, errors, self.batch_write_concern)
+
+    async def _insert_claimed(self, branch, items, errors, write_concern=None) -> List[Optional[StorageError]]:
+        """Inserts the items without an error yet; a failed insert releases its claimed item."""
+        accepted = [position for position, error in enumerate(errors) if error is None]
+        if not accepted:
+            return errors
+
+        transactions = self.db.transactions
+        if write_concern is not None:
+            transactions = transactions.with_options(write_concern=write_concern)
+        failed = {}
+        try:
+            await transactions.insert_many(
+                [to_stored("transactions", branch, items[position][0]) for position in accepted], ordered=False
+            )
+        except BulkWriteError as e:
+            for write_error in e.details["writeErrors"]:
+                failed[accepted[write_error["index"]]] = (
+                    DuplicateError() if write_error["code"] == 11000 else StorageError(write_error["errmsg"])
+                )
+        except Exception:
+            # Outcome unknown: treat the whole batch as failed, like record_transaction
+            for position in accepted:
+                if items[position][1]:
+                    await self.release_stock_item(branch, items[position][1])
+            raise
+
+        for position, error in failed.items():
+            errors[position] = error
+            if items[position][1]:
+                await self.release_stock_item(branch, items[position][1])
+        written = [items[position][0] for position in accepted if position not in failed]
+        await self.apply_to_ledger(branch, written)
+        await self.apply_to_rollups(branch, written)
+        return errors
+
+    def _transaction_query(self, branch, date_from, date_to):
+        query = date_range_query("date", to_bson_date(date_from), to_bson_date(date_to))
+        query["branch"] = branch
+        return query, "branch_id"
+
+    async def list_transactions(self, branch, limit=None, after=None, date_from=None, date_to=None,
+                                newest_first=False) -> Page:
+        query, hint = self._transaction_query(branch, date_from, date_to)
+        return await self._page(self.db.transactions, query, TRANSACTION_FIELDS, limit, after, hint, newest_first)
+
+    def stream_transactions(self, branch, limit=None, after=None, date_from=None, date_to=None, newest_first=False):
+        query, hint = self._transaction_query(branch, date_from, date_to)
+        return self._stream(self.db.transactions, query, TRANSACTION_FIELDS, limit, after, hint, newest_first)
+
+    async def delete_transaction(self, branch: str, date: str, name: str) -> Optional[dict]:
+        try:
+            date_value = to_bson_date(date)
+        except ValueError:
+            # Legacy value the migration could not parse
+            date_value = date
+        return await self._delete_transaction(branch, {"date": date_value, "name": name})
+
+    async def delete_transaction_by_id(self, branch: str, id: int) -> Optional[dict]:
+        return await self._delete_transaction(branch, {"id": id})
+
+    async def _delete_transaction(self, branch: str, query: dict) -> Optional[dict]:
+        query = {**query, "branch": branch}
+        closed = await self.closed_through(branch)
+        open_query = {"$and": [query, {"date": {"$gt": to_bson_date(closed)}}]} if closed else query
+        async def delete(version, session=None):
+            deleted = await self.db.transactions.find_one_and_delete(
+                open_query, projection=projection(TRANSACTION_FIELDS), session=session
+            )
+            if deleted is None:
+                return None
+            await self._tombstone(branch, "transactions", deleted.get("id"), version, session=session)
+            from_stored("transactions", deleted)
+            await self.apply_to_ledger(branch, [deleted], sign=-1, session=session)
+            await self.apply_to_rollups(branch, [deleted], sign=-1, session=session)
+            return deleted
+
+        # On replica sets the delete, its tombstone and the ledger/rollup
+        # updates commit together; on a standalone server they run in turn
+        async with self._changes(branch) as version:
+            if self.supports_transactions:
+                async with await self.client.start_session() as session:
+                    deleted = await session.with_transaction(lambda s: delete(version, s))
+            else:
+                deleted = await delete(version)
+        if deleted is None and closed and await self.db.transactions.count_documents(query, limit=1):
+            raise PeriodClosed(closed)
+        return deleted
+
+    # Delta sync
+    async def changes_since(self, branch: str, since: int, limit: int) -> dict:
+        version = await self.sync_version(branch)
+        transactions = await self.db.transactions.find(
+            {"branch": branch, "id": {"$gt": since, "$lte": version}}, projection(TRANSACTION_FIELDS)
+        ).sort("id", 1).limit(limit + 1).to_list(None)
+        stock = await self.db.stock_items.find(
+            {"branch": branch, "version": {"$gt": since, "$lte": version}}, projection(STOCK_FIELDS + ("version",))
+        ).sort("version", 1).limit(limit + 1).to_list(None)
+        tombstones = await self.db.tombstones.find(
+            {"branch": branch, "version": {"$gt": since, "$lte": version}}, {"_id": 0, "branch": 0}
+        ).sort("version", 1).limit(limit + 1).to_list(None)
+        return merge_changes(
+            version,
+            [from_stored("transactions", doc) for doc in transactions],
+            [from_stored("stock_items", doc) for doc in stock],
+            tombstones,
+            limit
+        )
+
+    # Analytics
+    async def change_version(self, branch: str) -> int:
+        return await self.sync_version(branch)
+
+    async def margin_totals(self, branch, group_by, period_length=None, date_from=None, date_to=None) -> List[dict]:
+        query = date_range_query("date", to_bson_date(date_from), to_bson_date(date_to))
+        query.update({"branch": branch, "transaction_type": "sell", "stock_code": {"$nin": [None, ""]}})
+        if group_by == "period":
+            key = {"$substr": [{"$dateToString": {"format": DATE_FORMAT, "date": "$date"}}, 0, period_length]}
+        else:
+            key = f"$item.{group_by}"
+        # Item numbers repeat across branches, so the join (served by the
+        # item_number_unique index) can return one item per branch
+        pipeline = [
+            {"$match": query},
+            {"$lookup": {"from": "stock_items", "localField": "stock_code", "foreignField": "item_number",
+                         "as": "item"}},
+            {"$unwind": "$item"},
+            {"$match": {"item.branch": branch}},
+            {"$group": {"_id": key, "count": {"$sum": 1}, "revenue": {"$sum": "$amount"},
+                        "cost": {"$sum": "$item.price"}}},
+            {"$sort": {"_id": 1}},
+        ]
+        return [{"key": row["_id"], "count": row["count"], "revenue": float(row["revenue"]),
+                 "cost": float(row["cost"])}
+                async for row in self.db.transactions.aggregate(pipeline)]
+
+    async def stock_aging(self, branch: str, cutoffs: List[str]) -> List[dict]:
+        bucket = {"$switch": {
+            "branches": [{"case": {"$gte": ["$date_of_purchase", to_bson_date(cutoff)]}, "then": index}
+                         for index, cutoff in enumerate(cutoffs)],
+            "default": len(cutoffs),
+        }}
+        pipeline = [
+            {"$match": {"branch": branch, "status": "current"}},
+            {"$group": {"_id": bucket, "count": {"$sum": 1}, "value": {"$sum": "$price"}}},
+            {"$sort": {"_id": 1}},
+        ]
+        return [{"bucket": row["_id"], "count": row["count"], "value": float(row["value"])}
+                async for row in self.db.stock_items.aggregate(pipeline)]
+
+    # Period closing
+    # A close first inserts the snapshot without its ledger, as a marker: the
+    # unique (branch, period_end) index turns a concurrent close of the same
+    # period into PeriodClosed, and writes into the period are refused from
+    # then on. Only then is the ledger summed and filled in, so every write
+    # that got past the check and landed before the marker is in it.
+    # What remains: writes check the closed period before they write, not
+    # inside the same (multi-document) transaction, so a write that passed
+    # its check just before the marker went in and is inserted after the
+    # ledger was summed is left out of the snapshot. The window is one
+    # write's check-to-insert latency. A close interrupted before the ledger
+    # is filled leaves the period closed without a snapshot; balance_as_of
+    # then starts from the previous one. Archived transactions move in
+    # batches, each one multi-document transaction when the deployment has
+    # them; a batch interrupted without one is finished by the next close.
+    async def closed_through(self, branch: str) -> Optional[str]:
+        doc = await self.db.period_snapshots.find_one({"branch": branch}, {"_id": 0, "period_end": 1},
+                                                      sort=[("period_end", -1)])
+        return from_bson_date(doc["period_end"]) if doc else None
+
+    async def _closed_dates(self, branch: str, dates: Iterable[str]) -> Set[str]:
+        """The `dates` on or before the last closed period's end."""
+        earlier = backdated(dates)
+        closed = await self.closed_through(branch) if earlier else None
+        return {value for value in earlier if closed and value <= closed}
+
+    async def close_period(self, branch: str, period: str, period_end: str, archive: bool = False) -> dict:
+        closed = await self.closed_through(branch)
+        if closed and period_end <= closed:
+            raise PeriodClosed(closed)
+        snapshot = {
+            "branch": branch,
+            "period": period,
+            "period_end": to_bson_date(period_end),
+            "closed_at": datetime.now(timezone.utc).replace(microsecond=0),
+            "ledger": None,
+        }
+        try:
+            await self.db.period_snapshots.insert_one(snapshot)
+        except DuplicateKeyError:
+            raise PeriodClosed(period_end)
+        snapshot["ledger"] = await self.balance_as_of(branch, period_end)
+        await self.db.period_snapshots.update_one({"_id": snapshot["_id"]}, {"$set": {"ledger": snapshot["ledger"]}})
+        archived = await self._archive_through(branch, period_end) if archive else 0
+        if archived:
+            # Archived rows leave the lists, so cached analytics must go too
+            await self._reserve_versions(branch)
+        return {**snapshot_fields(snapshot), "archived": archived}
+
+    async def _archive_through(self, branch: str, period_end: str) -> int:
+        query = {"branch": branch, "date": {"$lte": to_bson_date(period_end)}}
+        moved = 0
+        while True:
+            docs = await self.db.transactions.find(query).limit(ARCHIVE_BATCH_SIZE).to_list(None)
+            if not docs:
+                return moved
+            if self.supports_transactions:
+                async with await self.client.start_session() as session:
+                    await session.with_transaction(lambda s: self._move_to_archive(docs, s))
+            else:
+                await self._move_to_archive(docs)
+            moved += len(docs)
+
+    async def _move_to_archive(self, docs: List[dict], session=None):
+        try:
+            await self.db.transactions_archive.insert_many(docs, ordered=False, session=session)
+        except BulkWriteError as e:
+            # Copied by an interrupted earlier run
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+        await self.db.transactions.delete_many({"_id": {"$in": [doc["_id"] for doc in docs]}}, session=session)
+
+    async def list_snapshots(self, branch: str) -> List[dict]:
+        cursor = self.db.period_snapshots.find({"branch": branch, "ledger": {"$ne": None}}).sort("period_end", 1)
+        return [snapshot_fields(doc) async for doc in cursor]
+
+    async def balance_as_of(self, branch: str, as_of: str) -> Dict[str, dict]:
+        as_of = to_bson_date(as_of)
+        snapshot = await self.db.period_snapshots.find_one(
+            {"branch": branch, "period_end": {"$lte": as_of}, "ledger": {"$ne": None}}, sort=[("period_end", -1)]
+        )
+        tail = {"$lte": as_of}
+        if snapshot:
+            tail["$gt"] = snapshot["period_end"]
+        query = {"branch": branch, "date": tail}
+        return add_ledgers(
+            snapshot["ledger"] if snapshot else {},
+            await self._ledger_totals(self.db.transactions, query),
+            await self._ledger_totals(self.db.transactions_archive, query)
+        )
+
+    # Exports
+    # Sorted on the date_name and status_id indexes, so the server streams
+    # the result in batches without a blocking in-memory sort.
+    def export_transactions(self, branch, date_from=None, date_to=None, transaction_type=None):
+        query = date_range_query("date", to_bson_date(date_from), to_bson_date(date_to))
+        query["branch"] = branch
+        if transaction_type:
+            query["transaction_type"] = transaction_type
+        cursor = self.db.transactions.find(query, projection(TRANSACTION_FIELDS))
+        return self._read("transactions", cursor.sort([("date", 1), ("name", 1)]).batch_size(EXPORT_BATCH_SIZE))
+
+    def export_stock(self, branch, status=None, date_from=None, date_to=None):
+        query = date_range_query("date_of_purchase", to_bson_date(date_from), to_bson_date(date_to))
+        query["branch"] = branch
+        if status:
+            query["status"] = status
+        cursor = self.db.stock_items.find(query, projection(STOCK_FIELDS))
+        return self._read("stock_items", cursor.sort("_id", 1).batch_size(EXPORT_BATCH_SIZE))
+
+    # Change events
+    async def watch(self):
+        pipeline = [{"$match": {
+            "ns.coll": {"$in": list(CHANGE_EVENTS)},
+            "operationType": {"$in": ["insert", "update", "replace", "delete"]},
+        }}]
+        options = {"full_document": "updateLookup"}
+        if self.supports_pre_images:
+            options["full_document_before_change"] = "whenAvailable"
+        async with self.db.watch(pipeline, **options) as stream:
+            async for change in stream:
+                event = change_event(change)
+                if event is not None:
+                    yield event
+
+    # Balance ledger
+    async def apply_to_ledger(self, branch: str, transactions: List[dict], sign: int = 1, session=None):
+        deltas = ledger_deltas(transactions, sign)
+        if len(deltas) == 1:
+            (method, (balance, count)), = deltas.items()
+            await self.db.balances.update_one(
+                {"branch": branch, "payment_method": method}, {"$inc": {"balance": balance, "count": count}},
+                upsert=True, session=session
+            )
+        elif deltas:
+            await self.db.balances.bulk_write([
+                UpdateOne({"branch": branch, "payment_method": method},
+                          {"$inc": {"balance": balance, "count": count}}, upsert=True)
+                for method, (balance, count) in deltas.items()
+            ], ordered=False, session=session)
+
+    async def get_ledger(self, branch: str) -> Dict[str, dict]:
+        ledger = {method: {"balance": 0.0, "count": 0} for method in PAYMENT_METHODS}
+        async for doc in self.db.balances.find({"branch": branch, "payment_method": {"$in": list(PAYMENT_METHODS)}}):
+            ledger[doc["payment_method"]] = {"balance": doc["balance"], "count": doc["count"]}
+        return ledger
+
+    async def branch_ledgers(self) -> Dict[str, Dict[str, dict]]:
+        ledgers = {}
+        async for doc in self.db.balances.find({"payment_method": {"$in": list(PAYMENT_METHODS)}}):
+            ledger = ledgers.setdefault(doc["branch"], {method: {"balance": 0.0, "count": 0}
+                                                        for method in PAYMENT_METHODS})
+            ledger[doc["payment_method"]] = {"balance": doc["balance"], "count": doc["count"]}
+        return ledgers
+
+    async def compute_balances_from_history(self, branch: str) -> Dict[str, dict]:
+        return add_ledgers(await self._ledger_totals(self.db.transactions, {"branch": branch}),
+                           await self._ledger_totals(self.db.transactions_archive, {"branch": branch}))
+
+    async def _ledger_totals(self, collection, query: dict) -> Dict[str, dict]:
+        pipeline = [
+            {"$match": {**query, "payment_method": {"$in": list(PAYMENT_METHODS)}}},
+            {"$group": {
+                "_id": "$payment_method",
+                "balance": {"$sum": {"$switch": {
+                    "branches": [
+                        {"case": {"$in": ["$transaction_type", ["sell", "purchase"]]}, "then": "$amount"},
+                        {"case": {"$eq": ["$transaction_type", "spending"]}, "then": {"$multiply": ["$amount", -1]}},
+                    ],
+                    "default": 0,
+                }}},
+                "count": {"$sum": 1},
+            }},
+        ]
+        totals = empty_ledger()
+        async for row in collection.aggregate(pipeline):
+            totals[row["_id"]] = {"balance": float(row["balance"]), "count": row["count"]}
+        return totals
+
+    async def rebuild_balances(self, branch: str) -> Dict[str, dict]:
+        totals = await self.compute_balances_from_history(branch)
+        for method, values in totals.items():
+            key = {"branch": branch, "payment_method": method}
+            await self.db.balances.replace_one(key, {**key, **values}, upsert=True)
+        return totals
+
+    # Daily rollups
+    async def apply_to_rollups(self, branch: str, transactions: List[dict], sign: int = 1, session=None):
+        per_day = {}
+        for (date, trans_type, method), (amount, count) in rollup_deltas(transactions, sign).items():
+            inc = per_day.setdefault(date, {})
+            inc[f"{trans_type}.{method}.amount"] = amount
+            inc[f"{trans_type}.{method}.count"] = count
+        if per_day:
+            await self.db.daily_rollups.bulk_write([
+                UpdateOne({"branch": branch, "date": date}, {"$inc": inc}, upsert=True)
+                for date, inc in per_day.items()
+            ], ordered=False, session=session)
+
+    async def rebuild_rollups(self, branch: str) -> int:
+        pipeline = [
+            {"$match": {
+                "branch": branch,
+                "date": {"$type": "date"},
+                "transaction_type": {"$in": list(TRANSACTION_TYPES)},
+                "payment_method": {"$in": list(PAYMENT_METHODS)},
+            }},
+            {"$group": {
+                "_id": {
+                    "date": {"$dateToString": {"format": DATE_FORMAT, "date": "$date"}},
+                    "type": "$transaction_type",
+                    "method": "$payment_method",
+                },
+                "amount": {"$sum": "$amount"},
+                "count": {"$sum": 1},
+            }},
+        ]
+        docs = {}
+        for collection in (self.db.transactions, self.db.transactions_archive):
+            async for row in collection.aggregate(pipeline):
+                key = row["_id"]
+                doc = docs.setdefault(key["date"], {"branch": branch, "date": key["date"]})
+                totals = doc.setdefault(key["type"], {}).setdefault(key["method"], {"amount": 0.0, "count": 0})
+                totals["amount"] += float(row["amount"])
+                totals["count"] += row["count"]
+
+        await self.db.daily_rollups.delete_many({"branch": branch})
+        if docs:
+            await self.db.daily_rollups.insert_many(list(docs.values()))
+        return len(docs)
+
+    async def rollup_totals(self, branch, period_length, date_from=None, date_to=None) -> List[dict]:
+        query = {**date_range_query("date", date_from, date_to), "branch": branch}
+        return await self._rollup_totals(query, period_length, by_branch=False)
+
+    async def branch_rollup_totals(self, period_length, date_from=None, date_to=None) -> List[dict]:
+        return await self._rollup_totals(date_range_query("date", date_from, date_to), period_length, by_branch=True)
+
+    async def _rollup_totals(self, query: dict, period_length, by_branch: bool) -> List[dict]:
+        # Periods use $substr on the ASCII date key (also supported by mongomock)
+        period = {"$substr": ["$date", 0, period_length]} if period_length else None
+        group = {"_id": {"branch": "$branch", "period": period} if by_branch else period}
+        for trans_type in TRANSACTION_TYPES:
+            for method in PAYMENT_METHODS:
+                for field in ("amount", "count"):
+                    group[rollup_field(trans_type, method, field)] = {
+                        "$sum": {"$ifNull": [f"${trans_type}.{method}.{field}", 0]}
+                    }
+        pipeline = [
+            {"$match": query},
+            {"$group": group},
+            {"$sort": {"_id.branch": 1, "_id.period": 1} if by_branch else {"_id": 1}},
+        ]
+
+        rows = []
+        async for row in self.db.daily_rollups.aggregate(pipeline):
+            totals = empty_rollup_totals()
+            for trans_type in TRANSACTION_TYPES:
+                for method in PAYMENT_METHODS:
+                    for field in ("amount", "count"):
+                        totals[trans_type][method][field] = row[rollup_field(trans_type, method, field)]
+            if by_branch:
+                rows.append({"branch": row["_id"]["branch"], "period": row["_id"]["period"], "totals": totals})
+            else:
+                rows.append({"period": row["_id"], "totals": totals})
+        return rows
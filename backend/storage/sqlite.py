@@ -0,0 +1,904 @@
+"""Embedded SQLite storage backend.
+
+Meant for single-shop installs: no external service, and reads are served
+straight from the local database file. Dates are stored as ISO-8601 TEXT,
+SQLite's own date representation, so range filters are plain comparisons.
+Statements run synchronously on the event loop thread, which keeps every
+operation atomic with respect to other requests; each write runs in one
+SQLite transaction and bulk writes go through executemany. File databases use
+WAL mode so readers never wait on the writer. The same class backs the
+in-memory store with path ":memory:".
+
+Every table has a `branch` column that leads its keys and indexes; databases
+from before branches are rebuilt into the new tables on connect, with their
+rows in DEFAULT_BRANCH.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from .base import (
+    CHANGE_COUNTER, CONTACT_FIELDS, DEFAULT_BRANCH, FIRST_STOCK_NUMBER, ITEM_TYPE_FIELDS, PAYMENT_METHODS,
+    SEARCH_CANDIDATES, STOCK_COUNTER, STOCK_FIELDS, TRANSACTION_FIELDS, TRANSACTION_TYPES, DuplicateError, InvalidCursor, Page, Storage,
+    PeriodClosed, StorageError, StockItemAlreadySold, StockItemNotFound, add_ledgers, backdated, contact_search_result,
+    empty_ledger, empty_rollup_totals, ledger_deltas, merge_changes, rollup_deltas, stock_search_result,
+    top_search_results,
+)
+
+logger = logging.getLogger(__name__)
+
+STREAM_BATCH_SIZE = 500
+EXPORT_BATCH_SIZE = 1000
+
+# Transactions keep their API id in `id`, unique per branch, and page by
+# the `seq` row id
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS branches (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS item_types (
+    id INTEGER PRIMARY KEY,
+    branch TEXT NOT NULL,
+    name TEXT NOT NULL,
+    UNIQUE (branch, name)
+);
+CREATE TABLE IF NOT EXISTS stock_items (
+    id INTEGER PRIMARY KEY,
+    branch TEXT NOT NULL,
+    item_number TEXT NOT NULL,
+    date_of_purchase TEXT NOT NULL,
+    type TEXT NOT NULL,
+    description TEXT NOT NULL,
+    supplier_name TEXT NOT NULL,
+    phone TEXT NOT NULL,
+    price REAL NOT NULL,
+    status TEXT NOT NULL DEFAULT 'current',
+    version INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (branch, item_number)
+);
+CREATE INDEX IF NOT EXISTS stock_items_status_id ON stock_items (branch, status, id);
+CREATE INDEX IF NOT EXISTS stock_items_status_date ON stock_items (branch, status, date_of_purchase);
+CREATE INDEX IF NOT EXISTS stock_items_version ON stock_items (branch, version);
+CREATE TABLE IF NOT EXISTS transactions (
+    seq INTEGER PRIMARY KEY,
+    branch TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    amount REAL NOT NULL,
+    payment_method TEXT NOT NULL,
+    stock_code TEXT,
+    idempotency_key TEXT UNIQUE,
+    UNIQUE (branch, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_branch_seq ON transactions (branch, seq);
+CREATE INDEX IF NOT EXISTS transactions_date_name ON transactions (branch, date, name);
+CREATE INDEX IF NOT EXISTS transactions_date_type ON transactions (branch, date, transaction_type);
+CREATE TABLE IF NOT EXISTS customers_suppliers (
+    id INTEGER PRIMARY KEY,
+    branch TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT NOT NULL,
+    UNIQUE (branch, name, type)
+);
+CREATE INDEX IF NOT EXISTS customers_suppliers_type_id ON customers_suppliers (branch, type, id);
+CREATE TABLE IF NOT EXISTS counters (
+    branch TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value INTEGER NOT NULL,
+    PRIMARY KEY (branch, name)
+);
+CREATE TABLE IF NOT EXISTS balances (
+    branch TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    balance REAL NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (branch, payment_method)
+);
+CREATE TABLE IF NOT EXISTS daily_rollups (
+    branch TEXT NOT NULL,
+    date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    payment_method TEXT NOT NULL,
+    amount REAL NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (branch, date, transaction_type, payment_method)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tombstones (
+    branch TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    collection TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (branch, version)
+);
+CREATE TABLE IF NOT EXISTS period_snapshots (
+    branch TEXT NOT NULL,
+    period_end TEXT NOT NULL,
+    period TEXT NOT NULL,
+    closed_at TEXT NOT NULL,
+    ledger TEXT NOT NULL,
+    PRIMARY KEY (branch, period_end)
+);
+CREATE TABLE IF NOT EXISTS transactions_archive (
+    branch TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    transaction_type TEXT NOT NULL,
+    name TEXT NOT NULL,
+    amount REAL NOT NULL,
+    payment_method TEXT NOT NULL,
+    stock_code TEXT,
+    PRIMARY KEY (branch, id)
+);
+CREATE INDEX IF NOT EXISTS transactions_archive_date ON transactions_archive (branch, date);
+"""
+
+# Typeahead search: FTS5 indexes over the searchable columns, kept in sync by
+# triggers. unicode61 with remove_diacritics folds case and accents like
+# normalize_text(), and the prefix option adds 2/3-character prefix indexes
+# so "ab"* / "abc"* queries do not scan the whole term list.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE stock_search USING fts5(
+    description, supplier_name, content='stock_items', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER stock_search_insert AFTER INSERT ON stock_items BEGIN
+    INSERT INTO stock_search (rowid, description, supplier_name)
+    VALUES (new.id, new.description, new.supplier_name);
+END;
+CREATE TRIGGER stock_search_delete AFTER DELETE ON stock_items BEGIN
+    INSERT INTO stock_search (stock_search, rowid, description, supplier_name)
+    VALUES ('delete', old.id, old.description, old.supplier_name);
+END;
+CREATE TRIGGER stock_search_update AFTER UPDATE OF description, supplier_name ON stock_items BEGIN
+    INSERT INTO stock_search (stock_search, rowid, description, supplier_name)
+    VALUES ('delete', old.id, old.description, old.supplier_name);
+    INSERT INTO stock_search (rowid, description, supplier_name)
+    VALUES (new.id, new.description, new.supplier_name);
+END;
+CREATE VIRTUAL TABLE contact_search USING fts5(
+    name, content='customers_suppliers', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER contact_search_insert AFTER INSERT ON customers_suppliers BEGIN
+    INSERT INTO contact_search (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER contact_search_delete AFTER DELETE ON customers_suppliers BEGIN
+    INSERT INTO contact_search (contact_search, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+CREATE TRIGGER contact_search_update AFTER UPDATE OF name ON customers_suppliers BEGIN
+    INSERT INTO contact_search (contact_search, rowid, name) VALUES ('delete', old.id, old.name);
+    INSERT INTO contact_search (rowid, name) VALUES (new.id, new.name);
+END;
+"""
+
+TABLES = ("branches", "item_types", "stock_items", "transactions", "customers_suppliers",
+          "counters", "balances", "daily_rollups", "tombstones", "period_snapshots", "transactions_archive")
+# Derived from transactions: rebuilt rather than copied when migrating
+DERIVED_TABLES = ("balances", "daily_rollups")
+
+
+def columns(fields) -> str:
+    return ", ".join(fields)
+
+def placeholders(fields) -> str:
+    return ", ".join(f":{field}" for field in fields)
+
+def date_range_filter(column: str, date_from: Optional[str], date_to: Optional[str]):
+    where, params = [], []
+    if date_from:
+        where.append(f"{column} >= ?")
+        params.append(date_from)
+    if date_to:
+        where.append(f"{column} <= ?")
+        params.append(date_to)
+    return where, params
+
+
+class SqliteStorage(Storage):
+    name = "sqlite"
+
+    def __init__(self, path: str):
+        self.path = path
+        self.conn: Optional[sqlite3.Connection] = None
+
+    async def connect(self):
+        if self.conn is not None:
+            return
+        # isolation_level=None: transactions are opened explicitly in _write()
+        self.conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.migrate_branches()
+        self.conn.executescript(SCHEMA)
+        if not self._scalar("SELECT 1 FROM sqlite_master WHERE name = 'stock_search'"):
+            # New database or one created before search: index existing rows
+            self.conn.executescript(SEARCH_SCHEMA)
+            with self._write():
+                self.conn.execute("INSERT INTO stock_search (stock_search) VALUES ('rebuild')")
+                self.conn.execute("INSERT INTO contact_search (contact_search) VALUES ('rebuild')")
+
+        with self._write():
+            self.conn.execute("INSERT OR IGNORE INTO branches (name) VALUES (?)", (DEFAULT_BRANCH,))
+            branches = [row[0] for row in self.conn.execute("SELECT name FROM branches")]
+            for branch in branches:
+                self._seed_counters(branch)
+        self.migrate_versions(branches)
+        for branch in branches:
+            if not self._scalar("SELECT 1 FROM balances WHERE branch = ?", (branch,)):
+                await self.rebuild_balances(branch)
+            if not self._scalar("SELECT 1 FROM daily_rollups WHERE branch = ?", (branch,)) and \
+                    self._scalar("SELECT 1 FROM transactions WHERE branch = ?", (branch,)):
+                days = await self.rebuild_rollups(branch)
+                logger.info(f"Daily rollups of branch {branch} seeded from transaction history ({days} days)")
+
+    async def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    async def ping(self):
+        self._scalar("SELECT 1")
+
+    async def warmup(self, connections: int):
+        # A single connection, opened by connect()
+        await self.ping()
+
+    async def clear(self):
+        with self._write():
+            for table in TABLES:
+                self.conn.execute(f"DELETE FROM {table}")
+            self.conn.execute("INSERT INTO branches (name) VALUES (?)", (DEFAULT_BRANCH,))
+            self._seed_counters(DEFAULT_BRANCH)
+
+    def _columns(self, table: str) -> List[str]:
+        return [row["name"] for row in self.conn.execute(f"PRAGMA table_info({table})")]
+
+    def migrate_branches(self):
+        # One-off: tables from before branches are renamed aside, recreated
+        # from SCHEMA and refilled as DEFAULT_BRANCH, keeping row ids so list
+        # cursors stay valid. The search tables are dropped and rebuilt by
+        # connect(); the ledger and rollups are rebuilt from history.
+        legacy = [table for table in TABLES
+                  if table != "branches" and self._columns(table) and "branch" not in self._columns(table)]
+        if not legacy:
+            return
+        with self._write():
+            for table in legacy:
+                for kind, name in self.conn.execute(
+                        "SELECT type, name FROM sqlite_master WHERE tbl_name = ? AND type IN ('index', 'trigger') "
+                        "AND sql IS NOT NULL", (table,)).fetchall():
+                    self.conn.execute(f"DROP {kind.upper()} {name}")
+            self.conn.execute("DROP TABLE IF EXISTS stock_search")
+            self.conn.execute("DROP TABLE IF EXISTS contact_search")
+            for table in legacy:
+                self.conn.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+            # executescript() would commit; SCHEMA has no triggers, so its
+            # statements split on ";"
+            for statement in SCHEMA.split(";"):
+                self.conn.execute(statement)
+            for table in legacy:
+                if table not in DERIVED_TABLES:
+                    old_columns = self._columns(f"{table}_legacy")
+                    common = [column for column in self._columns(table) if column in old_columns]
+                    # Transaction ids were the row ids
+                    targets = ["seq"] + common if table == "transactions" else common
+                    sources = ["id"] + common if table == "transactions" else common
+                    self.conn.execute(
+                        f"INSERT INTO {table} (branch, {columns(targets)}) "
+                        f"SELECT ?, {columns(sources)} FROM {table}_legacy ORDER BY rowid", (DEFAULT_BRANCH,)
+                    )
+                self.conn.execute(f"DROP TABLE {table}_legacy")
+        logger.info(f"Moved {', '.join(legacy)} to branch {DEFAULT_BRANCH}")
+
+    def migrate_versions(self, branches: List[str]):
+        # Stock items written before delta sync get versions in insertion
+        # order; older transactions keep their row id, which is below the
+        # change counter's starting point
+        with self._write():
+            for branch in branches:
+                ids = [row[0] for row in self.conn.execute(
+                    "SELECT id FROM stock_items WHERE branch = ? AND version = 0 ORDER BY id", (branch,))]
+                if ids:
+                    first = self._next_versions(branch, len(ids))
+                    self.conn.executemany("UPDATE stock_items SET version = ? WHERE id = ?",
+                                          [(first + offset, id) for offset, id in enumerate(ids)])
+                    logger.info(f"Assigned stock_items.version to {len(ids)} rows of branch {branch}")
+
+    def _seed_counters(self, branch: str):
+        self.conn.execute("INSERT OR IGNORE INTO counters (branch, name, value) VALUES (?, ?, ?)",
+                          (branch, STOCK_COUNTER, FIRST_STOCK_NUMBER - 1))
+        # Transaction ids come from the change counter; start it past the
+        # ids already handed out as row ids
+        self.conn.execute("INSERT OR IGNORE INTO counters (branch, name, value) "
+                          "SELECT ?, ?, COALESCE(MAX(id), 0) FROM transactions WHERE branch = ?",
+                          (branch, CHANGE_COUNTER, branch))
+
+    def _next_versions(self, branch: str, count: int = 1) -> int:
+        """Reserve `count` change versions inside the current write and return the first."""
+        value = self._scalar("UPDATE counters SET value = value + ? WHERE branch = ? AND name = ? RETURNING value",
+                             (count, branch, CHANGE_COUNTER))
+        return value - count + 1
+
+    def _tombstone(self, branch: str, collection: str, key, version: int):
+        self.conn.execute("INSERT INTO tombstones (branch, version, collection, key) VALUES (?, ?, ?, ?)",
+                          (branch, version, collection, str(key)))
+
+    def _write(self):
+        return _Transaction(self.conn)
+
+    def _scalar(self, sql: str, params=()):
+        rows = self.conn.execute(sql, params).fetchall()
+        return rows[0][0] if rows else None
+
+    def _rows(self, sql: str, params=()) -> List[dict]:
+        return [dict(row) for row in self.conn.execute(sql, params)]
+
+    # Keyset pagination over the integer row id
+    def _after(self, after: Optional[str]) -> int:
+        if not after:
+            return 0
+        try:
+            return int(after)
+        except ValueError:
+            raise InvalidCursor(after)
+
+    def _select(self, table: str, fields, where: str, params: list, after_id: int, limit: Optional[int],
+                newest_first: bool = False):
+        sql = f"SELECT rowid AS row_id, {columns(fields)} FROM {table} WHERE {where}"
+        if newest_first:
+            if after_id:
+                sql += " AND rowid < ?"
+                params = params + [after_id]
+            sql += " ORDER BY rowid DESC"
+        else:
+            sql += " AND rowid > ? ORDER BY rowid"
+            params = params + [after_id]
+        if limit:
+            sql += " LIMIT ?"
+            params.append(limit)
+        return self._rows(sql, params)
+
+    def _page(self, table: str, fields, where: str, params: list, limit, after, newest_first=False) -> Page:
+        docs = self._select(table, fields, where, params, self._after(after), limit, newest_first)
+        next_cursor = str(docs[-1]["row_id"]) if limit and len(docs) == limit else None
+        for doc in docs:
+            del doc["row_id"]
+        return Page(docs, next_cursor)
+
+    def _stream(self, table: str, fields, where: str, params: list, limit, after, newest_first=False):
+        after_id = self._after(after)
+
+        async def iterate():
+            last_id, remaining = after_id, limit
+            while remaining is None or remaining > 0:
+                batch = STREAM_BATCH_SIZE if remaining is None else min(STREAM_BATCH_SIZE, remaining)
+                docs = self._select(table, fields, where, list(params), last_id, batch, newest_first)
+                for doc in docs:
+                    last_id = doc.pop("row_id")
+                    yield doc
+                if len(docs) < batch:
+                    return
+                if remaining is not None:
+                    remaining -= len(docs)
+                # Let other requests run between batches
+                await asyncio.sleep(0)
+
+        return iterate()
+
+    def _export(self, table: str, fields, where: List[str], params: list, order=()):
+        """Keyset scan over (*order, rowid); `order` columns must be in `fields`."""
+        keys = tuple(order) + ("rowid",)
+        sql = (f"SELECT rowid AS row_id, {columns(fields)} FROM {table} WHERE {' AND '.join(where)} "
+               "{keyset} ORDER BY " + ", ".join(keys) + " LIMIT ?")
+
+        async def iterate():
+            last = None
+            while True:
+                if last is None:
+                    docs = self._rows(sql.format(keyset=""), params + [EXPORT_BATCH_SIZE])
+                else:
+                    keyset = f"AND ({', '.join(keys)}) > ({', '.join('?' * len(keys))})"
+                    docs = self._rows(sql.format(keyset=keyset), params + last + [EXPORT_BATCH_SIZE])
+                for doc in docs:
+                    last = [doc[key] for key in order] + [doc.pop("row_id")]
+                    yield doc
+                if len(docs) < EXPORT_BATCH_SIZE:
+                    return
+                await asyncio.sleep(0)
+
+        return iterate()
+
+    def _insert(self, table: str, fields, branch: str, doc: dict):
+        fields = ("branch",) + tuple(fields)
+        try:
+            with self._write():
+                self.conn.execute(f"INSERT INTO {table} ({columns(fields)}) VALUES ({placeholders(fields)})",
+                                  {**doc, "branch": branch})
+        except sqlite3.IntegrityError:
+            raise DuplicateError()
+
+    # Branches
+    async def create_branch(self, name: str):
+        try:
+            with self._write():
+                self.conn.execute("INSERT INTO branches (name) VALUES (?)", (name,))
+                self._seed_counters(name)
+        except sqlite3.IntegrityError:
+            raise DuplicateError()
+
+    async def list_branches(self) -> List[str]:
+        return [row[0] for row in self.conn.execute("SELECT name FROM branches ORDER BY name")]
+
+    # Item types
+    async def insert_item_type(self, branch: str, doc: dict):
+        self._insert("item_types", ITEM_TYPE_FIELDS, branch, doc)
+
+    async def list_item_types(self, branch: str) -> List[dict]:
+        return self._rows(f"SELECT {columns(ITEM_TYPE_FIELDS)} FROM item_types WHERE branch = ? ORDER BY id",
+                          (branch,))
+
+    async def delete_item_type(self, branch: str, name: str) -> bool:
+        with self._write():
+            return self.conn.execute("DELETE FROM item_types WHERE branch = ? AND name = ?",
+                                     (branch, name)).rowcount > 0
+
+    # Customers and suppliers
+    def _contact_filter(self, branch: str, type: Optional[str]):
+        return ("branch = ? AND type = ?", [branch, type]) if type else ("branch = ?", [branch])
+
+    async def insert_contact(self, branch: str, doc: dict):
+        self._insert("customers_suppliers", CONTACT_FIELDS, branch, doc)
+
+    async def list_contacts(self, branch, type=None, limit=None, after=None) -> Page:
+        where, params = self._contact_filter(branch, type)
+        return self._page("customers_suppliers", CONTACT_FIELDS, where, params, limit, after)
+
+    def stream_contacts(self, branch, type=None, limit=None, after=None):
+        where, params = self._contact_filter(branch, type)
+        return self._stream("customers_suppliers", CONTACT_FIELDS, where, params, limit, after)
+
+    async def delete_contact(self, branch: str, name: str, type: str) -> bool:
+        with self._write():
+            return self.conn.execute("DELETE FROM customers_suppliers WHERE branch = ? AND name = ? AND type = ?",
+                                     (branch, name, type)).rowcount > 0
+
+    # Stock
+    async def reserve_stock_numbers(self, branch: str, count: int = 1) -> int:
+        with self._write():
+            value = self._scalar("UPDATE counters SET value = value + ? WHERE branch = ? AND name = ? RETURNING value",
+                                 (count, branch, STOCK_COUNTER))
+        return value - count + 1
+
+    async def insert_stock_items(self, branch: str, docs: List[dict]):
+        fields = ("branch",) + STOCK_FIELDS + ("version",)
+        with self._write():
+            first = self._next_versions(branch, len(docs))
+            self.conn.executemany(
+                f"INSERT INTO stock_items ({columns(fields)}) VALUES ({placeholders(fields)})",
+                [{**doc, "branch": branch, "version": first + offset} for offset, doc in enumerate(docs)]
+            )
+
+    def _stock_filter(self, branch, status, date_from, date_to):
+        where, params = date_range_filter("date_of_purchase", date_from, date_to)
+        return " AND ".join(["branch = ?", "status = ?"] + where), [branch, status] + params
+
+    async def list_stock(self, branch, status, limit=None, after=None, date_from=None, date_to=None) -> Page:
+        where, params = self._stock_filter(branch, status, date_from, date_to)
+        return self._page("stock_items", STOCK_FIELDS, where, params, limit, after)
+
+    def stream_stock(self, branch, status, limit=None, after=None, date_from=None, date_to=None):
+        where, params = self._stock_filter(branch, status, date_from, date_to)
+        return self._stream("stock_items", STOCK_FIELDS, where, params, limit, after)
+
+    def _claim(self, branch: str, item_number: str):
+        updated = self.conn.execute(
+            "UPDATE stock_items SET status = 'sold', version = ? "
+            "WHERE branch = ? AND item_number = ? AND status = 'current'",
+            (self._next_versions(branch), branch, item_number)
+        ).rowcount
+        if updated == 0:
+            if self._scalar("SELECT 1 FROM stock_items WHERE branch = ? AND item_number = ?", (branch, item_number)):
+                raise StockItemAlreadySold(item_number)
+            raise StockItemNotFound(item_number)
+
+    async def claim_stock_item(self, branch: str, item_number: str):
+        with self._write():
+            self._claim(branch, item_number)
+
+    async def delete_stock_item(self, branch: str, item_number: str) -> bool:
+        with self._write():
+            if self.conn.execute("DELETE FROM stock_items WHERE branch = ? AND item_number = ?",
+                                 (branch, item_number)).rowcount == 0:
+                return False
+            self._tombstone(branch, "stock", item_number, self._next_versions(branch))
+        return True
+
+    # Search
+    async def search(self, branch: str, query: str, kinds, limit: int) -> List[dict]:
+        # Every word as a quoted prefix term, e.g. "dell"* "mon"*
+        match = " ".join(f'"{token}"*' for token in query.split())
+        results = []
+        if "stock" in kinds:
+            rows = self.conn.execute(
+                "SELECT s.item_number, s.description, s.supplier_name, -bm25(stock_search, 3.0, 1.0) "
+                "FROM stock_search JOIN stock_items s ON s.id = stock_search.rowid "
+                "WHERE stock_search MATCH ? AND s.branch = ? ORDER BY bm25(stock_search, 3.0, 1.0) LIMIT ?",
+                (match, branch, SEARCH_CANDIDATES)
+            )
+            results += [stock_search_result(dict(row), query, row[3]) for row in rows]
+        contact_types = [kind for kind in kinds if kind in ("customer", "supplier")]
+        if contact_types:
+            rows = self.conn.execute(
+                "SELECT c.name, c.type, -bm25(contact_search) FROM contact_search "
+                "JOIN customers_suppliers c ON c.id = contact_search.rowid "
+                f"WHERE contact_search MATCH ? AND c.branch = ? AND c.type IN ({', '.join('?' * len(contact_types))}) "
+                "ORDER BY bm25(contact_search) LIMIT ?",
+                [match, branch] + contact_types + [SEARCH_CANDIDATES]
+            )
+            results += [contact_search_result(dict(row), query, row[2]) for row in rows]
+        return top_search_results(results, limit)
+
+    # Transactions
+    def _insert_transactions(self, branch: str, docs: List[dict]):
+        self._check_open(branch, [doc["date"] for doc in docs])
+        fields = ("branch",) + TRANSACTION_FIELDS + ("idempotency_key",)
+        first = self._next_versions(branch, len(docs))
+        for offset, doc in enumerate(docs):
+            doc["id"] = first + offset
+        self.conn.executemany(
+            f"INSERT INTO transactions ({columns(fields)}) VALUES ({placeholders(fields)})",
+            [{"stock_code": None, "idempotency_key": None, **doc, "branch": branch} for doc in docs]
+        )
+        self._apply_to_ledger(branch, docs)
+        self._apply_to_rollups(branch, docs)
+
+    async def find_transaction_by_key(self, branch: str, idempotency_key: str) -> Optional[dict]:
+        rows = self._rows(f"SELECT {columns(TRANSACTION_FIELDS)} FROM transactions "
+                          "WHERE branch = ? AND idempotency_key = ?", (branch, idempotency_key))
+        return rows[0] if rows else None
+
+    async def record_transaction(self, branch: str, doc: dict, stock_code: Optional[str] = None):
+        try:
+            with self._write():
+                if stock_code:
+                    self._claim(branch, stock_code)
+                self._insert_transactions(branch, [doc])
+        except sqlite3.IntegrityError:
+            raise DuplicateError()
+
+    async def record_transactions(self, branch: str,
+                                  items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        errors, accepted = [], []
+        with self._write():
+            for doc, stock_code in items:
+                if stock_code:
+                    try:
+                        self._claim(branch, stock_code)
+                    except StorageError as e:
+                        errors.append(e)
+                        continue
+                errors.append(None)
+                accepted.append(doc)
+            if accepted:
+                self._insert_transactions(branch, accepted)
+        return errors
+
+    # Group commit: one BEGIN IMMEDIATE ... COMMIT (one WAL sync) for the
+    # batch, with a savepoint per item so a failed item is rolled back alone
+    async def record_transaction_batch(self, branch: str,
+                                       items: List[Tuple[dict, Optional[str]]]) -> List[Optional[StorageError]]:
+        errors = []
+        with self._write():
+            for doc, stock_code in items:
+                self.conn.execute("SAVEPOINT batch_item")
+                try:
+                    if stock_code:
+                        self._claim(branch, stock_code)
+                    self._insert_transactions(branch, [doc])
+                    errors.append(None)
+                except (StorageError, sqlite3.IntegrityError) as e:
+                    self.conn.execute("ROLLBACK TO batch_item")
+                    errors.append(DuplicateError() if isinstance(e, sqlite3.IntegrityError) else e)
+                self.conn.execute("RELEASE batch_item")
+        return errors
+
+    def _transaction_filter(self, branch, date_from, date_to):
+        where, params = date_range_filter("date", date_from, date_to)
+        return " AND ".join(["branch = ?"] + where), [branch] + params
+
+    async def list_transactions(self, branch, limit=None, after=None, date_from=None, date_to=None,
+                                newest_first=False) -> Page:
+        where, params = self._transaction_filter(branch, date_from, date_to)
+        return self._page("transactions", TRANSACTION_FIELDS, where, params, limit, after, newest_first)
+
+    def stream_transactions(self, branch, limit=None, after=None, date_from=None, date_to=None, newest_first=False):
+        where, params = self._transaction_filter(branch, date_from, date_to)
+        return self._stream("transactions", TRANSACTION_FIELDS, where, params, limit, after, newest_first)
+
+    def _delete_transaction(self, branch: str, where: str, params) -> Optional[dict]:
+        with self._write():
+            rows = self._rows(
+                f"SELECT seq, {columns(TRANSACTION_FIELDS)} FROM transactions WHERE branch = ? AND {where} "
+                "ORDER BY seq LIMIT 1", (branch,) + params
+            )
+            if not rows:
+                return None
+            deleted = rows[0]
+            self._check_open(branch, [deleted["date"]])
+            self.conn.execute("DELETE FROM transactions WHERE seq = ?", (deleted.pop("seq"),))
+            self._tombstone(branch, "transactions", deleted["id"], self._next_versions(branch))
+            self._apply_to_ledger(branch, [deleted], sign=-1)
+            self._apply_to_rollups(branch, [deleted], sign=-1)
+        return deleted
+
+    async def delete_transaction(self, branch: str, date: str, name: str) -> Optional[dict]:
+        return self._delete_transaction(branch, "date = ? AND name = ?", (date, name))
+
+    async def delete_transaction_by_id(self, branch: str, id: int) -> Optional[dict]:
+        return self._delete_transaction(branch, "id = ?", (id,))
+
+    # Delta sync: transaction ids and stock versions share the branch's
+    # change counter, so one watermark covers inserts, updates and tombstones
+    async def changes_since(self, branch: str, since: int, limit: int) -> dict:
+        version = self._scalar("SELECT value FROM counters WHERE branch = ? AND name = ?",
+                               (branch, CHANGE_COUNTER)) or 0
+        bounds = (branch, since, version, limit + 1)
+        transactions = self._rows(
+            f"SELECT {columns(TRANSACTION_FIELDS)} FROM transactions "
+            "WHERE branch = ? AND id > ? AND id <= ? ORDER BY id LIMIT ?", bounds
+        )
+        stock = self._rows(
+            f"SELECT {columns(STOCK_FIELDS + ('version',))} FROM stock_items "
+            "WHERE branch = ? AND version > ? AND version <= ? ORDER BY version LIMIT ?", bounds
+        )
+        tombstones = self._rows(
+            "SELECT collection, key, version FROM tombstones WHERE branch = ? AND version > ? AND version <= ? "
+            "ORDER BY version LIMIT ?", bounds
+        )
+        for tombstone in tombstones:
+            if tombstone["collection"] == "transactions":
+                tombstone["key"] = int(tombstone["key"])
+        return merge_changes(version, transactions, stock, tombstones, limit)
+
+    # Analytics
+    async def change_version(self, branch: str) -> int:
+        return self._scalar("SELECT value FROM counters WHERE branch = ? AND name = ?", (branch, CHANGE_COUNTER)) or 0
+
+    async def margin_totals(self, branch, group_by, period_length=None, date_from=None, date_to=None) -> List[dict]:
+        where, params = date_range_filter("t.date", date_from, date_to)
+        key, key_params = ("substr(t.date, 1, ?)", [period_length]) if group_by == "period" else (f"s.{group_by}", [])
+        # Joined on the (branch, item_number) unique index
+        return self._rows(
+            f"SELECT {key} AS key, COUNT(*) AS count, SUM(t.amount) AS revenue, SUM(s.price) AS cost "
+            "FROM transactions t JOIN stock_items s ON s.branch = t.branch AND s.item_number = t.stock_code "
+            f"WHERE {' AND '.join(['t.branch = ?', 't.transaction_type = ?'] + where)} GROUP BY key ORDER BY key",
+            key_params + [branch, "sell"] + params
+        )
+
+    async def stock_aging(self, branch: str, cutoffs: List[str]) -> List[dict]:
+        cases = " ".join(f"WHEN date_of_purchase >= ? THEN {index}" for index in range(len(cutoffs)))
+        return self._rows(
+            f"SELECT CASE {cases} ELSE {len(cutoffs)} END AS bucket, COUNT(*) AS count, SUM(price) AS value "
+            "FROM stock_items WHERE branch = ? AND status = 'current' GROUP BY bucket ORDER BY bucket",
+            list(cutoffs) + [branch]
+        )
+
+    # Period closing
+    # Checked inside each write transaction, and the close itself is one
+    # transaction: the snapshot, and the move to the archive, are atomic
+    # with respect to every other write.
+    def _closed_through(self, branch: str) -> Optional[str]:
+        return self._scalar("SELECT MAX(period_end) FROM period_snapshots WHERE branch = ?", (branch,))
+
+    def _check_open(self, branch: str, dates: Iterable[str]):
+        earlier = backdated(dates)
+        closed = self._closed_through(branch) if earlier else None
+        if closed and min(earlier) <= closed:
+            raise PeriodClosed(min(earlier))
+
+    async def closed_through(self, branch: str) -> Optional[str]:
+        return self._closed_through(branch)
+
+    async def close_period(self, branch: str, period: str, period_end: str, archive: bool = False) -> dict:
+        with self._write():
+            closed = self._closed_through(branch)
+            if closed and period_end <= closed:
+                raise PeriodClosed(closed)
+            snapshot = {
+                "period": period,
+                "period_end": period_end,
+                "closed_at": datetime.now(timezone.utc).replace(microsecond=0).isoformat(),
+                "ledger": self._balance_as_of(branch, period_end),
+            }
+            self.conn.execute(
+                "INSERT INTO period_snapshots (branch, period_end, period, closed_at, ledger) VALUES (?, ?, ?, ?, ?)",
+                (branch, period_end, period, snapshot["closed_at"], json.dumps(snapshot["ledger"]))
+            )
+            archived = 0
+            if archive:
+                fields = ("branch",) + TRANSACTION_FIELDS
+                archived = self.conn.execute(
+                    f"INSERT INTO transactions_archive ({columns(fields)}) SELECT {columns(fields)} FROM transactions "
+                    "WHERE branch = ? AND date <= ? ORDER BY seq", (branch, period_end)
+                ).rowcount
+                self.conn.execute("DELETE FROM transactions WHERE branch = ? AND date <= ?", (branch, period_end))
+                if archived:
+                    # Archived rows leave the lists, so cached analytics must go too
+                    self._next_versions(branch)
+        return {**snapshot, "archived": archived}
+
+    async def list_snapshots(self, branch: str) -> List[dict]:
+        rows = self._rows("SELECT period, period_end, closed_at, ledger FROM period_snapshots WHERE branch = ? "
+                          "ORDER BY period_end", (branch,))
+        return [{**row, "ledger": json.loads(row["ledger"])} for row in rows]
+
+    async def balance_as_of(self, branch: str, as_of: str) -> Dict[str, dict]:
+        return self._balance_as_of(branch, as_of)
+
+    def _balance_as_of(self, branch: str, as_of: str) -> Dict[str, dict]:
+        rows = self._rows("SELECT period_end, ledger FROM period_snapshots WHERE branch = ? AND period_end <= ? "
+                          "ORDER BY period_end DESC LIMIT 1", (branch, as_of))
+        where, params = ["branch = ?", "date <= ?"], [branch, as_of]
+        if rows:
+            where.append("date > ?")
+            params.append(rows[0]["period_end"])
+        return add_ledgers(json.loads(rows[0]["ledger"]) if rows else {}, self._ledger_totals(where, params))
+
+    # Exports
+    def export_transactions(self, branch, date_from=None, date_to=None, transaction_type=None):
+        where, params = date_range_filter("date", date_from, date_to)
+        where.insert(0, "branch = ?")
+        params.insert(0, branch)
+        if transaction_type:
+            where.append("transaction_type = ?")
+            params.append(transaction_type)
+        # (branch, date, name, seq) is the transactions_date_name index order
+        return self._export("transactions", TRANSACTION_FIELDS, where, params, order=("date", "name"))
+
+    def export_stock(self, branch, status=None, date_from=None, date_to=None):
+        where, params = date_range_filter("date_of_purchase", date_from, date_to)
+        where.insert(0, "branch = ?")
+        params.insert(0, branch)
+        if status:
+            where.append("status = ?")
+            params.append(status)
+        return self._export("stock_items", STOCK_FIELDS, where, params)
+
+    # Balance ledger
+    def _apply_to_ledger(self, branch: str, transactions: List[dict], sign: int = 1):
+        self.conn.executemany(
+            "INSERT INTO balances (branch, payment_method, balance, count) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (branch, payment_method) DO UPDATE SET "
+            "balance = balance + excluded.balance, count = count + excluded.count",
+            [(branch, method, balance, count)
+             for method, (balance, count) in ledger_deltas(transactions, sign).items()]
+        )
+
+    async def get_ledger(self, branch: str) -> Dict[str, dict]:
+        ledger = {method: {"balance": 0.0, "count": 0} for method in PAYMENT_METHODS}
+        for row in self.conn.execute("SELECT payment_method, balance, count FROM balances WHERE branch = ?",
+                                     (branch,)):
+            if row["payment_method"] in ledger:
+                ledger[row["payment_method"]] = {"balance": row["balance"], "count": row["count"]}
+        return ledger
+
+    async def branch_ledgers(self) -> Dict[str, Dict[str, dict]]:
+        ledgers = {}
+        for row in self.conn.execute("SELECT branch, payment_method, balance, count FROM balances"):
+            if row["payment_method"] in PAYMENT_METHODS:
+                ledger = ledgers.setdefault(row["branch"], {method: {"balance": 0.0, "count": 0}
+                                                            for method in PAYMENT_METHODS})
+                ledger[row["payment_method"]] = {"balance": row["balance"], "count": row["count"]}
+        return ledgers
+
+    async def compute_balances_from_history(self, branch: str) -> Dict[str, dict]:
+        return self._ledger_totals(["branch = ?"], [branch])
+
+    def _ledger_totals(self, where: List[str], params: list) -> Dict[str, dict]:
+        """Ledger of the matching transactions, live and archived."""
+        ledgers = []
+        for table in ("transactions", "transactions_archive"):
+            totals = empty_ledger()
+            rows = self.conn.execute(
+                "SELECT payment_method, "
+                "SUM(CASE WHEN transaction_type IN ('sell', 'purchase') THEN amount "
+                "WHEN transaction_type = 'spending' THEN -amount ELSE 0 END), COUNT(*) "
+                f"FROM {table} WHERE {' AND '.join(where)} "
+                f"AND payment_method IN ({', '.join('?' * len(PAYMENT_METHODS))}) "
+                "GROUP BY payment_method", list(params) + list(PAYMENT_METHODS)
+            )
+            for method, balance, count in rows:
+                totals[method] = {"balance": float(balance), "count": count}
+            ledgers.append(totals)
+        return add_ledgers(*ledgers)
+
+    async def rebuild_balances(self, branch: str) -> Dict[str, dict]:
+        totals = await self.compute_balances_from_history(branch)
+        with self._write():
+            self.conn.execute("DELETE FROM balances WHERE branch = ?", (branch,))
+            self.conn.executemany(
+                "INSERT INTO balances (branch, payment_method, balance, count) VALUES (?, ?, ?, ?)",
+                [(branch, method, values["balance"], values["count"]) for method, values in totals.items()]
+            )
+        return totals
+
+    # Daily rollups
+    def _apply_to_rollups(self, branch: str, transactions: List[dict], sign: int = 1):
+        self.conn.executemany(
+            "INSERT INTO daily_rollups (branch, date, transaction_type, payment_method, amount, count) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (branch, date, transaction_type, payment_method) DO UPDATE SET "
+            "amount = amount + excluded.amount, count = count + excluded.count",
+            [(branch,) + key + (amount, count) for key, (amount, count) in rollup_deltas(transactions, sign).items()]
+        )
+
+    async def rebuild_rollups(self, branch: str) -> int:
+        type_marks = ", ".join("?" * len(TRANSACTION_TYPES))
+        method_marks = ", ".join("?" * len(PAYMENT_METHODS))
+        with self._write():
+            self.conn.execute("DELETE FROM daily_rollups WHERE branch = ?", (branch,))
+            self.conn.execute(
+                "INSERT INTO daily_rollups (branch, date, transaction_type, payment_method, amount, count) "
+                "SELECT branch, date, transaction_type, payment_method, SUM(amount), COUNT(*) FROM ("
+                "SELECT branch, date, transaction_type, payment_method, amount FROM transactions UNION ALL "
+                "SELECT branch, date, transaction_type, payment_method, amount FROM transactions_archive) "
+                f"WHERE branch = ? AND transaction_type IN ({type_marks}) AND payment_method IN ({method_marks}) "
+                "GROUP BY date, transaction_type, payment_method", (branch,) + TRANSACTION_TYPES + PAYMENT_METHODS
+            )
+        return self._scalar("SELECT COUNT(DISTINCT date) FROM daily_rollups WHERE branch = ?", (branch,))
+
+    async def rollup_totals(self, branch, period_length, date_from=None, date_to=None) -> List[dict]:
+        rows = await self._rollup_totals(period_length, date_from, date_to, branch=branch)
+        for row in rows:
+            del row["branch"]
+        return rows
+
+    async def branch_rollup_totals(self, period_length, date_from=None, date_to=None) -> List[dict]:
+        return await self._rollup_totals(period_length, date_from, date_to)
+
+    async def _rollup_totals(self, period_length, date_from, date_to, branch: Optional[str] = None) -> List[dict]:
+        period = "substr(date, 1, ?)" if period_length else "NULL"
+        where, params = date_range_filter("date", date_from, date_to)
+        if branch:
+            where.insert(0, "branch = ?")
+            params.insert(0, branch)
+        if period_length:
+            params.insert(0, period_length)
+        rows = self.conn.execute(
+            f"SELECT branch, {period} AS period, transaction_type, payment_method, SUM(amount), SUM(count) "
+            f"FROM daily_rollups WHERE {' AND '.join(where or ['1 = 1'])} "
+            f"GROUP BY branch, period, transaction_type, payment_method ORDER BY branch, period", params
+        )
+
+        grouped = {}
+        for branch_key, period_key, trans_type, method, amount, count in rows:
+            totals = grouped.setdefault((branch_key, period_key), empty_rollup_totals())
+            totals[trans_type][method] = {"amount": amount, "count": count}
+        return [{"branch": branch_key, "period": period_key, "totals": totals}
+                for (branch_key, period_key), totals in grouped.items()]
+
+
+class _Transaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back if the block raises. Nested use
+    joins the outer transaction."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+        self.owner = False
+
+    def __enter__(self):
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.owner = True
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.owner:
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""Local load-testing harness for the sales tracker API.
+
+Boots `server.app` in-process (no network hop) against an in-memory MongoDB
+stand-in (mongomock-motor), a local mongod or one of the SQLite backends,
+seeds a configurable dataset and drives every route concurrently. Latency percentiles and
+throughput per endpoint are printed and written as JSON so runs can be
+compared across commits:
+
+    python backend_benchmark.py --transactions 100000 --output bench.json
+    python backend_benchmark.py --mongo-url mongodb://localhost:27017 --baseline bench.json
+    python backend_benchmark.py --storage sqlite --baseline bench.json
+
+The "(group commit)" scenarios repeat the transaction POSTs with a
+TransactionBatcher of --write-batch-items/--write-batch-delay-ms swapped in,
+for a side-by-side comparison with the one-write-per-request path. Likewise
+the "(fast list)" scenarios repeat the list reads with FAST_LIST_RESPONSES
+on, while the plain ones run with it off.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent
+sys.path.insert(0, str(ROOT_DIR / "backend"))
+
+SEED_BATCH_SIZE = 10000
+PAYMENT_METHODS = ["cash", "bank1", "bank2"]
+ITEM_TYPES = ["Laptop", "Desktop", "Monitor", "Keyboard", "Mouse", "Printer"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the sales tracker API in-process")
+    parser.add_argument("--storage", choices=["mongomock", "mongo", "sqlite", "memory"],
+                        help="Storage backend (default: mongo with --mongo-url, else mongomock)")
+    parser.add_argument("--mongo-url", help="Use a real mongod instead of mongomock-motor")
+    parser.add_argument("--db-name", default="sales_tracker_benchmark")
+    parser.add_argument("--sqlite-path", help="SQLite database file (default: a temporary file)")
+    parser.add_argument("--transactions", type=int, default=10000, help="Transactions to seed")
+    parser.add_argument("--stock-items", type=int, default=2000, help="Stock items to seed")
+    parser.add_argument("--contacts", type=int, default=200, help="Customers and suppliers to seed")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight per endpoint")
+    parser.add_argument("--write-batch-items", type=int, default=32,
+                        help="Batch size for the group commit scenarios")
+    parser.add_argument("--write-batch-delay-ms", type=float, default=5.0,
+                        help="Flush delay for the group commit scenarios")
+    parser.add_argument("--scenarios", help="Comma separated scenario names to run (default: all)")
+    parser.add_argument("--output", help="Write results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare against a previous JSON result file")
+    args = parser.parse_args()
+    if not args.storage:
+        args.storage = "mongo" if args.mongo_url else "mongomock"
+    if args.storage == "mongo" and not args.mongo_url:
+        parser.error("--storage mongo needs --mongo-url")
+    return args
+
+
+def connect(args):
+    """Import the app and point it at the selected storage backend."""
+    os.environ["MONGO_URL"] = args.mongo_url or "mongodb://localhost:27017"
+    os.environ["DB_NAME"] = args.db_name
+    os.environ["STORAGE_BACKEND"] = "mongo" if args.storage == "mongomock" else args.storage
+    if args.storage == "sqlite":
+        os.environ["SQLITE_PATH"] = args.sqlite_path or str(Path(tempfile.mkdtemp()) / "benchmark.db")
+    import server
+
+    if args.storage == "mongomock":
+        from mongomock_motor import AsyncMongoMockClient
+        from storage.mongo import MongoStorage
+        server.storage = MongoStorage(AsyncMongoMockClient(), args.db_name)
+    return server
+
+
+async def seed(server, args):
+    storage = server.storage
+    branch = server.DEFAULT_BRANCH
+    await storage.clear()
+
+    rng = random.Random(42)
+    start = date(2020, 1, 1)
+
+    for name in ITEM_TYPES:
+        await storage.insert_item_type(branch, {"name": name})
+    for i in range(args.contacts):
+        await storage.insert_contact(branch, {"name": f"Contact {i}", "type": "customer" if i % 2 else "supplier"})
+
+    for offset in range(0, args.stock_items, SEED_BATCH_SIZE):
+        count = min(SEED_BATCH_SIZE, args.stock_items - offset)
+        first = await storage.reserve_stock_numbers(branch, count)
+        await storage.insert_stock_items(branch, [
+            {
+                "item_number": str(first + i),
+                "date_of_purchase": (start + timedelta(days=(offset + i) % 1500)).isoformat(),
+                "type": rng.choice(ITEM_TYPES),
+                "description": f"Item {offset + i}",
+                "supplier_name": f"Contact {2 * ((offset + i) % max(1, args.contacts // 2))}",
+                "phone": "5555555555",
+                "price": round(rng.uniform(500, 80000), 2),
+                "status": "current",
+            }
+            for i in range(count)
+        ])
+
+    # Ledger and rollups are kept current by record_transactions
+    for offset in range(0, args.transactions, SEED_BATCH_SIZE):
+        await storage.record_transactions(branch, [
+            ({
+                "date": (start + timedelta(days=i % 1500)).isoformat(),
+                "transaction_type": rng.choice(["sell", "purchase", "spending"]),
+                "name": f"Contact {i % max(1, args.contacts)}",
+                "amount": round(rng.uniform(10, 50000), 2),
+                "payment_method": rng.choice(PAYMENT_METHODS),
+                "stock_code": None,
+            }, None)
+            for i in range(offset, min(offset + SEED_BATCH_SIZE, args.transactions))
+        ])
+
+    # Written behind the API's back: drop the reference data startup cached
+    server.reference_cache.invalidate(f"item_types:{branch}")
+    server.reference_cache.invalidate(f"customers_suppliers:{branch}")
+
+
+def build_scenarios(args):
+    """Each scenario is (name, method, request factory); factories get the request index."""
+    stock_item = {
+        "date_of_purchase": "2024-03-01",
+        "type": "Laptop",
+        "description": "Benchmark laptop",
+        "supplier_name": "Contact 0",
+        "phone": "5555555555",
+        "price": 45000,
+    }
+    sold_numbers = iter(range(1000, 1000 + args.stock_items))
+
+    def spending(i):
+        return {"date": "2024-03-01", "transaction_type": "spending", "name": f"Bench {i}",
+                "amount": 10.5, "payment_method": PAYMENT_METHODS[i % 3]}
+
+    def sell(i):
+        return {"date": "2024-03-02", "transaction_type": "sell", "name": f"Bench {i}",
+                "amount": 1000, "payment_method": "cash", "stock_code": str(next(sold_numbers, 0))}
+
+    return [
+        ("GET /api/balance", "GET", lambda i: ("/api/balance", None)),
+        ("GET /api/dashboard", "GET", lambda i: ("/api/dashboard", None)),
+        ("GET /api/dashboard (no transactions)", "GET",
+         lambda i: ("/api/dashboard?sections=balance,stock,customers,suppliers", None)),
+        ("GET /api/item-types", "GET", lambda i: ("/api/item-types", None)),
+        ("GET /api/customers-suppliers", "GET", lambda i: ("/api/customers-suppliers?type=customer", None)),
+        ("GET /api/stock", "GET", lambda i: ("/api/stock?status=current", None)),
+        ("GET /api/stock?limit=100", "GET", lambda i: ("/api/stock?status=current&limit=100", None)),
+        ("GET /api/transactions?limit=1000", "GET", lambda i: ("/api/transactions?limit=1000", None)),
+        ("GET /api/transactions?stream", "GET", lambda i: ("/api/transactions?stream=true&limit=1000", None)),
+        ("GET /api/transactions?newest_first", "GET",
+         lambda i: ("/api/transactions?newest_first=true&limit=200", None)),
+        ("GET /api/stock (fast list)", "GET", lambda i: ("/api/stock?status=current", None)),
+        ("GET /api/transactions?limit=1000 (fast list)", "GET", lambda i: ("/api/transactions?limit=1000", None)),
+        ("GET /api/dashboard (fast list)", "GET", lambda i: ("/api/dashboard", None)),
+        ("GET /api/search", "GET", lambda i: (f"/api/search?q=item%20{i % 100}&kind=stock", None)),
+        ("GET /api/search (contacts)", "GET", lambda i: (f"/api/search?q=cont%20{i % 100}", None)),
+        ("GET /api/reports/pnl", "GET", lambda i: ("/api/reports/pnl?period=month", None)),
+        ("GET /api/reports/payment-methods", "GET", lambda i: ("/api/reports/payment-methods", None)),
+        ("POST /api/stock", "POST", lambda i: ("/api/stock", stock_item)),
+        ("POST /api/stock/bulk", "POST", lambda i: ("/api/stock/bulk", [stock_item] * 50)),
+        ("POST /api/transactions", "POST", lambda i: ("/api/transactions", spending(i))),
+        ("POST /api/transactions (sell)", "POST", lambda i: ("/api/transactions", sell(i))),
+        ("POST /api/transactions (group commit)", "POST", lambda i: ("/api/transactions", spending(i))),
+        ("POST /api/transactions (group commit sell)", "POST", lambda i: ("/api/transactions", sell(i))),
+    ]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(http, method, factory, args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, errors, payload_bytes = [], 0, 0
+
+    async def one(i):
+        nonlocal errors, payload_bytes
+        path, body = factory(i)
+        async with semaphore:
+            started = time.perf_counter()
+            response = await http.request(method, path, json=body)
+            latencies.append(time.perf_counter() - started)
+        payload_bytes += len(response.content)
+        if response.status_code >= 400:
+            errors += 1
+
+    wall_started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(args.requests)))
+    wall = time.perf_counter() - wall_started
+
+    latencies.sort()
+    return {
+        "requests": args.requests,
+        "errors": errors,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "throughput_rps": round(args.requests / wall, 1),
+        "avg_response_bytes": payload_bytes // max(1, args.requests),
+    }
+
+
+async def run_batched(server, http, method, factory, args):
+    """run_scenario with group commit enabled for its duration."""
+    default_batcher = server.transaction_batcher
+    server.transaction_batcher = server.TransactionBatcher(args.write_batch_items, args.write_batch_delay_ms)
+    server.transaction_batcher.start()
+    try:
+        return await run_scenario(http, method, factory, args)
+    finally:
+        await server.transaction_batcher.stop()
+        server.transaction_batcher = default_batcher
+
+
+async def run_fast_list(server, http, method, factory, args, enabled):
+    """run_scenario with FAST_LIST_RESPONSES switched on or off for its duration."""
+    default = server.fast_list_responses
+    server.fast_list_responses = enabled
+    try:
+        return await run_scenario(http, method, factory, args)
+    finally:
+        server.fast_list_responses = default
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def print_results(results, baseline=None):
+    print(f"\n{'endpoint':<44}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'errors':>8}")
+    for name, r in results.items():
+        line = f"{name:<44}{r['p50_ms']:>10}{r['p95_ms']:>10}{r['p99_ms']:>10}{r['throughput_rps']:>10}{r['errors']:>8}"
+        previous = (baseline or {}).get(name)
+        if previous and previous["p50_ms"]:
+            line += f"   p50 x{r['p50_ms'] / previous['p50_ms']:.2f} vs baseline"
+        print(line)
+
+
+async def main():
+    args = parse_args()
+    server = connect(args)
+
+    import httpx
+
+    scenarios = build_scenarios(args)
+    if args.scenarios:
+        wanted = {name.strip() for name in args.scenarios.split(",")}
+        scenarios = [s for s in scenarios if s[0] in wanted]
+
+    results = {}
+    async with server.app.router.lifespan_context(server.app):
+        print(f"🌱 Seeding {args.transactions} transactions, {args.stock_items} stock items, "
+              f"{args.contacts} contacts ({args.storage})...")
+        seed_started = time.perf_counter()
+        await seed(server, args)
+        print(f"   seeded in {time.perf_counter() - seed_started:.1f}s")
+
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as http:
+            for name, method, factory in scenarios:
+                print(f"🚀 {name}")
+                if "group commit" in name:
+                    results[name] = await run_batched(server, http, method, factory, args)
+                else:
+                    results[name] = await run_fast_list(server, http, method, factory, args,
+                                                        enabled="fast list" in name)
+
+    baseline = None
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())["results"]
+    print_results(results, baseline)
+
+    if args.output:
+        report = {
+            "commit": git_commit(),
+            "backend": args.storage,
+            "dataset": {"transactions": args.transactions, "stock_items": args.stock_items,
+                        "contacts": args.contacts},
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "results": results,
+        }
+        Path(args.output).write_text(json.dumps(report, indent=2))
+        print(f"\n📄 Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
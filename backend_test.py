@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 import requests
+import csv
+import io
 import json
+import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 class ComputerShopAPITester:
@@ -290,17 +294,844 @@ class ComputerShopAPITester:
             self.log_test("Get balance", False,
                         f"- Status: {response.status_code if response else 'No response'}")
 
+    def test_balance_ledger_consistency(self):
+        """Test that the running balance ledger matches transaction history"""
+        print("\n📒 Testing Balance Ledger Consistency...")
+        
+        success, response = self.make_request('GET', 'balance/verify')
+        if success:
+            verify_data = response.json()
+            self.log_test("Balance ledger matches history", verify_data.get('consistent') is True,
+                        f"- Mismatches: {verify_data.get('mismatches')}")
+        else:
+            self.log_test("Verify balance ledger", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+
+    def test_concurrent_stock_numbers(self, parallel=20):
+        """Test that parallel stock inserts never share an item number"""
+        print("\n🔢 Testing Concurrent Stock Number Allocation...")
+        
+        item = {
+            "date_of_purchase": "2024-01-18",
+            "type": "Mouse",
+            "description": "Wireless Mouse",
+            "supplier_name": "Accessories Plus",
+            "phone": "5555555555",
+            "price": 1200
+        }
+        
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(lambda _: self.make_request('POST', 'stock', item, 200),
+                                        range(parallel)))
+        
+        item_numbers = [response.json().get('item_number') for success, response in results if success]
+        all_created = len(item_numbers) == parallel
+        self.log_test("Parallel stock inserts succeed", all_created,
+                    f"- Created: {len(item_numbers)}/{parallel}")
+        no_duplicates = len(set(item_numbers)) == len(item_numbers)
+        self.log_test("Parallel stock inserts get unique numbers", no_duplicates,
+                    f"- Numbers: {sorted(item_numbers, key=int)}")
+
+    def test_sells_and_idempotency(self, parallel=10):
+        """Test a stock item can only be sold once and a retried request is recorded once"""
+        print("\n🔐 Testing Sells and Idempotency Keys...")
+
+        item = {"date_of_purchase": "2024-01-19", "type": "Laptop", "description": "Sell once",
+                "supplier_name": "Tech Supplier", "phone": "1234567890", "price": 60000}
+        codes = []
+        for _ in range(2):
+            success, response = self.make_request('POST', 'stock', item, 200)
+            if success:
+                codes.append(response.json()['item_number'])
+        if len(codes) != 2:
+            self.log_test("Create stock items for sells", False)
+            return
+
+        def sell(code, name):
+            return {"date": "2024-01-20", "transaction_type": "sell", "name": name, "amount": 65000,
+                    "payment_method": "cash", "stock_code": code}
+
+        success, _ = self.make_request('POST', 'transactions', sell(codes[0], "First Buyer"), 200)
+        self.log_test("First sell succeeds", success)
+        success, response = self.make_request('POST', 'transactions', sell(codes[0], "Second Buyer"), 409)
+        self.log_test("Second sell of the same item rejected", success,
+                    f"- Status: {response.status_code if response else 'No response'}")
+
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            results = list(executor.map(
+                lambda i: self.make_request('POST', 'transactions', sell(codes[1], f"Racing Buyer {i}"), 200),
+                range(parallel)))
+        statuses = sorted(response.status_code for _, response in results if response is not None)
+        self.log_test("Concurrent sells of one item: one wins, the rest get 409",
+                      statuses == [200] + [409] * (parallel - 1), f"- Statuses: {statuses}")
+
+        key = f"test-{datetime.now().strftime('%H%M%S%f')}"
+        transaction = {"date": "2024-01-20", "transaction_type": "purchase", "name": f"Retry {key}",
+                       "amount": 1500, "payment_method": "bank1"}
+        try:
+            responses = [requests.post(f"{self.base_url}/api/transactions", json=transaction,
+                                       headers={'Idempotency-Key': key}, timeout=10) for _ in range(2)]
+        except Exception as e:
+            self.log_test("Idempotent retry", False, f"- Request failed: {str(e)}")
+            return
+        first, retry = (response.json() for response in responses)
+        self.log_test("Retry returns the original transaction",
+                      all(r.status_code == 200 for r in responses) and first.get('id') == retry.get('id'),
+                      f"- Ids: {first.get('id')}, {retry.get('id')}")
+        success, response = self.make_request('GET', 'transactions', expected_status=200)
+        booked = [t for t in response.json() if t['name'] == transaction['name']] if success else []
+        self.log_test("Retry is not booked again", len(booked) == 1, f"- Booked: {len(booked)}")
+
+    def test_hot_queries_use_indexes(self):
+        """Test that no hot query shape is planned as a collection scan"""
+        print("\n🗂️  Testing Query Plans...")
+        
+        mongo_url = os.environ.get('MONGO_URL')
+        db_name = os.environ.get('DB_NAME')
+        if not mongo_url or not db_name:
+            print("⚠️  MONGO_URL/DB_NAME not set, skipping explain checks")
+            return
+        
+        from pymongo import MongoClient
+        db = MongoClient(mongo_url, serverSelectionTimeoutMS=5000)[db_name]
+        
+        hot_queries = [
+            ("item_types", {"branch": "main", "name": "Laptop"}, None),
+            ("stock_items", {"branch": "main", "status": "current"}, {"_id": 1}),
+            # Date-ranged pages, with the hint list_stock/list_transactions send
+            ("stock_items", {"branch": "main", "status": "current",
+                             "date_of_purchase": {"$gte": datetime(2024, 1, 1)}}, {"_id": 1}, "status_id"),
+            ("transactions", {"branch": "main", "date": {"$gte": datetime(2024, 1, 1)}}, {"_id": 1}, "branch_id"),
+            ("transactions", {"branch": "main", "date": {"$gte": datetime(2024, 1, 1)}}, {"_id": -1}, "branch_id"),
+            ("stock_items", {"branch": "main", "item_number": "1000"}, None),
+            # The margin report's $lookup side
+            ("stock_items", {"item_number": "1000"}, None),
+            ("transactions", {"branch": "main", "date": "2024-01-20", "name": "John Doe"}, None),
+            # The dashboard's newest-first window
+            ("transactions", {"branch": "main"}, {"_id": -1}),
+            ("customers_suppliers", {"branch": "main", "name": "John Doe", "type": "customer"}, None),
+            ("customers_suppliers", {"branch": "main", "type": "customer"}, {"_id": 1}),
+            ("counters", {"branch": "main", "name": "stock_counter"}, None),
+        ]
+        
+        def stages(plan):
+            yield plan.get('stage')
+            for key in ('inputStage', 'queryPlan'):
+                if key in plan:
+                    yield from stages(plan[key])
+            for child in plan.get('inputStages', []):
+                yield from stages(child)
+        
+        for collection, query, sort, *hint in hot_queries:
+            command = {"find": collection, "filter": query}
+            if sort:
+                command["sort"] = sort
+            if hint:
+                command["hint"] = hint[0]
+            explain = db.command("explain", command, verbosity="queryPlanner")
+            plan_stages = list(stages(explain['queryPlanner']['winningPlan']))
+            self.log_test(f"{collection} {query} uses an index", 'COLLSCAN' not in plan_stages,
+                        f"- Stages: {plan_stages}")
+            if sort:
+                # Sorted shapes page by _id: the index has to supply the order
+                self.log_test(f"{collection} {query} sorted by {sort} without a SORT stage",
+                              'SORT' not in plan_stages, f"- Stages: {plan_stages}")
+
+    def test_bulk_import(self):
+        """Test bulk stock import from a JSON array and a CSV upload"""
+        print("\n📥 Testing Bulk Import...")
+        
+        item = {
+            "date_of_purchase": "2024-02-01",
+            "type": "Monitor",
+            "description": "Dell 24 inch",
+            "supplier_name": "Display World",
+            "phone": "9876543210",
+            "price": 18000
+        }
+        success, response = self.make_request('POST', 'stock/bulk', [item, {"type": "Monitor"}, item], 200)
+        if success:
+            result = response.json()
+            numbers = [int(n) for n in result['item_numbers']]
+            contiguous = numbers == list(range(numbers[0], numbers[0] + len(numbers))) if numbers else False
+            self.log_test("Bulk JSON import inserts valid rows", result['inserted'] == 2 and contiguous,
+                        f"- Item numbers: {result['item_numbers']}")
+            self.log_test("Bulk JSON import reports invalid row", [e['row'] for e in result['errors']] == [2],
+                        f"- Errors: {result['errors']}")
+        else:
+            self.log_test("Bulk JSON import", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+        
+        csv_data = ("date_of_purchase,type,description,supplier_name,phone,price\n"
+                    "2024-02-02,Keyboard,Logitech K120,Accessories Plus,5555555555,900\n")
+        try:
+            response = requests.post(f"{self.base_url}/api/stock/bulk",
+                                     files={'file': ('stock.csv', csv_data, 'text/csv')}, timeout=10)
+            self.log_test("Bulk CSV import", response.status_code == 200 and response.json()['inserted'] == 1,
+                        f"- Status: {response.status_code}")
+        except Exception as e:
+            self.log_test("Bulk CSV import", False, f"- Request failed: {str(e)}")
+
+        cp1252_data = ("date_of_purchase,type,description,supplier_name,phone,price\n"
+                       "2024-02-02,Keyboard,Clavier français,Café Supplies,5555555555,900\n").encode('cp1252')
+        try:
+            response = requests.post(f"{self.base_url}/api/stock/bulk", data=cp1252_data,
+                                     headers={'Content-Type': 'text/csv'}, timeout=10)
+            self.log_test("Non-UTF-8 CSV rejected with 400", response.status_code == 400,
+                        f"- Status: {response.status_code}")
+            response = requests.post(f"{self.base_url}/api/stock/bulk", data=cp1252_data,
+                                     headers={'Content-Type': 'text/csv; charset=cp1252'}, timeout=10)
+            self.log_test("CSV decoded with its declared charset",
+                          response.status_code == 200 and response.json()['inserted'] == 1,
+                          f"- Status: {response.status_code}")
+        except Exception as e:
+            self.log_test("Bulk CSV charsets", False, f"- Request failed: {str(e)}")
+
+    def test_bulk_sells_claim_once(self):
+        """Test a stock item sold through bulk import and a single POST at once is booked once"""
+        print("\n🧾 Testing Bulk Sells...")
+
+        item = {"date_of_purchase": "2024-02-03", "type": "Laptop", "description": "Bulk sell race",
+                "supplier_name": "Tech Supplier", "phone": "1234567890", "price": 50000}
+        success, response = self.make_request('POST', 'stock', item, 200)
+        if not success:
+            self.log_test("Create stock item for bulk sells", False)
+            return
+        item_number = response.json()['item_number']
+        sell = {"date": "2024-02-04", "transaction_type": "sell", "name": f"Bulk Race {item_number}",
+                "amount": 55000, "payment_method": "cash", "stock_code": item_number}
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            bulk = executor.submit(self.make_request, 'POST', 'transactions/bulk', [sell, sell], 200)
+            single = executor.submit(self.make_request, 'POST', 'transactions', sell, 200)
+            (bulk_ok, bulk_response), (single_ok, _) = bulk.result(), single.result()
+
+        inserted = bulk_response.json()['inserted'] if bulk_ok else 0
+        self.log_test("Item sold exactly once", inserted + single_ok == 1,
+                    f"- Bulk inserted: {inserted}, single sell succeeded: {single_ok}")
+        errors = [e['error'] for e in bulk_response.json()['errors']] if bulk_ok else []
+        self.log_test("Bulk reports the rows that lost the claim",
+                      errors == ["Stock item already sold"] * (2 - inserted), f"- Errors: {errors}")
+
+        success, response = self.make_request('GET', 'transactions', expected_status=200)
+        booked = [t for t in response.json() if t.get('stock_code') == item_number] if success else []
+        self.log_test("One transaction booked for the item", len(booked) == 1, f"- Booked: {len(booked)}")
+
+    def test_exports(self):
+        """Test CSV exports stream every matching row with the model columns"""
+        print("\n📤 Testing Exports...")
+        
+        success, response = self.make_request('GET', 'export/transactions', expected_status=200)
+        if success:
+            rows = list(csv.DictReader(io.StringIO(response.text)))
+            success, listed = self.make_request('GET', 'transactions', expected_status=200)
+            expected = len(listed.json()) if success else -1
+            self.log_test("Transaction CSV export has every row", len(rows) == expected,
+                        f"- Exported {len(rows)}, listed {expected}")
+            dates = [(row['date'], row['name']) for row in rows]
+            self.log_test("Transaction CSV export ordered by date", dates == sorted(dates))
+        else:
+            self.log_test("Transaction CSV export", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+        
+        success, response = self.make_request('GET', 'export/stock?status=current&from=2024-01-01&to=2024-12-31',
+                                              expected_status=200)
+        if success:
+            rows = list(csv.DictReader(io.StringIO(response.text)))
+            in_range = all(row['status'] == 'current' and '2024-01-01' <= row['date_of_purchase'] <= '2024-12-31'
+                           for row in rows)
+            self.log_test("Stock CSV export applies filters", in_range, f"- {len(rows)} rows")
+        else:
+            self.log_test("Stock CSV export", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+
+    def test_date_filters(self):
+        """Test from/to date filters on list endpoints"""
+        print("\n📅 Testing Date Filters...")
+        
+        success, response = self.make_request('GET', 'transactions?from=2024-01-01&to=2024-01-31', expected_status=200)
+        if success:
+            dates = [trans['date'] for trans in response.json()]
+            self.log_test("Transactions filtered by date range",
+                        all('2024-01-01' <= d <= '2024-01-31' for d in dates), f"- {len(dates)} rows")
+        else:
+            self.log_test("Transactions filtered by date range", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+        
+        success, response = self.make_request('GET', 'stock?status=current&from=2024-01-01', expected_status=200)
+        if success:
+            dates = [item['date_of_purchase'] for item in response.json()]
+            self.log_test("Stock filtered by purchase date", all(d >= '2024-01-01' for d in dates),
+                        f"- {len(dates)} rows")
+        else:
+            self.log_test("Stock filtered by purchase date", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+        
+        success, _ = self.make_request('GET', 'transactions?from=2024-13-01', expected_status=422)
+        self.log_test("Invalid date filter rejected", success)
+
+    def test_events(self):
+        """Test the change event stream reports a new contact"""
+        print("\n📡 Testing Change Events...")
+        
+        name = f"Event Contact {datetime.now().strftime('%H%M%S%f')}"
+        try:
+            with requests.get(f"{self.base_url}/api/events", stream=True, timeout=10) as response:
+                self.log_test("Event stream is text/event-stream",
+                            response.headers.get('content-type', '').startswith('text/event-stream'))
+                lines = response.iter_lines(decode_unicode=True)
+                next(lines)  # retry interval, sent once the stream is open
+                self.make_request('POST', 'customers-suppliers', {"name": name, "type": "customer"}, 200)
+                event = None
+                for line in lines:
+                    if line.startswith('data:') and name in line:
+                        event = json.loads(line[len('data:'):])
+                        break
+                self.log_test("Contact insert event received",
+                            event == {"op": "insert", "doc": {"name": name, "type": "customer"}}, f"- {event}")
+        except Exception as e:
+            self.log_test("Contact insert event received", False, f"- {e}")
+        self.make_request('DELETE', f'customers-suppliers/{name}/customer', expected_status=200)
+
+    def test_sync(self):
+        """Test delta sync returns new transactions and deletions by id"""
+        print("\n🔄 Testing Delta Sync...")
+        
+        success, response = self.make_request('GET', 'sync?limit=1', expected_status=200)
+        if not success:
+            self.log_test("Sync endpoint", False, f"- Status: {response.status_code if response else 'No response'}")
+            return
+        since = response.json()['version']
+        while response.json()['more']:
+            _, response = self.make_request('GET', f'sync?since={since}', expected_status=200)
+            since = response.json()['version']
+        
+        transaction = {"date": "2024-02-01", "transaction_type": "spending", "name": "Sync Test",
+                       "amount": 1.0, "payment_method": "cash"}
+        success, response = self.make_request('POST', 'transactions', transaction, 200)
+        transaction_id = response.json().get('id') if success else None
+        self.log_test("Transaction has an id", isinstance(transaction_id, int), f"- {transaction_id}")
+        
+        success, response = self.make_request('GET', f'sync?since={since}', expected_status=200)
+        ids = [trans['id'] for trans in response.json()['transactions']] if success else []
+        self.log_test("New transaction in sync delta", transaction_id in ids, f"- {ids}")
+        
+        success, _ = self.make_request('DELETE', f'transactions/{transaction_id}', expected_status=200)
+        self.log_test("Delete transaction by id", success)
+        success, response = self.make_request('GET', f'sync?since={since}', expected_status=200)
+        deleted = response.json()['deleted']['transactions'] if success else []
+        self.log_test("Deleted transaction in sync delta", transaction_id in deleted, f"- {deleted}")
+
+    def test_sync_across_workers(self):
+        """Test a write still in flight on one worker holds back the sync watermark of another"""
+        print("\n🔀 Testing Sync Across Workers...")
+
+        mongo_url = os.environ.get('MONGO_URL')
+        db_name = os.environ.get('DB_NAME')
+        if not mongo_url or not db_name:
+            print("⚠️  MONGO_URL/DB_NAME not set, skipping cross-worker sync checks")
+            return
+        try:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import asyncio
+            from motor.motor_asyncio import AsyncIOMotorClient
+            from storage.mongo import MongoStorage
+        except Exception as e:
+            print(f"⚠️  Backend not importable here ({e}), skipping cross-worker sync checks")
+            return
+
+        def transaction(name):
+            return {"date": "2024-02-01", "transaction_type": "spending", "name": name, "amount": 1.0,
+                    "payment_method": "cash"}
+
+        async def interleave():
+            # Two storages on one scratch database stand in for two workers
+            client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+            scratch = f"{db_name}_sync_workers"
+            first_worker, second_worker = MongoStorage(client, scratch), MongoStorage(client, scratch)
+            try:
+                await first_worker.clear()
+                await first_worker.ensure_indexes()
+                held, release = asyncio.Event(), asyncio.Event()
+                record = first_worker._record_transaction
+
+                async def held_record(*args):
+                    held.set()
+                    await release.wait()
+                    return await record(*args)
+
+                # The first worker has its id but has not written yet when the
+                # second worker writes and a till syncs through it
+                first_worker._record_transaction = held_record
+                slow = asyncio.create_task(first_worker.record_transaction("main", transaction("Slow Worker")))
+                await held.wait()
+                await second_worker.record_transaction("main", transaction("Fast Worker"))
+                during = await second_worker.changes_since("main", 0, 100)
+                release.set()
+                await slow
+                after = await second_worker.changes_since("main", during["version"], 100)
+                return during, after
+            finally:
+                await client.drop_database(scratch)
+                client.close()
+
+        try:
+            during, after = asyncio.run(interleave())
+        except Exception as e:
+            self.log_test("Cross-worker sync", False, f"- Failed: {str(e)}")
+            return
+        self.log_test("Sync stops below the other worker's pending write",
+                      not during['transactions'] and during['version'] == 0,
+                      f"- Version: {during['version']}, names: {[t['name'] for t in during['transactions']]}")
+        names = sorted(t['name'] for t in after['transactions'])
+        self.log_test("Both writes delivered once the pending one is done",
+                      names == ["Fast Worker", "Slow Worker"], f"- Names: {names}")
+
+    def test_branches(self):
+        """Test branches keep their own records and balances, and roll up together"""
+        print("\n🏬 Testing Branches...")
+        
+        branch = f"test-{datetime.now().strftime('%H%M%S%f')}"
+        success, _ = self.make_request('POST', 'branches', {"name": branch}, 200)
+        self.log_test("Create branch", success)
+        success, _ = self.make_request('GET', 'stock?branch=no-such-branch', expected_status=404)
+        self.log_test("Unknown branch rejected", success)
+        
+        transaction = {"date": "2024-03-01", "transaction_type": "sell", "name": "Branch Test",
+                       "amount": 250.0, "payment_method": "bank2"}
+        self.make_request('POST', f'transactions?branch={branch}', transaction, 200)
+        success, response = self.make_request('GET', f'balance?branch={branch}', expected_status=200)
+        balance = response.json() if success else {}
+        self.log_test("Branch has its own balance", balance.get('bank2') == 250.0 and balance.get('total') == 250.0,
+                    f"- {balance}")
+        success, response = self.make_request('GET', 'transactions?limit=5000', expected_status=200)
+        names = [trans['name'] for trans in response.json()] if success else []
+        self.log_test("Branch records not in default branch", "Branch Test" not in names)
+        
+        success, response = self.make_request('GET', 'branches', expected_status=200)
+        listed = {row['name']: row for row in response.json()} if success else {}
+        self.log_test("Branch listed with balance", listed.get(branch, {}).get('total') == 250.0)
+        success, response = self.make_request('GET', 'reports/branches?period=year&from=2024-03-01&to=2024-03-01',
+                                               expected_status=200)
+        rows = [row for row in response.json() if row['branch'] == branch] if success else []
+        self.log_test("Cross-branch report", len(rows) == 1 and rows[0]['sell'] == 250.0, f"- {rows}")
+
+    def test_analytics(self):
+        """Test margins join sells to their stock item and the cached result follows writes"""
+        print("\n📈 Testing Analytics...")
+        
+        item_type = f"Analytics {datetime.now().strftime('%H%M%S%f')}"
+        item = {"date_of_purchase": datetime.now().strftime('%Y-%m-%d'), "type": item_type,
+                "description": "Margin test", "supplier_name": "Margin Supplier", "phone": "1234567890",
+                "price": 1000.0}
+        success, response = self.make_request('POST', 'stock', item, 200)
+        if not success:
+            self.log_test("Create stock item for margins", False)
+            return
+        item_number = response.json()['item_number']
+        
+        def margin_row():
+            success, response = self.make_request('GET', 'analytics/margins?group_by=type', expected_status=200)
+            rows = [row for row in response.json() if row['key'] == item_type] if success else []
+            return rows[0] if rows else None
+        
+        self.log_test("Unsold item has no margin", margin_row() is None)
+        transaction = {"date": "2024-03-01", "transaction_type": "sell", "name": "Margin Customer",
+                       "amount": 1250.0, "payment_method": "cash", "stock_code": item_number}
+        self.make_request('POST', 'transactions', transaction, 200)
+        row = margin_row()
+        self.log_test("Sale joined to its purchase price",
+                      row is not None and row['cost'] == 1000.0 and row['margin'] == 250.0, f"- {row}")
+        
+        success, response = self.make_request('GET', 'analytics/stock-aging', expected_status=200)
+        buckets = [row['bucket'] for row in response.json()] if success else []
+        self.log_test("Stock aging buckets", buckets[:1] == ['0-30'], f"- {buckets}")
+
+    def test_periods(self):
+        """Test closing a past period snapshots its balance and rejects backdated writes"""
+        print("\n🔒 Testing Period Closing...")
+
+        # Closing is permanent, so use a year that predates all other test data;
+        # a second run finds it already closed
+        success, response = self.make_request('POST', 'periods/close', {"period": "2019"}, 200)
+        self.log_test("Close past period", success or (response is not None and response.status_code == 409),
+                      f"- Status: {response.status_code if response else 'No response'}")
+        success, _ = self.make_request('POST', 'periods/close', {"period": "2019"}, 409)
+        self.log_test("Closing twice is rejected", success)
+        success, _ = self.make_request('POST', 'periods/close', {"period": "2999-01"}, 400)
+        self.log_test("Open period cannot be closed", success)
+
+        success, response = self.make_request('GET', 'periods', expected_status=200)
+        snapshots = [s for s in response.json() if s['period'] == "2019"] if success else []
+        self.log_test("Snapshot listed", len(snapshots) == 1 and snapshots[0]['period_end'] == "2019-12-31")
+
+        transaction = {"date": "2019-06-01", "transaction_type": "sell", "name": "Closed Period Customer",
+                       "amount": 10.0, "payment_method": "cash"}
+        success, _ = self.make_request('POST', 'transactions', transaction, 409)
+        self.log_test("Write into closed period rejected", success)
+
+        success, response = self.make_request('GET', 'balance?as_of=2019-12-31', expected_status=200)
+        self.log_test("Balance as of period end matches snapshot",
+                      success and bool(snapshots) and response.json()['total'] == snapshots[0]['total'],
+                      f"- {response.json() if success else None}")
+
+    def test_fast_list_encoding(self):
+        """Test the FAST_LIST_RESPONSES encoder writes the same bytes as the response_model path"""
+        print("\n⚡ Testing Fast List Encoding...")
+        
+        # In-process: the flag is read once at startup, so both paths are
+        # compared on the encoder itself rather than through the live server
+        try:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import server
+            from typing import List
+            from fastapi import FastAPI
+            from fastapi.testclient import TestClient
+        except Exception as e:
+            print(f"⚠️  Backend not importable here ({e}), skipping fast list checks")
+            return
+        
+        transactions = [
+            {"id": 1, "date": "2024-01-01", "transaction_type": "sell", "name": "Zoë", "amount": 2.5,
+             "payment_method": "cash", "stock_code": "1000"},
+            {"id": 2, "date": "2024-01-02", "transaction_type": "purchase", "name": "Ünïcode \"q\"", "amount": 99,
+             "payment_method": "bank1"},
+            # Legacy row without an id or stock code
+            {"date": "2024-01-03", "transaction_type": "spending", "name": "Old", "amount": 0.0,
+             "payment_method": "bank2"},
+        ]
+        stock = [{"item_number": "1000", "date_of_purchase": "2024-01-01", "type": "Laptop", "description": "d é",
+                  "supplier_name": "s", "phone": "1", "price": 123456.78, "status": "current"}]
+        cases = [
+            ("transactions", server.Transaction, transactions),
+            # Outside 1e-4 <= |x| < 1e16 orjson writes floats differently: stdlib fallback
+            ("transactions with 1e16 and 7e-7", server.Transaction,
+             transactions + [dict(transactions[0], id=3, amount=1e16), dict(transactions[0], id=4, amount=7e-7)]),
+            ("stock", server.StockItem, stock),
+        ]
+        for label, model, docs in cases:
+            app = FastAPI()
+            app.get("/", response_model=List[model])(lambda docs=docs: docs)
+            expected = TestClient(app).get("/").content
+            actual = server.list_encoder(model).encode(docs)
+            diverges = next((i for i, (a, b) in enumerate(zip(actual, expected)) if a != b),
+                            min(len(actual), len(expected)))
+            self.log_test(f"Fast encoding of {label} is byte-identical", actual == expected,
+                        f"- {actual[diverges:diverges + 40]!r} vs {expected[diverges:diverges + 40]!r}"
+                        if actual != expected else "")
+
+    def test_batcher_stop(self):
+        """Test transactions recorded after the batcher stops are written directly instead of hanging"""
+        print("\n🛑 Testing Batcher Stop...")
+
+        # In-process on a throwaway in-memory storage: stopping the live
+        # server's batcher would mean stopping the server
+        try:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import asyncio
+            import server
+            from storage import create_storage
+        except Exception as e:
+            print(f"⚠️  Backend not importable here ({e}), skipping batcher checks")
+            return
+
+        def transaction(name):
+            return {"date": "2024-02-01", "transaction_type": "spending", "name": name, "amount": 1.0,
+                    "payment_method": "cash"}
+
+        async def record_around_stop():
+            batcher = server.TransactionBatcher(max_items=4, max_delay_ms=5)
+            batcher.start()
+            before = asyncio.create_task(batcher.record("main", transaction("Before Stop"), None))
+            await asyncio.sleep(0)
+            await batcher.stop()
+            await asyncio.wait_for(before, 5)
+            await asyncio.wait_for(batcher.record("main", transaction("After Stop"), None), 5)
+            page = await server.storage.list_transactions("main")
+            return batcher.enabled, sorted(doc['name'] for doc in page.docs)
+
+        default_storage = server.storage
+        server.storage = create_storage("memory")
+        try:
+            async def run():
+                await server.storage.connect()
+                try:
+                    return await record_around_stop()
+                finally:
+                    await server.storage.close()
+            enabled, names = asyncio.run(run())
+        except Exception as e:
+            self.log_test("Record after batcher stop", False, f"- Failed: {type(e).__name__} {str(e)}")
+            return
+        finally:
+            server.storage = default_storage
+        self.log_test("Stopped batcher is disabled", not enabled)
+        self.log_test("Queued and late transactions both recorded", names == ["After Stop", "Before Stop"],
+                      f"- Names: {names}")
+
+    def test_stock_number_blocks(self):
+        """Test leased stock number blocks hand out each number once, with no gaps across refills"""
+        print("\n🔢 Testing Stock Number Blocks...")
+
+        # In-process: STOCK_NUMBER_BLOCK_SIZE is read once at startup
+        try:
+            sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backend'))
+            import asyncio
+            import server
+            from storage import create_storage
+        except Exception as e:
+            print(f"⚠️  Backend not importable here ({e}), skipping stock number block checks")
+            return
+
+        block_size, leased, bulk_count = 5, 23, 7
+
+        async def allocate():
+            allocator = server.StockNumberAllocator(block_size)
+            # Parallel creates refill the block several times while a bulk
+            # import reserves its range from the same counter
+            numbers = asyncio.gather(*(allocator.next("main") for _ in range(leased)))
+            bulk_first = server.storage.reserve_stock_numbers("main", bulk_count)
+            numbers, bulk_first = await asyncio.gather(numbers, bulk_first)
+            # Use up the rest of the last leased block
+            numbers += [await allocator.next("main") for _ in range(-leased % block_size)]
+            return [int(n) for n in numbers], list(range(bulk_first, bulk_first + bulk_count))
+
+        default_storage = server.storage
+        server.storage = create_storage("memory")
+        try:
+            async def run():
+                await server.storage.connect()
+                try:
+                    return await allocate()
+                finally:
+                    await server.storage.close()
+            numbers, bulk = asyncio.run(run())
+        except Exception as e:
+            self.log_test("Stock number blocks", False, f"- Failed: {type(e).__name__} {str(e)}")
+            return
+        finally:
+            server.storage = default_storage
+        every = numbers + bulk
+        self.log_test("No stock number handed out twice", len(set(every)) == len(every),
+                      f"- {len(every) - len(set(every))} duplicates")
+        self.log_test("No gaps across block refills", sorted(every) == list(range(min(every), min(every) + len(every))),
+                      f"- Numbers: {sorted(every)}")
+
+    def test_reference_cache(self):
+        """Test cached reference lists answer with ETags, 304s and follow writes"""
+        print("\n🗃️  Testing Reference Cache...")
+
+        url = f"{self.base_url}/api/item-types"
+        try:
+            first, second = requests.get(url, timeout=10), requests.get(url, timeout=10)
+            etag = first.headers.get('ETag')
+            self.log_test("Repeated GET returns the same ETag",
+                          first.status_code == 200 and bool(etag) and second.headers.get('ETag') == etag,
+                          f"- ETags: {etag}, {second.headers.get('ETag')}")
+            response = requests.get(url, headers={'If-None-Match': etag}, timeout=10)
+            self.log_test("If-None-Match returns 304", response.status_code == 304 and not response.content,
+                        f"- Status: {response.status_code}")
+
+            name = f"Cache Test {datetime.now().strftime('%H%M%S%f')}"
+            self.make_request('POST', 'item-types', {"name": name}, 200)
+            response = requests.get(url, headers={'If-None-Match': etag}, timeout=10)
+            names = [t['name'] for t in response.json()] if response.status_code == 200 else []
+            self.log_test("Write invalidates the cache", name in names and response.headers.get('ETag') != etag,
+                        f"- Status: {response.status_code}, ETag: {response.headers.get('ETag')}")
+            self.make_request('DELETE', f'item-types/{name}', expected_status=200)
+        except Exception as e:
+            self.log_test("Reference cache", False, f"- Request failed: {str(e)}")
+
+    def test_reports(self):
+        """Test the rollup reports follow creates and deletes and match a rebuild"""
+        print("\n📊 Testing Reports...")
+
+        day = "2024-06-15"
+        window = f"from={day}&to={day}"
+
+        def reports():
+            results = []
+            for endpoint in (f'reports/pnl?period=day&{window}', f'reports/payment-methods?{window}',
+                             f'reports/spending?period=day&{window}'):
+                success, response = self.make_request('GET', endpoint, expected_status=200)
+                results.append(response.json() if success else None)
+            return results
+
+        def day_row(rows):
+            return next((row for row in rows or [] if row['period'] == day),
+                        {'sell': 0.0, 'spending': 0.0, 'net': 0.0, 'count': 0})
+
+        before = reports()
+        ids = []
+        for transaction in ({"transaction_type": "sell", "amount": 100.0, "payment_method": "cash"},
+                            {"transaction_type": "spending", "amount": 40.0, "payment_method": "bank2"}):
+            success, response = self.make_request('POST', 'transactions',
+                                                  {"date": day, "name": "Report Test", **transaction}, 200)
+            if success:
+                ids.append(response.json()['id'])
+        after = reports()
+
+        old, new = day_row(before[0]), day_row(after[0])
+        self.log_test("P&L follows new transactions",
+                      new['sell'] - old['sell'] == 100.0 and new['spending'] - old['spending'] == 40.0
+                      and new['net'] - old['net'] == 60.0 and new['count'] - old['count'] == 2, f"- {new}")
+        methods = {row['payment_method']: row for row in after[1] or []}
+        self.log_test("Payment method report covers every method",
+                      set(methods) == {"cash", "bank1", "bank2"} and methods['bank2']['spending'] >= 40.0,
+                      f"- {after[1]}")
+        spending = day_row(after[2])
+        self.log_test("Spending report by day", spending.get('bank2', 0.0) >= 40.0, f"- {spending}")
+
+        if ids:
+            self.make_request('DELETE', f'transactions/{ids[0]}', expected_status=200)
+        deleted = reports()
+        self.log_test("P&L follows a delete", day_row(deleted[0])['sell'] == old['sell'],
+                    f"- {day_row(deleted[0])}")
+        success, _ = self.make_request('POST', 'reports/rebuild', expected_status=200)
+        self.log_test("Incremental rollups match a rebuild", success and reports() == deleted)
+
+        for query in ('from=2024-6-1', 'to=garbage'):
+            success, response = self.make_request('GET', f'reports/pnl?{query}', expected_status=422)
+            self.log_test(f"Invalid date {query} rejected", success,
+                        f"- Status: {response.status_code if response else 'No response'}")
+
+    def test_pagination(self):
+        """Test keyset pages and the NDJSON stream return the same rows as the unpaged list"""
+        print("\n📄 Testing Pagination...")
+
+        for i in range(5):
+            self.make_request('POST', 'transactions', {"date": "2024-04-02", "transaction_type": "purchase",
+                                                       "name": f"Page {i}", "amount": 2.0,
+                                                       "payment_method": "bank1"}, 200)
+        success, response = self.make_request('GET', 'transactions', expected_status=200)
+        if not success:
+            self.log_test("Unpaged transactions", False)
+            return
+        unpaged = response.json()
+        self.log_test("Unpaged list has no cursor", 'X-Next-Cursor' not in response.headers)
+
+        # About three pages, however many transactions the database holds
+        limit = max(1, (len(unpaged) + 2) // 3)
+        paged, sizes, cursor = [], [], None
+        while len(sizes) <= len(unpaged):
+            endpoint = f'transactions?limit={limit}' + (f'&after={cursor}' if cursor else '')
+            success, response = self.make_request('GET', endpoint, expected_status=200)
+            if not success:
+                break
+            paged += response.json()
+            sizes.append(len(response.json()))
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+        self.log_test("Pages hold at most the limit", len(sizes) > 1 and max(sizes) <= limit,
+                    f"- Limit: {limit}, pages: {sizes}")
+        self.log_test("Pages concatenate to the unpaged list", paged == unpaged,
+                    f"- Rows: {len(paged)}/{len(unpaged)}")
+
+        success, response = self.make_request('GET', 'transactions?after=not-a-cursor&limit=2', expected_status=400)
+        self.log_test("Bad cursor rejected", success,
+                    f"- Status: {response.status_code if response else 'No response'}")
+
+        success, response = self.make_request('GET', 'transactions?stream=true', expected_status=200)
+        streamed = [json.loads(line) for line in response.text.splitlines() if line] if success else []
+        self.log_test("NDJSON stream matches the unpaged list",
+                      success and response.headers.get('content-type', '').startswith('application/x-ndjson')
+                      and streamed == unpaged, f"- Rows: {len(streamed)}/{len(unpaged)}")
+
+    def test_dashboard(self):
+        """Test the dashboard returns a bounded newest-first window of transactions"""
+        print("\n📋 Testing Dashboard...")
+
+        for i in range(3):
+            self.make_request('POST', 'transactions', {"date": "2024-04-01", "transaction_type": "spending",
+                                                       "name": f"Dashboard {i}", "amount": 1.0,
+                                                       "payment_method": "cash"}, 200)
+        success, response = self.make_request('GET', 'dashboard?transactions_limit=2', expected_status=200)
+        if not success:
+            self.log_test("Dashboard loads", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+            return
+        data = response.json()
+        self.log_test("Dashboard has every section",
+                      set(data) == {"transactions", "balance", "stock", "customers", "suppliers"}, f"- {list(data)}")
+        ids = [t['id'] for t in data['transactions']]
+        self.log_test("Dashboard transactions are the newest, newest first",
+                      len(ids) == 2 and ids[0] > ids[1] and ids[0] >= 3, f"- Ids: {ids}")
+
+        cursor = response.headers.get('X-Next-Cursor')
+        self.log_test("Dashboard returns a cursor for older transactions", bool(cursor))
+        success, response = self.make_request('GET', f'transactions?newest_first=true&limit=2&after={cursor}',
+                                              expected_status=200)
+        older = [t['id'] for t in response.json()] if success else []
+        self.log_test("Load more continues with older transactions",
+                      bool(older) and max(older) < min(ids) and older == sorted(older, reverse=True),
+                      f"- Ids: {older}")
+
+    def test_health(self):
+        """Test the liveness and readiness probes"""
+        print("\n🩺 Testing Health Checks...")
+        
+        success, _ = self.make_request('GET', 'health/live', expected_status=200)
+        self.log_test("Liveness probe", success)
+        success, response = self.make_request('GET', 'health/ready', expected_status=200)
+        body = response.json() if success else {}
+        self.log_test("Readiness probe reports database latency",
+                      body.get('status') == 'ready' and body.get('db_latency_ms', -1) >= 0, f"- {body}")
+
+    def test_search(self):
+        """Test typeahead search matches accent-insensitive word prefixes"""
+        print("\n🔎 Testing Search...")
+        
+        name = f"Zoë Typeahead {datetime.now().strftime('%H%M%S%f')}"
+        self.make_request('POST', 'customers-suppliers', {"name": name, "type": "customer"}, 200)
+        
+        success, response = self.make_request('GET', 'search?q=zoe%20typea&kind=customer', expected_status=200)
+        if success:
+            names = [result['name'] for result in response.json()]
+            self.log_test("Search finds contact by normalized prefix", name in names, f"- Results: {names}")
+        else:
+            self.log_test("Search finds contact by normalized prefix", False,
+                        f"- Status: {response.status_code if response else 'No response'}")
+        
+        success, response = self.make_request('GET', 'search?q=zoe%20typea&kind=supplier', expected_status=200)
+        self.log_test("Search filters by kind", success and all(r['kind'] == 'supplier' for r in response.json()))
+        
+        self.make_request('DELETE', f'customers-suppliers/{name}/customer', expected_status=200)
+
     def run_all_tests(self):
         """Run all backend API tests"""
         print("🚀 Starting Computer Shop Management System API Tests")
         print(f"🌐 Testing against: {self.base_url}")
         
         # Test in sequence as some tests depend on previous ones
+        self.test_health()
         self.test_item_types_management()
         stock_codes = self.test_stock_management()
         self.test_customer_supplier_management()
         self.test_transaction_management(stock_codes)
         self.test_balance_calculation()
+        self.test_balance_ledger_consistency()
+        self.test_concurrent_stock_numbers()
+        self.test_sells_and_idempotency()
+        self.test_hot_queries_use_indexes()
+        self.test_bulk_import()
+        self.test_fast_list_encoding()
+        self.test_batcher_stop()
+        self.test_stock_number_blocks()
+        self.test_reference_cache()
+        self.test_reports()
+        self.test_pagination()
+        self.test_dashboard()
+        self.test_bulk_sells_claim_once()
+        self.test_exports()
+        self.test_date_filters()
+        self.test_search()
+        self.test_events()
+        self.test_sync()
+        self.test_sync_across_workers()
+        self.test_branches()
+        self.test_analytics()
+        self.test_periods()
         
         # Print final results
         print(f"\n📊 Final Results: {self.tests_passed}/{self.tests_run} tests passed")
@@ -0,0 +1,62 @@
+import { useEffect, useRef } from 'react';
+import { BRANCH } from '../lib/branch';
+
+const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
+
+const EVENT_COLLECTIONS = ['stock', 'transactions', 'contacts', 'balance'];
+
+// Subscribes to the branch's server-sent change events (GET /api/events) and
+// calls handlers[collection]({ op, doc }) for each one. Changes made while the
+// stream was down are not replayed, so onReconnect runs after every reconnect.
+// Returns a ref that is true while the stream is open: pages skip their own
+// refetch after a write then, as the change arrives as an event.
+export const useChangeEvents = (handlers, onReconnect) => {
+  const handlersRef = useRef(handlers);
+  const onReconnectRef = useRef(onReconnect);
+  const live = useRef(false);
+  handlersRef.current = handlers;
+  onReconnectRef.current = onReconnect;
+
+  useEffect(() => {
+    if (typeof EventSource === 'undefined') return undefined;
+
+    const source = new EventSource(`${BACKEND_URL}/api/events?branch=${encodeURIComponent(BRANCH)}`);
+    let opened = false;
+    source.onopen = () => {
+      live.current = true;
+      if (opened && onReconnectRef.current) onReconnectRef.current();
+      opened = true;
+    };
+    source.onerror = () => {
+      live.current = false;
+    };
+    EVENT_COLLECTIONS.forEach((collection) => {
+      source.addEventListener(collection, (message) => {
+        const handler = handlersRef.current[collection];
+        if (handler) handler(JSON.parse(message.data));
+      });
+    });
+
+    return () => {
+      live.current = false;
+      source.close();
+    };
+  }, []);
+
+  return live;
+};
+
+// True when the event doesn't say what changed and the list must be refetched
+export const needsRefetch = ({ op, doc }) => op === 'reload' || !doc;
+
+// Patches a list with a change event, matching rows on keyFields
+export const applyChange = (items, { op, doc }, keyFields) => {
+  const matches = (item) => keyFields.every((field) => item[field] === doc[field]);
+  if (op === 'insert') return [...items, doc];
+  if (op === 'update') return items.map((item) => (matches(item) ? { ...item, ...doc } : item));
+  if (op === 'delete') {
+    const index = items.findIndex(matches);
+    return index === -1 ? items : [...items.slice(0, index), ...items.slice(index + 1)];
+  }
+  return items;
+};
@@ -1,6 +1,7 @@
 import React from "react";
 import ReactDOM from "react-dom/client";
 import "@/index.css";
+import "@/lib/branch";
 import App from "@/App";
 import { Toaster } from "sonner";
 
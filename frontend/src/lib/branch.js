@@ -0,0 +1,12 @@
+import axios from 'axios';
+
+// Shop branch this client works on: set per till with
+// localStorage.setItem('branch', ...), or for the whole build with
+// REACT_APP_BRANCH. The backend uses its default branch ("main") otherwise.
+export const BRANCH = window.localStorage.getItem('branch') || process.env.REACT_APP_BRANCH || 'main';
+
+// Scope every API request to the branch
+axios.interceptors.request.use((config) => ({
+  ...config,
+  params: { branch: BRANCH, ...config.params },
+}));
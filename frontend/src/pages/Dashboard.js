@@ -20,12 +20,23 @@ import {
 } from '../components/ui/dialog';
 import { Plus, Trash2 } from 'lucide-react';
 import { toast } from 'sonner';
+import { applyChange, needsRefetch, useChangeEvents } from '../hooks/use-change-events';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
+// Older transactions fetched per "Load more" click
+const TRANSACTIONS_PAGE_SIZE = 200;
+
+// Sent with each new transaction so retries and double submits are recorded once
+const newIdempotencyKey = () =>
+  window.crypto?.randomUUID
+    ? window.crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
 const Dashboard = () => {
   const [transactions, setTransactions] = useState([]);
+  const [transactionsCursor, setTransactionsCursor] = useState(null);
   const [balance, setBalance] = useState({ cash: 0, bank1: 0, bank2: 0, total: 0 });
   const [stockItems, setStockItems] = useState([]);
   const [customers, setCustomers] = useState([]);
@@ -43,68 +54,87 @@ const Dashboard = () => {
     stock_code: '',
   });
 
+  const [transactionKey, setTransactionKey] = useState(newIdempotencyKey);
+
   const [customerForm, setCustomerForm] = useState({ name: '' });
   const [supplierForm, setSupplierForm] = useState({ name: '' });
 
   useEffect(() => {
-    fetchTransactions();
-    fetchBalance();
-    fetchStockItems();
-    fetchCustomers();
-    fetchSuppliers();
+    fetchDashboard();
   }, []);
 
-  const fetchTransactions = async () => {
+  // Loads the requested dashboard sections (all of them by default) in one request
+  const fetchDashboard = async (sections) => {
     try {
-      const response = await axios.get(`${API}/transactions`);
-      setTransactions(response.data);
+      const params = sections ? { sections: sections.join(',') } : {};
+      const response = await axios.get(`${API}/dashboard`, { params });
+      const data = response.data;
+      if (data.transactions) {
+        setTransactions(data.transactions);
+        setTransactionsCursor(response.headers['x-next-cursor'] || null);
+      }
+      if (data.balance) setBalance(data.balance);
+      if (data.stock) setStockItems(data.stock);
+      if (data.customers) setCustomers(data.customers);
+      if (data.suppliers) setSuppliers(data.suppliers);
     } catch (error) {
-      console.error('Error fetching transactions:', error);
+      console.error('Error fetching dashboard:', error);
     }
   };
 
-  const fetchBalance = async () => {
+  // The dashboard only loads the newest transactions; this pages in older ones
+  const loadMoreTransactions = async () => {
     try {
-      const response = await axios.get(`${API}/balance`);
-      setBalance(response.data);
-    } catch (error) {
-      console.error('Error fetching balance:', error);
-    }
-  };
-
-  const fetchStockItems = async () => {
-    try {
-      const response = await axios.get(`${API}/stock?status=current`);
-      setStockItems(response.data);
-    } catch (error) {
-      console.error('Error fetching stock items:', error);
-    }
-  };
-
-  const fetchCustomers = async () => {
-    try {
-      const response = await axios.get(`${API}/customers-suppliers?type=customer`);
-      setCustomers(response.data);
+      const response = await axios.get(`${API}/transactions`, {
+        params: { newest_first: true, limit: TRANSACTIONS_PAGE_SIZE, after: transactionsCursor },
+      });
+      setTransactions((items) => [...items, ...response.data]);
+      setTransactionsCursor(response.headers['x-next-cursor'] || null);
     } catch (error) {
-      console.error('Error fetching customers:', error);
+      toast.error('Error loading transactions');
+      console.error('Error loading transactions:', error);
     }
   };
 
-  const fetchSuppliers = async () => {
-    try {
-      const response = await axios.get(`${API}/customers-suppliers?type=supplier`);
-      setSuppliers(response.data);
-    } catch (error) {
-      console.error('Error fetching suppliers:', error);
-    }
-  };
+  // Changes from every till, this one included, are patched in from the event
+  // stream instead of refetching whole lists; only current stock is shown here
+  const live = useChangeEvents(
+    {
+      transactions: (event) => {
+        if (needsRefetch(event)) return fetchDashboard(['transactions']);
+        // Newest first, so new transactions go on top
+        setTransactions((items) =>
+          event.op === 'insert' ? [event.doc, ...items] : applyChange(items, event, ['id'])
+        );
+      },
+      stock: (event) => {
+        if (needsRefetch(event)) return fetchDashboard(['stock']);
+        setStockItems((items) =>
+          applyChange(items, event, ['item_number']).filter((item) => item.status === 'current')
+        );
+      },
+      contacts: (event) => {
+        if (needsRefetch(event)) return fetchDashboard(['customers', 'suppliers']);
+        const setContacts = event.doc.type === 'customer' ? setCustomers : setSuppliers;
+        setContacts((items) => applyChange(items, event, ['name', 'type']));
+      },
+      balance: (event) => {
+        if (needsRefetch(event)) return fetchDashboard(['balance']);
+        setBalance(event.doc);
+      },
+    },
+    () => fetchDashboard()
+  );
 
   const handleAddTransaction = async (e) => {
     e.preventDefault();
     try {
-      await axios.post(`${API}/transactions`, transactionForm);
+      await axios.post(`${API}/transactions`, transactionForm, {
+        headers: { 'Idempotency-Key': transactionKey },
+      });
       toast.success('Transaction added successfully');
       setShowTransactionModal(false);
+      setTransactionKey(newIdempotencyKey());
       setTransactionForm({
         date: new Date().toISOString().split('T')[0],
         transaction_type: 'sell',
@@ -113,9 +143,7 @@ const Dashboard = () => {
         payment_method: 'cash',
         stock_code: '',
       });
-      fetchTransactions();
-      fetchBalance();
-      fetchStockItems();
+      if (!live.current) fetchDashboard(['transactions', 'balance', 'stock']);
     } catch (error) {
       toast.error('Error adding transaction');
       console.error('Error adding transaction:', error);
@@ -132,7 +160,7 @@ const Dashboard = () => {
       toast.success('Customer added successfully');
       setShowCustomerModal(false);
       setCustomerForm({ name: '' });
-      fetchCustomers();
+      if (!live.current) fetchDashboard(['customers']);
     } catch (error) {
       toast.error('Error adding customer');
       console.error('Error adding customer:', error);
@@ -149,7 +177,7 @@ const Dashboard = () => {
       toast.success('Supplier added successfully');
       setShowSupplierModal(false);
       setSupplierForm({ name: '' });
-      fetchSuppliers();
+      if (!live.current) fetchDashboard(['suppliers']);
     } catch (error) {
       toast.error('Error adding supplier');
       console.error('Error adding supplier:', error);
@@ -158,10 +186,9 @@ const Dashboard = () => {
 
   const handleDeleteTransaction = async (transaction) => {
     try {
-      await axios.delete(`${API}/transactions/${transaction.date}/${transaction.name}`);
+      await axios.delete(`${API}/transactions/${transaction.id}`);
       toast.success('Transaction deleted successfully');
-      fetchTransactions();
-      fetchBalance();
+      if (!live.current) fetchDashboard(['transactions', 'balance']);
     } catch (error) {
       toast.error('Error deleting transaction');
       console.error('Error deleting transaction:', error);
@@ -429,6 +456,13 @@ const Dashboard = () => {
               </tbody>
             </table>
           </div>
+          {transactionsCursor && (
+            <div className="px-6 py-4 border-t border-slate-200 text-center">
+              <Button variant="outline" data-testid="load-more-transactions" onClick={loadMoreTransactions}>
+                Load more
+              </Button>
+            </div>
+          )}
         </div>
       </div>
     </div>
@@ -21,13 +21,14 @@ import {
 import { Tabs, TabsContent, TabsList, TabsTrigger } from '../components/ui/tabs';
 import { Plus, Trash2 } from 'lucide-react';
 import { toast } from 'sonner';
+import { applyChange, needsRefetch, useChangeEvents } from '../hooks/use-change-events';
 
 const BACKEND_URL = process.env.REACT_APP_BACKEND_URL;
 const API = `${BACKEND_URL}/api`;
 
 const Stock = () => {
-  const [currentStock, setCurrentStock] = useState([]);
-  const [soldStock, setSoldStock] = useState([]);
+  // Current and sold items in one list, so a sale moves an item between tabs
+  const [stockItems, setStockItems] = useState([]);
   const [itemTypes, setItemTypes] = useState([]);
   const [showItemModal, setShowItemModal] = useState(false);
   const [showTypeModal, setShowTypeModal] = useState(false);
@@ -43,29 +44,36 @@ const Stock = () => {
 
   const [typeForm, setTypeForm] = useState({ name: '' });
 
+  const currentStock = stockItems.filter((item) => item.status === 'current');
+  const soldStock = stockItems.filter((item) => item.status === 'sold');
+
   useEffect(() => {
-    fetchCurrentStock();
-    fetchSoldStock();
+    fetchStock();
     fetchItemTypes();
   }, []);
 
-  const fetchCurrentStock = async () => {
+  const fetchStock = async () => {
     try {
-      const response = await axios.get(`${API}/stock?status=current`);
-      setCurrentStock(response.data);
+      const [current, sold] = await Promise.all([
+        axios.get(`${API}/stock?status=current`),
+        axios.get(`${API}/stock?status=sold`),
+      ]);
+      setStockItems([...current.data, ...sold.data]);
     } catch (error) {
-      console.error('Error fetching current stock:', error);
+      console.error('Error fetching stock:', error);
     }
   };
 
-  const fetchSoldStock = async () => {
-    try {
-      const response = await axios.get(`${API}/stock?status=sold`);
-      setSoldStock(response.data);
-    } catch (error) {
-      console.error('Error fetching sold stock:', error);
-    }
-  };
+  // Stock changes from any till are patched in from the event stream
+  const live = useChangeEvents(
+    {
+      stock: (event) => {
+        if (needsRefetch(event)) return fetchStock();
+        setStockItems((items) => applyChange(items, event, ['item_number']));
+      },
+    },
+    () => fetchStock()
+  );
 
   const fetchItemTypes = async () => {
     try {
@@ -90,7 +98,7 @@ const Stock = () => {
         phone: '',
         price: '',
       });
-      fetchCurrentStock();
+      if (!live.current) fetchStock();
     } catch (error) {
       toast.error('Error adding stock item');
       console.error('Error adding stock item:', error);
@@ -115,8 +123,7 @@ const Stock = () => {
     try {
       await axios.delete(`${API}/stock/${itemNumber}`);
       toast.success('Stock item deleted successfully');
-      fetchCurrentStock();
-      fetchSoldStock();
+      if (!live.current) fetchStock();
     } catch (error) {
       toast.error('Error deleting stock item');
       console.error('Error deleting stock item:', error);